@@ -0,0 +1,130 @@
+"""Multi-process mode for web_monitor_agent.py: a supervisor forks N worker
+processes, each one running its own Probe_engine over a shard of the monitored
+URLs (split by consistent hashing), and restarts any worker that dies.
+sink_connector.py supervises its consumer processes the same way
+"""
+
+import multiprocessing
+import os
+import signal
+import time
+from . import config
+from . import logging_console
+from .hash_ring import Hash_ring
+from .probe_engine import Probe_engine
+
+log = logging_console.getLogger("homeworks")
+
+
+def run_worker(worker_name: str, worker_names: list[str]) -> None:
+    """Entry point of a worker process: Monitor the shard of URLs owned by `worker_name`
+
+    Args:
+        worker_name (str): Name of this worker in the hash ring
+        worker_names (list[str]): Names of all workers in the hash ring
+    """
+    ring = Hash_ring(worker_names)
+
+    def is_in_shard(url: str) -> bool:
+        return ring.get_node(url) == worker_name
+
+    # Read the targets file again, it may have changed since the supervisor started
+    specs = [
+        spec for spec in config.load_monitored_probe_specs() if is_in_shard(spec.url)
+    ]
+    log.info(f"{worker_name}: Monitoring a shard of {len(specs)} URLs")
+    try:
+        Probe_engine(specs, shard_filter=is_in_shard, name=worker_name).run()
+    except KeyboardInterrupt:
+        log.info(f"{worker_name}: Keyboard interruption received (Ctrl+break)")
+
+
+class Agent_supervisor:
+    """Start and supervise the worker processes of web_monitor_agent.py"""
+
+    def __init__(
+        self,
+        workers: int,
+        check_interval_secs: float = 1.0,
+        target=run_worker,
+        stop_timeout_secs: float = 10.0,
+    ) -> None:
+        """Default constructor
+
+        Args:
+            workers (int): Number of worker processes
+            check_interval_secs (float, optional): How often workers are checked. Defaults to 1.0.
+            target (callable, optional): Entry point of every worker process, called
+            as `target(worker_name, worker_names)`. Defaults to `run_worker`.
+            stop_timeout_secs (float, optional): How long workers are given to stop
+            cleanly before they are terminated. Defaults to 10.0.
+
+        Properties:
+            worker_names (list[str]): Names of the workers, used as nodes of the hash ring
+            processes (dict[str, multiprocessing.Process]): Running process of every worker
+            restarts (int): How many times a dead worker has been restarted
+        """
+        if workers < 1:
+            raise ValueError(f"Number of workers must be at least 1, got {workers}")
+        self.check_interval_secs = check_interval_secs
+        self.stop_timeout_secs = stop_timeout_secs
+        self.target = target
+        self.worker_names = [f"worker-{i}" for i in range(workers)]
+        self.processes = {}
+        self.restarts = 0
+        # Fork, so that workers inherit configuration and logging without re-importing
+        self.mp_context = multiprocessing.get_context("fork")
+
+    def start_worker(self, worker_name: str) -> None:
+        """Fork a process for `worker_name`, which takes care of its shard of URLs
+        (or, for other targets, of its share of the work)
+        """
+        process = self.mp_context.Process(
+            target=self.target,
+            args=(worker_name, self.worker_names),
+            name=worker_name,
+            daemon=True,  # Daemons are killed when the supervisor exits
+        )
+        process.start()
+        self.processes[worker_name] = process
+        log.info(f"Started {worker_name} (pid: {process.pid})")
+
+    def stop_workers(self) -> None:
+        """Stop all worker processes and wait for them: They are interrupted as with
+        Ctrl+C (SIGINT), so that they flush and close their connections, and the ones
+        still alive after `self.stop_timeout_secs` are terminated
+        """
+        for process in self.processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+        deadline = time.monotonic() + self.stop_timeout_secs
+        for process in self.processes.values():
+            process.join(max(0.0, deadline - time.monotonic()))
+        for worker_name, process in self.processes.items():
+            if process.is_alive():
+                log.warning(
+                    f"{worker_name} (pid: {process.pid}) did not stop in {self.stop_timeout_secs} seconds, terminating it"
+                )
+                process.terminate()
+                process.join()
+        log.info("All workers stopped")
+
+    def run(self) -> None:
+        """Start all workers and, in a continuous loop, restart the ones which die,
+        reassigning them their same shard
+        """
+        for worker_name in self.worker_names:
+            self.start_worker(worker_name)
+        try:
+            while True:
+                time.sleep(self.check_interval_secs)
+                for worker_name, process in list(self.processes.items()):
+                    if not process.is_alive():
+                        log.warning(
+                            f"{worker_name} (pid: {process.pid}) died with exit code {process.exitcode}, restarting it"
+                        )
+                        process.join()
+                        self.restarts += 1
+                        self.start_worker(worker_name)
+        finally:
+            self.stop_workers()
@@ -0,0 +1,96 @@
+"""When the sink stops accumulating consumed messages and stores them as one batch.
+A batch is flushed as soon as it reaches its target number of rows, a max. number of
+bytes or a max. latency (measured from the moment the sink starts waiting for it, so
+that an idle topic never blocks the sink for longer than that)
+
+In adaptive mode, the target number of rows follows the consumer lag: it doubles while
+the lag is larger than a batch (bigger batches, fewer DB round trips for catching up)
+and halves while batches are flushed by latency with little lag (smaller batches, which
+are flushed sooner, keeping stored metrics fresh)
+"""
+
+from . import logging_console
+
+log = logging_console.getLogger("homeworks")
+
+
+class Batch_window:
+    """Flush policy of the batches of the sink (see module description)"""
+
+    ROWS = "rows"
+    BYTES = "bytes"
+    LATENCY = "latency"
+
+    def __init__(
+        self,
+        max_rows: int,
+        max_bytes: int,
+        max_latency_secs: float,
+        adaptive: bool = True,
+        min_rows: int = 100,
+    ) -> None:
+        """Default constructor
+
+        Args:
+            max_rows (int): Max. rows (samples) of a batch
+            max_bytes (int): Max. bytes of the Kafka messages of a batch
+            max_latency_secs (float): Max. time waiting for a batch
+            adaptive (bool, optional): Adapt the target rows to the consumer lag,
+            otherwise it's always `max_rows`. Defaults to True.
+            min_rows (int, optional): Min. target rows, in adaptive mode. Defaults to 100.
+
+        Properties:
+            target_rows (int): Rows which flush the batch
+        """
+        if max_rows < 1 or max_bytes < 1 or max_latency_secs <= 0:
+            raise ValueError(
+                f"Batch limits must be positive, got {max_rows} rows, {max_bytes} bytes and {max_latency_secs} seconds"
+            )
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_latency_secs = max_latency_secs
+        self.adaptive = adaptive
+        self.min_rows = min(min_rows, max_rows)
+        self.target_rows = self.min_rows if adaptive else max_rows
+
+    def flush_reason(self, rows: int, size_bytes: int, elapsed_secs: float) -> str:
+        """Args:
+            rows (int): Rows accumulated so far
+            size_bytes (int): Bytes accumulated so far
+            elapsed_secs (float): Time waiting for the batch so far
+
+        Returns:
+            str: Why the batch must be flushed now (ROWS, BYTES or LATENCY), None if
+            it can keep accumulating
+        """
+        if rows >= self.target_rows:
+            return self.ROWS
+        if size_bytes >= self.max_bytes:
+            return self.BYTES
+        if elapsed_secs >= self.max_latency_secs:
+            return self.LATENCY
+        return None
+
+    def adapt(self, lag: int, reason: str) -> int:
+        """Adapt the target rows of next batches, after flushing one
+
+        Args:
+            lag (int): Rows (samples) of the assigned partitions not consumed yet,
+            None if unknown
+            reason (str): Why the last batch was flushed, see `flush_reason()`
+
+        Returns:
+            int: New target rows
+        """
+        if not self.adaptive or lag is None:
+            return self.target_rows
+        previous_rows = self.target_rows
+        if lag > self.target_rows:
+            self.target_rows = min(self.max_rows, self.target_rows * 2)
+        elif reason == self.LATENCY and lag < self.target_rows // 2:
+            self.target_rows = max(self.min_rows, self.target_rows // 2)
+        if self.target_rows != previous_rows:
+            log.debug(
+                f"Target batch rows changed from {previous_rows} to {self.target_rows} (lag: {lag})"
+            )
+        return self.target_rows
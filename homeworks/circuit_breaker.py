@@ -0,0 +1,106 @@
+"""Circuit breaker per monitored host: after several consecutive failed probes
+(timeouts, connection errors or unexpected errors), probes of that host are skipped
+for a cool-down period, which doubles every time the host keeps failing. Once it
+expires, one trial probe is allowed, with a shortened timeout, to find out if the host
+recovered
+"""
+
+import time
+from . import logging_console
+
+log = logging_console.getLogger("homeworks")
+
+
+class Circuit_breaker:
+    """Track the health of one host and decide whether it can be probed"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        host: str,
+        failure_threshold: int,
+        cooldown_secs: float,
+        max_cooldown_secs: float,
+        clock=time.monotonic,
+    ) -> None:
+        """Default constructor
+
+        Args:
+            host (str): Name of the monitored host
+            failure_threshold (int): Consecutive failures which open the circuit
+            cooldown_secs (float): Time without probes after the circuit opens
+            max_cooldown_secs (float): Limit for the cool-down, which doubles every time
+            the trial probe fails
+            clock (callable, optional): Monotonic clock in seconds. Defaults to time.monotonic.
+
+        Properties:
+            state (str): CLOSED (probes allowed), OPEN (probes skipped) or HALF_OPEN
+            (one trial probe in flight)
+            consecutive_failures (int): Failed probes since the last successful one
+            current_cooldown_secs (float): Cool-down applied the last time circuit opened
+            open_until (float): Clock value when the trial probe is allowed
+        """
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.cooldown_secs = cooldown_secs
+        self.max_cooldown_secs = max_cooldown_secs
+        self.clock = clock
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.current_cooldown_secs = cooldown_secs
+        self.open_until = 0.0
+
+    def allow_probe(self) -> bool:
+        """Decide whether the host can be probed now. When the cool-down of an open
+        circuit expires, the circuit becomes half-open and only one trial probe is allowed
+
+        Returns:
+            bool: True if the probe can go ahead
+        """
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and self.clock() >= self.open_until:
+            self.state = self.HALF_OPEN
+            log.info(f"Circuit of '{self.host}' is half-open, trying one probe")
+            return True
+        return False
+
+    def record_success(self) -> None:
+        """The host answered: Close the circuit"""
+        if self.state != self.CLOSED:
+            log.info(f"Circuit of '{self.host}' is closed, host recovered")
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.current_cooldown_secs = self.cooldown_secs
+
+    def record_failure(self) -> None:
+        """The host didn't answer: Open the circuit when failures reach the threshold,
+        or open it again (doubling the cool-down) when the trial probe failed
+        """
+        self.consecutive_failures += 1
+        if self.state == self.OPEN:
+            # Probe started before the circuit opened
+            return
+        if self.state == self.HALF_OPEN:
+            self.current_cooldown_secs = min(
+                self.current_cooldown_secs * 2, self.max_cooldown_secs
+            )
+        elif self.consecutive_failures < self.failure_threshold:
+            return
+        self.state = self.OPEN
+        self.open_until = self.clock() + self.current_cooldown_secs
+        log.warning(
+            f"Circuit of '{self.host}' is open after {self.consecutive_failures} consecutive failures, no probes for {self.current_cooldown_secs} seconds"
+        )
+
+    def cancel_trial(self) -> None:
+        """The trial probe ended without outcome, e.g. it was cancelled by a reload or
+        shutdown: Open the circuit again, with its cool-down already expired, so that
+        the next deadline is the trial probe (otherwise no probe would ever be allowed)
+        """
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+            self.open_until = self.clock()
@@ -3,9 +3,13 @@ Its purpose is to isolate communication service from the main application logic
 """
 
 import kafka
-import json
+import struct
+import threading
+import time
 from . import config
 from . import logging_console
+from . import wire_format
+from .batch_window import Batch_window
 
 log = logging_console.getLogger("homeworks")
 
@@ -21,17 +25,67 @@ class Communication_manager:
             kafka_access_key (str): Path to service.key file
             kafka_ca_cert (str): Path to ca.pem file
             kafka_consumer (kafka.KafkaConsumer): Consumer permanent connection to Kafka
+            kafka_consumer_group (str): Consumer group shared by all sinks, None for
+            consuming without group (every consumer reads all messages)
+            consumed_messages (list[dict]): Messages consumed but not returned yet by
+            `consume_messages()`, see `take_consumed_messages()`
+            consumed_offsets (dict): Next offset of every partition, after
+            `consumed_messages` (kafka.TopicPartition -> int)
+            consumed_bytes (int): Size of the Kafka messages of `consumed_messages`
+            consumed_records (int): Number of Kafka messages of `consumed_messages`
+            consumed_full (bool): A consumed Kafka message didn't fit in the target rows
+            of the batch, so it was left for the next one (see `poll_messages()`)
+            samples_per_record (float): Average samples per Kafka message of the last
+            batches, which converts the consumer lag to rows (see `get_lag()`)
+            last_batch_offsets (dict): `consumed_offsets` of the last batch taken with
+            `take_consumed_messages()`, e.g. for committing it once it's stored
+            batch_window (Batch_window): When `consume_messages()` returns a batch
+            last_batch_report (dict): Rows, bytes, flush reason, target rows and lag of
+            the last batch of `consume_messages()`
             kafka_producer (kafka.KafkaProducer): Producer permanent connection to Kafka
             kafka_security_protocol (str): Forces that Kafka communication is SSL
             kafka_topic_name (str): Name of kafka topic used for produce/consume messages
+            kafka_topic_partitions (int): Number of partitions of the topic
+            kafka_wire_format (str): Format of the produced messages, "json" or "binary"
+            kafka_producer_settings (dict): Batching and compression of the producer
+            acked_messages (int): Messages delivered by `send_encoded_message_async()`
+            failed_messages (int): Messages which `send_encoded_message_async()` could
+            not deliver
         """
         self.kafka_access_cert = config.kafka_access_cert
         self.kafka_access_key = config.kafka_access_key
         self.kafka_ca_cert = config.kafka_ca_cert
         self.kafka_consumer = None
+        self.kafka_consumer_group = config.kafka_consumer_group or None
+        self.consumed_messages = []
+        self.consumed_offsets = {}
+        self.consumed_bytes = 0
+        self.consumed_records = 0
+        self.consumed_full = False
+        self.samples_per_record = 1.0
+        self.last_batch_offsets = {}
+        self.batch_window = Batch_window(
+            max_rows=int(config.sink_batch_max_rows),
+            max_bytes=int(config.sink_batch_max_bytes),
+            max_latency_secs=int(config.sink_batch_max_latency_ms) / 1000,
+            adaptive=config.sink_batch_adaptive.lower() == "true",
+        )
+        self.last_batch_report = {}
         self.kafka_producer = None
         self.kafka_security_protocol = "SSL"
         self.kafka_topic_name = config.kafka_topic_name
+        self.kafka_topic_partitions = int(config.kafka_topic_partitions)
+        self.kafka_wire_format = config.kafka_wire_format
+        self.kafka_producer_settings = {
+            "linger_ms": int(config.kafka_producer_linger_ms),
+            "batch_size": int(config.kafka_producer_batch_bytes),
+            "compression_type": config.kafka_producer_compression or None,
+            # Time that send() may block, e.g. while the topic metadata is retrieved
+            "max_block_ms": 10000,
+        }
+        self.acked_messages = 0
+        self.failed_messages = 0
+        self.counters_lock = threading.Lock()
 
     def __del__(self) -> None:
         """Try to close all known connections with Kafka"""
@@ -52,8 +106,14 @@ class Communication_manager:
             log.debug("Consumer connection was closed")
 
     def close_producer(self) -> None:
-        """Close the producer connection"""
+        """Close the producer connection, once the messages still buffered are sent
+        (or their delivery fails)
+        """
         if self.kafka_producer:
+            try:
+                self.kafka_producer.flush(timeout=10.0)
+            except kafka.errors.KafkaTimeoutError:
+                log.warning("Not all buffered messages could be sent to Kafka")
             self.kafka_producer.close()
             self.kafka_producer = None
             log.debug("Producer connection was closed")
@@ -83,8 +143,10 @@ class Communication_manager:
     def connect_producer(self) -> None:
         """Establish a permanent connection to Kafka, for producing
         (pushing/publishing) messages
+        * An existing producer is always kept, even when its connections are down
+        (KafkaProducer reconnects by itself), so that its buffered messages are not lost
         """
-        if self.kafka_producer and self.kafka_producer.bootstrap_connected():
+        if self.kafka_producer:
             log.debug("Producer is already connected")
         else:
             log.debug("Going to connect KafkaProducer")
@@ -95,6 +157,7 @@ class Communication_manager:
                     ssl_cafile=self.kafka_ca_cert,
                     ssl_certfile=self.kafka_access_cert,
                     ssl_keyfile=self.kafka_access_key,
+                    **self.kafka_producer_settings,
                 )
             except Exception:
                 log.exception(
@@ -104,25 +167,37 @@ class Communication_manager:
             else:
                 log.debug("Established connection with KafkaProducer")
 
-    def connect_consumer(self) -> None:
+    def connect_consumer(self, rebalance_listener=None) -> None:
         """Establish a permanent connection with Kafka for consuming (retrieving) messages
-        Note: `auto_offset_reset` is set to "latest" instead of "earliest" because we found
-        that a gap in data is easier to detect than to duplicate registers, see:
-          * How Postgresql COPY TO STDIN With CSV do on conflict do update? https://stackoverflow.com/a/48020691
-          * UPSERTs not working correctly #100, https://github.com/timescale/timescaledb/issues/100
+        * Consumers of the same group (`self.kafka_consumer_group`) share the partitions
+        of the topic. Their offsets are not auto-committed: they are committed once
+        messages are stored, see `commit_consumed_messages()`
+        * An existing consumer is always kept, since a new one would trigger a rebalance
+        of the group
+
+        * Sinks store the next offset of every partition together with its messages
+        (see `Store_manager.store_offsets()`) and seek to them when partitions are
+        assigned (see `seek_consumer()`), so that messages are stored exactly once.
+        Therefore `auto_offset_reset` is "earliest": partitions without stored nor
+        committed offsets are consumed from their first message, without gaps
+        * Without consumer group, nobody assigns partitions nor notifies
+        `rebalance_listener`: the consumer takes all partitions of the topic and the
+        listener is notified of them, so that it seeks to their stored offsets too
+
+        Args:
+            rebalance_listener (kafka.ConsumerRebalanceListener, optional): Notified when
+            partitions are assigned to or revoked from this consumer. Defaults to None.
         """
-        # TODO: Keep a permanent track of processed messages, therefore auto_offset_reset can be set to "latest" without potential duplication
-        # TODO: URGENT! Enabling group_id!=None goes in unexpected scenario where messages are not consumed. Investigate further
-        if self.kafka_consumer and self.kafka_consumer.bootstrap_connected():
+        if self.kafka_consumer:
             log.debug("Consumer is already connected")
         else:
             try:
                 log.debug("Going to connect KafkaConsumer")
                 # Reference about enable_auto_commit=False, see https://www.thebookofjoel.com/python-kafka-consumers
                 self.kafka_consumer = kafka.KafkaConsumer(
-                    self.kafka_topic_name,
-                    auto_offset_reset="latest",
-                    enable_auto_commit=True,
+                    group_id=self.kafka_consumer_group,
+                    auto_offset_reset="earliest",
+                    enable_auto_commit=self.kafka_consumer_group is None,
                     auto_commit_interval_ms=5000,
                     bootstrap_servers=config.kafka_uri,
                     security_protocol=self.kafka_security_protocol,
@@ -130,6 +205,12 @@ class Communication_manager:
                     ssl_certfile=self.kafka_access_cert,
                     ssl_keyfile=self.kafka_access_key,
                 )
+                if self.kafka_consumer_group:
+                    self.kafka_consumer.subscribe(
+                        [self.kafka_topic_name], listener=rebalance_listener
+                    )
+                else:
+                    self.assign_all_partitions(rebalance_listener)
             except Exception:
                 log.exception(
                     f"Consumer cannot establish connection with Kafka, from topic '{self.kafka_topic_name}'"
@@ -138,6 +219,25 @@ class Communication_manager:
             else:
                 log.debug("Established connection with KafkaConsumer")
 
+    def assign_all_partitions(self, rebalance_listener=None) -> None:
+        """Consume all partitions of `self.kafka_topic_name` without consumer group,
+        notifying `rebalance_listener` of them as a group would do
+
+        Args:
+            rebalance_listener (kafka.ConsumerRebalanceListener, optional): Notified
+            when partitions are assigned. Defaults to None.
+        """
+        partitions = self.kafka_consumer.partitions_for_topic(self.kafka_topic_name)
+        if not partitions:
+            raise ValueError(f"Topic '{self.kafka_topic_name}' has no partitions")
+        assigned = [
+            kafka.TopicPartition(self.kafka_topic_name, partition)
+            for partition in sorted(partitions)
+        ]
+        self.kafka_consumer.assign(assigned)
+        if rebalance_listener:
+            rebalance_listener.on_partitions_assigned(assigned)
+
     def initialize_metrics_communication(self) -> None:
         """Create required topic `self.kafka_topic_name` for posting/retrieving
         monitoring metrics. If topic already exists, it reports as a warning
@@ -147,7 +247,9 @@ class Communication_manager:
 
         log.info(f"Creating topic '{self.kafka_topic_name}'")
         my_topic = kafka.admin.NewTopic(
-            name=self.kafka_topic_name, num_partitions=1, replication_factor=1
+            name=self.kafka_topic_name,
+            num_partitions=self.kafka_topic_partitions,
+            replication_factor=1,
         )
         log.debug(f"Object kafka.admin.NewTopic was created: {my_topic}")
         kafka_admin_client = self.connect_admin()
@@ -169,6 +271,67 @@ class Communication_manager:
                 kafka_admin_client.close()
                 log.debug("Connection with KafkaAdminClient was closed")
 
+    def get_partitions(self) -> list[int]:
+        """Partitions of `self.kafka_topic_name`, as known by the producer
+
+        Returns:
+            list[int]: Sorted partitions, or the configured ones if they cannot be
+            retrieved (e.g. Kafka is not available)
+        """
+        try:
+            self.connect_producer()  # Connect if it's not connected
+            return sorted(self.kafka_producer.partitions_for(self.kafka_topic_name))
+        except Exception:
+            log.warning(
+                f"Partitions of topic '{self.kafka_topic_name}' could not be retrieved, assuming {self.kafka_topic_partitions}"
+            )
+            return list(range(self.kafka_topic_partitions))
+
+    def grow_metrics_partitions(self) -> None:
+        """Increase the partitions of the existing topic `self.kafka_topic_name` up to
+        `self.kafka_topic_partitions`. Kafka cannot decrease them, a topic with more
+        partitions is left as it is
+        Note: After growing, part of the URLs are keyed to a different partition, so the
+        order of their samples is only kept within the old and new partitions
+        """
+        self.connect_consumer()
+        try:
+            current_partitions = len(
+                self.kafka_consumer.partitions_for_topic(self.kafka_topic_name) or ()
+            )
+        finally:
+            self.close_consumer()
+        if current_partitions >= self.kafka_topic_partitions:
+            log.info(
+                f"Topic '{self.kafka_topic_name}' has {current_partitions} partitions, nothing to grow"
+            )
+            return
+
+        log.info(
+            f"Growing topic '{self.kafka_topic_name}' from {current_partitions} to {self.kafka_topic_partitions} partitions"
+        )
+        kafka_admin_client = self.connect_admin()
+        try:
+            responses = kafka_admin_client.create_partitions(
+                {
+                    self.kafka_topic_name: kafka.admin.NewPartitions(
+                        total_count=self.kafka_topic_partitions
+                    )
+                }
+            )
+        except Exception:
+            log.exception(
+                f"Partitions of topic '{self.kafka_topic_name}' could not be grown"
+            )
+            raise
+        else:
+            log.info("Partitions created")
+            log.debug(f"kafka_admin_client.create_partitions() responses: {responses}")
+        finally:
+            if kafka_admin_client:
+                kafka_admin_client.close()
+                log.debug("Connection with KafkaAdminClient was closed")
+
     def validate_metrics_communication(self) -> bool:
         """Validate that the Kafka topic is defined
 
@@ -199,83 +362,118 @@ class Communication_manager:
             return result
 
     @staticmethod
-    def serialize_and_encode(message_dict: dict) -> str:
-        """Before sending messages to Kafka, the object needs to be serialized to a string,
-        in our case is serialize to a JSON string; and encoded to utf-8 (Default Python
-        Unicode is not supported by Kafka library)
+    def serialize_and_encode(message_dicts: list[dict], message_format: str) -> bytes:
+        """Before sending messages to Kafka, the objects need to be serialized to bytes,
+        in our case either to a JSON string encoded to utf-8 (one object per message)
+        or to a compact binary message (see `homeworks.wire_format`)
 
         Args:
-            message_dict (dict): Object to send to kafka, which it is going to be
-            processed here
+            message_dicts (list[dict]): Objects to send to kafka in the same message
+            message_format (str): "json" or "binary"
 
         Returns:
-            str: Result after serializing and encoding `message_dict`
+            bytes: Result after serializing and encoding `message_dicts`
         """
-        result = None
-        log.debug(f"Serializing '{message_dict}'")
+        log.debug(f"Serializing '{message_dicts}'")
         try:
-            result = json.dumps(message_dict).encode("utf-8", errors="strict")
-        except TypeError:
-            log.exception(f"JSON could not serialize message '{message_dict}'")
+            result = wire_format.encode_samples(message_dicts, message_format)
+        except (TypeError, ValueError, struct.error):
+            log.exception(f"Messages '{message_dicts}' could not be serialized")
             raise
-        except UnicodeDecodeError:
-            log.exception(f"Message '{message_dict}' could not be encoded to utf-8")
+        except UnicodeEncodeError:
+            log.exception(f"Messages '{message_dicts}' could not be encoded to utf-8")
             raise
         else:
             log.debug(
-                f"Serialized message object (message_dict) to a JSON formatted string and encoded to utf-8"
+                f"Serialized message objects (message_dicts) to {message_format} format"
             )
             return result
 
     @staticmethod
-    def deserialize_and_decode(raw_messages_dict: dict) -> list[str]:
-        """Decodes the messages consumed from Kafka and split them in a list
+    def deserialize_and_decode(raw_messages_dict: dict) -> list[dict]:
+        """Decodes the messages consumed from Kafka and split them in a list. The format
+        of every message (JSON or binary, see `homeworks.wire_format`) is detected
+        on the fly, so that producers can switch format at any time
 
         Args:
             messages (dict): Topic to list of records since the last fetch
             for the subscribed list of topics and partitions.
 
         Returns:
-            list[str]: List of recoded records
+            list[dict]: List of decoded records
         """
         messages_list = []
         for raw_messages in raw_messages_dict.values():
             for raw_message in raw_messages:
                 try:
-                    # Not necessary to decode, json.loads() accepts input encoding utf-8 since v3.6
-                    message = json.loads(raw_message.value)
-                    log.debug(
-                        f"Deserialized bytes message containing a JSON document, result: {message}"
-                    )
-                except json.JSONDecodeError:
+                    messages = wire_format.decode_samples(raw_message.value)
+                    log.debug(f"Deserialized bytes message, result: {messages}")
+                except (ValueError, struct.error):
                     log.exception(
-                        f"JSON could not deserialize message '{raw_message.value}'"
+                        f"Could not deserialize message '{raw_message.value}'"
                     )
                     raise
                 else:
-                    messages_list.append(message)
+                    messages_list.extend(messages)
         return messages_list
 
-    def produce_message(self, message_dict: dict) -> None:
-        """Send a message with metrics from web monitoring to Kafka
-        * Raise exception if message could no be created (No guarantee is made about
-        the completion of message sent)
-        * Message is synchronous (`producer.flush()`) for simplifying the code,
-        since threads sample metrics less often than 5-6 times per minute
-        * Kafka Key is unset, since message doesn't
-        require to be sorted
+    def produce_message(self, message_dict: dict, on_error=None) -> None:
+        """Send a message with metrics from web monitoring to Kafka, without waiting
+        for its delivery (see `send_encoded_message_async()`)
+        * The producer batches and compresses messages in the background, delivered and
+        failed ones are counted in `self.acked_messages` and `self.failed_messages`
+        * Message is keyed by its `web_url`, so that all the samples of a URL go to the
+        same partition and keep their order
+        * Raise exception if message could not be serialized or buffered. For waiting
+        until messages are acknowledged, see `produce_encoded_messages()`
 
         Args:
             message_dict (dict): Metrics from web monitoring
+            on_error (callable, optional): Called as `on_error(encoded_message, exception)`
+            if delivery fails. Defaults to None.
+        """
+        self.send_encoded_message_async(
+            self.serialize_and_encode([message_dict], self.kafka_wire_format),
+            on_error,
+            key=message_dict["web_url"].encode("utf-8"),
+        )
+
+    def produce_encoded_messages(
+        self, encoded_messages: list[bytes], keys: list[bytes] = None
+    ) -> None:
+        """Send a bulk of already encoded messages (see `serialize_and_encode()`) to
+        Kafka, in the given order, and wait until all of them are acknowledged
+        * Messages are keyed by the URL of their (first) sample. Without `keys`, e.g.
+        for messages read back from a spool, it's read from every message, see
+        `wire_format.message_key()`
+        * Raise exception if any message could not be delivered, e.g. Kafka is
+        unreachable, so that the caller can keep them for a later retry
+
+        Args:
+            encoded_messages (list[bytes]): Messages to send
+            keys (list[bytes], optional): Key of every message. Defaults to None.
         """
         self.connect_producer()  # Connect if it's not connected
-        encoded_message = self.serialize_and_encode(message_dict)
-        log.debug(f"Sending message to topic '{self.kafka_topic_name}'")
+        log.debug(
+            f"Sending {len(encoded_messages)} messages to topic '{self.kafka_topic_name}'"
+        )
+        if keys is None:
+            keys = [
+                wire_format.message_key(encoded_message)
+                for encoded_message in encoded_messages
+            ]
         try:
-            response = self.kafka_producer.send(self.kafka_topic_name, encoded_message)
-            log.debug(f"Message sent, response was: {response}")
+            futures = [
+                self.kafka_producer.send(
+                    self.kafka_topic_name, encoded_message, key=key
+                )
+                for encoded_message, key in zip(encoded_messages, keys)
+            ]
             self.kafka_producer.flush(timeout=10.0)
-            log.debug("Message flushed")
+            log.debug("Messages flushed")
+            # flush() doesn't raise on failed deliveries, their futures do
+            for future in futures:
+                future.get(timeout=0)
         except kafka.errors.KafkaTimeoutError:
             log.exception(
                 "Kafka infraestructure setup looks incomplete, e.g. Is our topic defined?"
@@ -287,40 +485,243 @@ class Communication_manager:
             )
             raise
         else:
-            log.info(f"Message sent to Kafka")
+            log.info(f"{len(encoded_messages)} messages sent to Kafka")
+
+    def send_encoded_message_async(
+        self, encoded_message: bytes, on_error=None, key: bytes = None
+    ) -> None:
+        """Send an already encoded message to Kafka without waiting for it: the
+        producer batches messages (`linger_ms`, `batch_size`) and compresses every batch
+        * Message is keyed by the URL of its (first) sample. Without `key`, it's read
+        from the message, see `wire_format.message_key()`
+        * Delivered and failed messages are counted in `self.acked_messages` and
+        `self.failed_messages`
+        * Raise exception if the message cannot even be buffered, e.g. Kafka is
+        unreachable when connecting
+
+        Args:
+            encoded_message (bytes): Message to send
+            on_error (callable, optional): Called as `on_error(encoded_message, exception)`,
+            from the producer thread, if delivery fails (after the producer retries).
+            Defaults to None.
+            key (bytes, optional): Key of the message. Defaults to None.
+        """
+        self.connect_producer()  # Connect if it's not connected
+        if key is None:
+            key = wire_format.message_key(encoded_message)
+        future = self.kafka_producer.send(
+            self.kafka_topic_name, encoded_message, key=key
+        )
+        future.add_callback(self.on_send_success)
+        future.add_errback(self.on_send_error, encoded_message, on_error)
+
+    def on_send_success(self, record_metadata) -> None:
+        """Delivery callback of `send_encoded_message_async()`"""
+        with self.counters_lock:
+            self.acked_messages += 1
+
+    def on_send_error(self, encoded_message: bytes, on_error, exception) -> None:
+        """Delivery error callback of `send_encoded_message_async()`"""
+        with self.counters_lock:
+            self.failed_messages += 1
+        log.warning(
+            f"Producer could not deliver message to Kafka, on topic '{self.kafka_topic_name}': {exception!r}"
+        )
+        if on_error:
+            on_error(encoded_message, exception)
 
     def consume_messages(self) -> list[dict]:
-        """Retrieve messages from Kafka
+        """Retrieve a batch of messages from Kafka
         * Raise exception in case of communication problems
-        * This call will wait _in eternum_ until at least one messsage can be retrieved
+        * The batch is returned once it reaches the target rows, the max. bytes or the
+        max. latency of `self.batch_window`, even if it's empty (no message arrived
+        in time), and its details are kept in `self.last_batch_report`
+        * Rows are samples, not Kafka messages: a binary message holds several samples,
+        and the batch never exceeds the target rows unless its first message alone does
+        * Messages are accumulated in `self.consumed_messages`, so that a rebalance
+        listener can take them (see `take_consumed_messages()`) before giving up
+        their partitions
 
         Returns:
-            list[str]: All retrieved metrics, already decoded to text (utf-8)
+            list[dict]: All retrieved metrics, already decoded
         """
         self.connect_consumer()  # Connect if it's not connected
-        messages_list = []
-        number_retries_without_incoming = 0
+        window = self.batch_window
+        start = time.monotonic()
+        reason = None
+        while reason is None:
+            elapsed_secs = time.monotonic() - start
+            if self.consumed_full:
+                reason = window.ROWS
+            else:
+                reason = window.flush_reason(
+                    len(self.consumed_messages), self.consumed_bytes, elapsed_secs
+                )
+            if reason is None:
+                self.poll_messages(
+                    timeout_ms=int((window.max_latency_secs - elapsed_secs) * 1000),
+                    max_rows=window.target_rows - len(self.consumed_messages),
+                )
 
-        # TODO: Validate that these values are optimal (Load test required for better tuning)
-        while number_retries_without_incoming < 2 and len(messages_list) < 100:
-            # For a limit time, try to retrieve kafka messages (with a max. of 100 messages)
-            log.debug("Checking for new messages")
+        size_bytes = self.consumed_bytes
+        target_rows = window.target_rows
+        if self.consumed_records:
+            self.samples_per_record = (
+                len(self.consumed_messages) / self.consumed_records
+            )
+        messages_list = self.take_consumed_messages()
+        lag = self.get_lag()
+        window.adapt(lag, reason)
+        self.last_batch_report = {
+            "rows": len(messages_list),
+            "bytes": size_bytes,
+            "reason": reason,
+            "target_rows": target_rows,
+            "lag": lag,
+        }
+        log.debug(
+            f"Returning batch {self.last_batch_report} of all received messages: {messages_list}"
+        )
+        return messages_list
+
+    def get_lag(self) -> int:
+        """Kafka only knows the lag in messages, it's converted to rows with the
+        average samples per message of the last batches (`self.samples_per_record`)
+
+        Returns:
+            int: Rows (samples) of the assigned partitions not consumed yet, None if
+            unknown (e.g. no message was fetched yet)
+        """
+        lag = None
+        for topic_partition in self.kafka_consumer.assignment():
+            highwater = self.kafka_consumer.highwater(topic_partition)
+            if highwater is not None:
+                position = self.kafka_consumer.position(topic_partition)
+                lag = (lag or 0) + max(highwater - position, 0)
+        if lag is None:
+            return None
+        return round(lag * self.samples_per_record)
+
+    def poll_messages(self, timeout_ms: int, max_rows: int = None) -> int:
+        """Poll Kafka once, adding the retrieved messages to `self.consumed_messages`
+        * Raise exception in case of communication problems
+        * Messages which would exceed `max_rows` are left in Kafka (the consumer seeks
+        back to them) and `self.consumed_full` is set. The first message of a batch is
+        always taken, so that a message of more than `max_rows` samples can't stall
+        the consumer
+
+        Args:
+            timeout_ms (int): Max. time waiting for messages, in milliseconds
+            max_rows (int, optional): Max. rows (samples) to retrieve. Defaults to
+            `max_poll_records` Kafka messages of the consumer, whatever their samples.
+
+        Returns:
+            int: Number of retrieved rows (0 if none arrived in time)
+        """
+        log.debug("Checking for new messages")
+        try:
+            # Every message has at least one sample
+            responses = self.kafka_consumer.poll(
+                timeout_ms=max(timeout_ms, 0),
+                max_records=max(max_rows, 1) if max_rows else None,
+            )
+        except Exception:
+            log.exception(
+                f"Consumer cannot retrieve message with Kafka, from topic '{self.kafka_topic_name}'"
+            )
+            raise
+        log.debug(f"kafka_consumer.poll() response: {responses}")
+        if not responses:
+            return 0
+        log.debug("Putting together all consumed messages")
+        taken_responses = {}
+        rows = 0
+        for topic_partition, records in responses.items():
+            taken = 0
+            for record in records:
+                samples = wire_format.count_samples(record.value)
+                if (
+                    max_rows is not None
+                    and rows + samples > max_rows
+                    and (rows or self.consumed_messages)
+                ):
+                    self.consumed_full = True
+                if self.consumed_full:
+                    break
+                rows += samples
+                taken += 1
+            if taken < len(records):
+                self.kafka_consumer.seek(topic_partition, records[taken].offset)
+            if taken:
+                taken_responses[topic_partition] = records[:taken]
+        messages = self.deserialize_and_decode(taken_responses)
+        self.consumed_messages.extend(messages)
+        for topic_partition, records in taken_responses.items():
+            self.consumed_offsets[topic_partition] = records[-1].offset + 1
+            self.consumed_bytes += sum(len(record.value) for record in records)
+            self.consumed_records += len(records)
+        return len(messages)
+
+    def take_consumed_messages(self) -> list[dict]:
+        """Their offsets are kept in `self.last_batch_offsets`
+
+        Returns:
+            list[dict]: Messages consumed so far and not returned yet, they are removed
+            from `self.consumed_messages`
+        """
+        messages_list = self.consumed_messages
+        self.consumed_messages = []
+        self.last_batch_offsets = self.consumed_offsets
+        self.consumed_offsets = {}
+        self.consumed_bytes = 0
+        self.consumed_records = 0
+        self.consumed_full = False
+        return messages_list
+
+    def seek_consumer(self, offsets: dict) -> None:
+        """Consume next messages of some partitions from the given offsets
+
+        Args:
+            offsets (dict): Next offset to consume of each partition
+            (kafka.TopicPartition -> int)
+        """
+        for topic_partition, offset in offsets.items():
+            self.kafka_consumer.seek(topic_partition, offset)
+        log.debug(f"Consumer moved to offsets {offsets}")
+
+    def pause_consumer(self) -> None:
+        """Stop fetching from the assigned partitions, while `poll_messages()` keeps
+        the consumer alive in its group (see `resume_consumer()`)
+        """
+        self.kafka_consumer.pause(*self.kafka_consumer.assignment())
+
+    def resume_consumer(self) -> None:
+        """Fetch again from partitions paused by `pause_consumer()`"""
+        self.kafka_consumer.resume(*self.kafka_consumer.paused())
+
+    def commit_consumed_messages(self, offsets: dict = None) -> None:
+        """Commit the offsets of consumed messages, once they are stored, so that the
+        group doesn't deliver them again (no-op without consumer group)
+
+        Args:
+            offsets (dict, optional): Next offset to consume of each partition
+            (kafka.TopicPartition -> int). Defaults to all messages consumed so far.
+        """
+        if self.kafka_consumer and self.kafka_consumer_group:
             try:
-                responses = self.kafka_consumer.poll(timeout_ms=1000)
+                if offsets is None:
+                    self.kafka_consumer.commit()
+                elif offsets:
+                    self.kafka_consumer.commit(
+                        offsets={
+                            topic_partition: kafka.OffsetAndMetadata(offset, "")
+                            for topic_partition, offset in offsets.items()
+                        }
+                    )
             except Exception:
                 log.exception(
-                    f"Consumer cannot retrieve message with Kafka, from topic '{self.kafka_topic_name}'"
+                    f"Consumer cannot commit offsets of topic '{self.kafka_topic_name}'"
                 )
                 raise
             else:
-                log.debug(f"kafka_consumer.poll() response: {responses}")
-                if responses:
-                    log.debug("Putting together all consumed messages")
-                    messages_list.extend(self.deserialize_and_decode(responses))
-                    # Reset counter after getting messages
-                    number_retries_without_incoming = 0
-                else:
-                    number_retries_without_incoming += 1
-
-        log.debug(f"Returning list of all received messages: {messages_list}")
-        return messages_list
+                log.debug("Consumed offsets committed")
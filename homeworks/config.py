@@ -7,8 +7,25 @@ It's important to keep this module free of monitoring logic
 # TODO: Use a more secure storage for secrets (e.g. hashicorp vault), currently security is implemented as read-only access for file-owner on .env
 # TODO: Encrypt password after using them (accessing them with a method) so that they have less chance to appear clear-text, e.g. with system dump
 
+import dataclasses
 import dotenv
+import os
 from . import logging_console
+from .probe_spec import Probe_spec, load_probe_specs
+
+
+def split_into_list(value: str) -> list[str]:
+    """Split a comma-separated setting into a list, ignoring empty items
+
+    Args:
+        value (str): Setting value, e.g. "http://a.com,http://b.com"
+
+    Returns:
+        list[str]: Items of the setting
+    """
+    if not value:
+        return []
+    return [item.strip() for item in value.split(",") if item.strip()]
 
 
 def load_file_into_list(file_path: str) -> list[str]:
@@ -29,20 +46,92 @@ def load_file_into_list(file_path: str) -> list[str]:
     return lines
 
 
+def load_monitored_probe_specs() -> list[Probe_spec]:
+    """Read the specs of our monitoring targets from `monitored_targets_path`, where
+    missing values (and bare URL lines) default to the MONITORING_* settings
+
+    Returns:
+        list[Probe_spec]: Specs of the targets, in file order
+    """
+    defaults = {
+        "interval": float(monitored_url_retry_secs),
+        "timeout": float(monitored_url_timeout_secs),
+        "regex": monitored_url_regex or "",
+    }
+    return [
+        dataclasses.replace(spec, cold_connection=True)
+        if spec.url in monitored_url_cold_targets
+        else spec
+        for spec in load_probe_specs(monitored_targets_path, defaults)
+    ]
+
+
 _dotenv_dict = dotenv.dotenv_values()
 
 db_autocommit = _dotenv_dict["POSTGRES_AUTOCOMMIT"]
+db_compress_after = _dotenv_dict.get("POSTGRES_COMPRESS_AFTER", "7 days")
+db_drop_after = _dotenv_dict.get("POSTGRES_DROP_AFTER", "")
 db_uri = _dotenv_dict["POSTGRES_URI"]
 db_table = _dotenv_dict["POSTGRES_TABLE"]
+db_url_cache_size = _dotenv_dict.get("POSTGRES_URL_CACHE_SIZE", "100000")
 kafka_access_cert = _dotenv_dict["KAFKA_ACCESS_CERTIFICATE"]
 kafka_access_key = _dotenv_dict["KAFKA_ACCESS_KEY"]
 kafka_ca_cert = _dotenv_dict["KAFKA_CA_CERTIFICATE"]
 kafka_uri = _dotenv_dict["KAFKA_SERVICE_URI"]
+kafka_consumer_group = _dotenv_dict.get("KAFKA_CONSUMER_GROUP", "web_health_sink")
+kafka_producer_batch_bytes = _dotenv_dict.get("KAFKA_PRODUCER_BATCH_BYTES", "131072")
+kafka_producer_compression = _dotenv_dict.get("KAFKA_PRODUCER_COMPRESSION", "lz4")
+kafka_producer_linger_ms = _dotenv_dict.get("KAFKA_PRODUCER_LINGER_MS", "50")
+kafka_producer_mode = _dotenv_dict.get("KAFKA_PRODUCER_MODE", "async")
 kafka_topic_name = _dotenv_dict["KAFKA_TOPIC_NAME"]
+kafka_topic_partitions = _dotenv_dict.get("KAFKA_TOPIC_PARTITIONS", "4")
+kafka_wire_format = _dotenv_dict.get("KAFKA_WIRE_FORMAT", "binary")
+monitored_breaker_cooldown_secs = _dotenv_dict.get(
+    "MONITORING_BREAKER_COOLDOWN_SECS", "60"
+)
+monitored_breaker_failures = _dotenv_dict.get("MONITORING_BREAKER_FAILURES", "3")
+monitored_breaker_max_cooldown_secs = _dotenv_dict.get(
+    "MONITORING_BREAKER_MAX_COOLDOWN_SECS", "900"
+)
+monitored_breaker_timeout_secs = _dotenv_dict.get(
+    "MONITORING_BREAKER_TIMEOUT_SECS", "3"
+)
+monitored_dns_cache_secs = _dotenv_dict.get("MONITORING_DNS_CACHE_SECS", "300")
+monitored_keepalive_secs = _dotenv_dict.get("MONITORING_KEEPALIVE_SECS", "120")
 monitored_log_level = _dotenv_dict["MONITORING_LOG_LEVEL"]
-monitored_url_targets = load_file_into_list(_dotenv_dict["MONITORING_TARGETS_PATH"])
+monitored_max_body_bytes = _dotenv_dict.get("MONITORING_MAX_BODY_BYTES", "1048576")
+monitored_max_concurrency = _dotenv_dict.get("MONITORING_MAX_CONCURRENCY", "500")
+monitored_max_connections_per_host = _dotenv_dict.get(
+    "MONITORING_MAX_CONNECTIONS_PER_HOST", "0"
+)
+monitored_max_probes_per_host = _dotenv_dict.get("MONITORING_MAX_PROBES_PER_HOST", "10")
+monitored_publish_queue_size = _dotenv_dict.get(
+    "MONITORING_PUBLISH_QUEUE_SIZE", "10000"
+)
+monitored_spool_max_bytes = _dotenv_dict.get("MONITORING_SPOOL_MAX_BYTES", "268435456")
+monitored_spool_path = _dotenv_dict.get(
+    "MONITORING_SPOOL_PATH",
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "var", "spool"
+    ),
+)
+monitored_spool_retry_secs = _dotenv_dict.get("MONITORING_SPOOL_RETRY_SECS", "10")
+monitored_url_cold_targets = split_into_list(
+    _dotenv_dict.get("MONITORING_COLD_TARGETS", "")
+)
+monitored_targets_path = _dotenv_dict["MONITORING_TARGETS_PATH"]
+monitored_targets_reload_secs = _dotenv_dict.get("MONITORING_TARGETS_RELOAD_SECS", "10")
 monitored_url_regex = _dotenv_dict["MONITORING_TARGETS_REGEX"]
 monitored_url_retry_secs = _dotenv_dict["MONITORING_RETRY_SECS"]
+monitored_url_jitter_ratio = _dotenv_dict.get("MONITORING_JITTER_RATIO", "1.0")
+monitored_url_timeout_secs = _dotenv_dict.get("MONITORING_TIMEOUT_SECS", "15")
+sink_batch_adaptive = _dotenv_dict.get("SINK_BATCH_ADAPTIVE", "True")
+sink_batch_max_bytes = _dotenv_dict.get("SINK_BATCH_MAX_BYTES", "8388608")
+sink_batch_max_latency_ms = _dotenv_dict.get("SINK_BATCH_MAX_LATENCY_MS", "2000")
+sink_batch_max_rows = _dotenv_dict.get("SINK_BATCH_MAX_ROWS", "5000")
+sink_queue_batches = _dotenv_dict.get("SINK_QUEUE_BATCHES", "2")
+monitored_probe_specs = load_monitored_probe_specs()
+monitored_url_targets = [spec.url for spec in monitored_probe_specs]
 
 # Delete temporary variable, it was only needed for initialization
 del _dotenv_dict
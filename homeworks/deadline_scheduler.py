@@ -0,0 +1,114 @@
+"""Min-heap scheduler which fires every monitored URL at its own deadline.
+Next deadline is computed from the previous deadline (not from the end of the
+probe), therefore sampling periods don't drift with response times
+"""
+
+import heapq
+import math
+import random
+import time
+from . import logging_console
+
+log = logging_console.getLogger("homeworks")
+
+
+class Deadline_scheduler:
+    """Keep track of the next deadline of every scheduled key (e.g. an URL)"""
+
+    def __init__(self, jitter_ratio: float = 1.0, clock=time.monotonic) -> None:
+        """Default constructor
+
+        Args:
+            jitter_ratio (float, optional): Fraction of its interval used for randomizing
+            the first deadline of a key, so that keys added together don't fire in bursts.
+            Defaults to 1.0 (start times are spread across a whole interval).
+            clock (callable, optional): Monotonic clock in seconds. Defaults to time.monotonic.
+
+        Properties:
+            heap (list[tuple]): Min-heap of (deadline, sequence, key)
+            entries (dict): For every key, its [interval, deadline, sequence]. Heap items whose
+            sequence doesn't match are stale (lazy deletion) and they are discarded when popped
+        """
+        self.jitter_ratio = jitter_ratio
+        self.clock = clock
+        self.heap = []
+        self.entries = {}
+        self._sequence = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key) -> bool:
+        return key in self.entries
+
+    def _push(self, key, interval: float, deadline: float) -> None:
+        self._sequence += 1
+        self.entries[key] = [interval, deadline, self._sequence]
+        heapq.heappush(self.heap, (deadline, self._sequence, key))
+
+    def add(self, key, interval: float, first_deadline: float = None) -> None:
+        """Schedule `key` every `interval` seconds. If it was already scheduled, its
+        interval and deadline are replaced
+
+        Args:
+            key (hashable): Identifier of the scheduled item
+            interval (float): Seconds between two consecutive deadlines
+            first_deadline (float, optional): Clock value for the first deadline. Defaults to
+            now plus a random offset within `jitter_ratio * interval`
+        """
+        if interval <= 0:
+            raise ValueError(f"Interval for '{key}' must be positive, got {interval}")
+        if first_deadline is None:
+            first_deadline = self.clock() + random.uniform(
+                0, self.jitter_ratio * interval
+            )
+        self._push(key, interval, first_deadline)
+
+    def remove(self, key) -> None:
+        """Stop scheduling `key`, if it is scheduled"""
+        self.entries.pop(key, None)
+
+    def _discard_stale(self) -> None:
+        while self.heap:
+            deadline, sequence, key = self.heap[0]
+            entry = self.entries.get(key)
+            if entry and entry[2] == sequence:
+                break
+            heapq.heappop(self.heap)
+
+    def next_deadline(self) -> float:
+        """Returns:
+        float: Clock value of the earliest deadline or None if nothing is scheduled
+        """
+        self._discard_stale()
+        if self.heap:
+            return self.heap[0][0]
+        return None
+
+    def pop_due(self, now: float = None) -> list[tuple]:
+        """Pop every key whose deadline is already reached and schedule its next deadline.
+        When a key is late by more than one interval, missed deadlines are skipped but
+        the key keeps its phase
+
+        Args:
+            now (float, optional): Current clock value. Defaults to `self.clock()`
+
+        Returns:
+            list[tuple]: List of (key, deadline) which are due
+        """
+        if now is None:
+            now = self.clock()
+        result = []
+        self._discard_stale()
+        while self.heap and self.heap[0][0] <= now:
+            deadline, sequence, key = heapq.heappop(self.heap)
+            interval = self.entries[key][0]
+            result.append((key, deadline))
+            next_deadline = deadline + interval
+            if next_deadline <= now:
+                missed = math.floor((now - deadline) / interval)
+                log.debug(f"'{key}' missed {missed} deadlines, skipping them")
+                next_deadline = deadline + (missed + 1) * interval
+            self._push(key, interval, next_deadline)
+            self._discard_stale()
+        return result
@@ -0,0 +1,231 @@
+"""Local append-only spool on disk, for keeping encoded messages while the
+communication bus (Kafka) is slow or unreachable, and replaying them in order
+once it recovers.
+Spool is a directory of segment files, `<number>.spool`, where every record is a
+4-byte big-endian length followed by the message bytes. Its total size (whole segment
+files, replayed messages of the oldest one included until it's deleted) is bounded:
+when it's exceeded, the oldest segment is dropped
+"""
+
+import os
+import struct
+import threading
+from . import logging_console
+
+log = logging_console.getLogger("homeworks")
+
+_LENGTH = struct.Struct(">I")
+
+
+class Disk_spool:
+    """Segment-based FIFO of byte messages, persisted on disk"""
+
+    def __init__(
+        self, directory: str, max_bytes: int, segment_bytes: int = 8 * 1024 * 1024
+    ) -> None:
+        """Default constructor. It recovers the messages spooled by a previous run
+
+        Args:
+            directory (str): Directory for the segment files, created if it doesn't exist
+            max_bytes (int): Max. size of all segments together
+            segment_bytes (int, optional): Size after which a new segment is started.
+            Defaults to 8 MiB.
+
+        Properties:
+            segments (list[int]): Numbers of the existing segments, oldest first
+            read_position (tuple[int, int]): Segment number and offset of the oldest
+            message not replayed yet, persisted in `read.offset`
+            depth (int): Number of messages waiting in the spool
+            size_bytes (int): Size of all segment files together, see module description
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        self.writer = None
+        self._pending_position = None
+        os.makedirs(self.directory, exist_ok=True)
+        self.segments = sorted(
+            int(file_name[: -len(".spool")])
+            for file_name in os.listdir(self.directory)
+            if file_name.endswith(".spool")
+        )
+        self.read_position = self._load_read_position()
+        self.depth = 0
+        self.size_bytes = 0
+        for segment in self.segments:
+            start = self.read_position[1] if segment == self.read_position[0] else 0
+            records, file_bytes = self._scan_segment(segment, start)
+            self.depth += records
+            self.size_bytes += file_bytes
+        if self.depth:
+            log.warning(
+                f"Spool '{self.directory}' recovered with {self.depth} messages to replay"
+            )
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:012d}.spool")
+
+    def _load_read_position(self) -> tuple:
+        try:
+            with open(os.path.join(self.directory, "read.offset"), "rt") as f:
+                segment, offset = (int(value) for value in f.read().split())
+        except (OSError, ValueError):
+            segment, offset = (self.segments[0] if self.segments else 0), 0
+        if self.segments and segment < self.segments[0]:
+            segment, offset = self.segments[0], 0
+        return (segment, offset)
+
+    def _save_read_position(self) -> None:
+        temp_path = os.path.join(self.directory, "read.offset.tmp")
+        with open(temp_path, "wt") as f:
+            f.write(f"{self.read_position[0]} {self.read_position[1]}")
+        os.replace(temp_path, os.path.join(self.directory, "read.offset"))
+
+    def _scan_segment(self, segment: int, start: int) -> tuple:
+        """Count the complete records of a segment from offset `start`, truncating an
+        incomplete last record (e.g. after a crash while writing it)
+
+        Returns:
+            tuple[int, int]: Number of records from `start` and size in bytes of the
+            whole segment file
+        """
+        path = self._segment_path(segment)
+        records = 0
+        with open(path, "r+b") as f:
+            f.seek(start)
+            offset = start
+            while True:
+                header = f.read(_LENGTH.size)
+                if len(header) < _LENGTH.size:
+                    break
+                (length,) = _LENGTH.unpack(header)
+                if len(f.read(length)) < length:
+                    break
+                offset += _LENGTH.size + length
+                records += 1
+            if offset < os.path.getsize(path):
+                log.warning(f"Truncating incomplete record at the end of '{path}'")
+                f.truncate(offset)
+        return records, os.path.getsize(path)
+
+    def append(self, message: bytes) -> None:
+        """Add a message at the end of the spool. If the spool grows over its max. size,
+        the oldest segment is dropped (and its messages are lost). A new segment is
+        also started when the message doesn't fit in the max. size together with the
+        current one, e.g. when `max_bytes` is smaller than `segment_bytes`
+
+        Args:
+            message (bytes): Encoded message
+        """
+        record_bytes = _LENGTH.size + len(message)
+        with self.lock:
+            if (
+                self.writer is None
+                or self.writer.tell() >= self.segment_bytes
+                or self.writer.tell() + record_bytes > self.max_bytes
+            ):
+                self._start_segment()
+            self.writer.write(_LENGTH.pack(len(message)))
+            self.writer.write(message)
+            self.writer.flush()
+            self.depth += 1
+            self.size_bytes += record_bytes
+            while self.size_bytes > self.max_bytes and len(self.segments) > 1:
+                self._drop_oldest_segment()
+
+    def _start_segment(self) -> None:
+        if self.writer:
+            self.writer.close()
+        segment = self.segments[-1] + 1 if self.segments else self.read_position[0]
+        self.segments.append(segment)
+        self.writer = open(self._segment_path(segment), "ab")
+
+    def _drop_oldest_segment(self) -> None:
+        segment = self.segments.pop(0)
+        start = self.read_position[1] if segment == self.read_position[0] else 0
+        records, file_bytes = self._scan_segment(segment, start)
+        os.remove(self._segment_path(segment))
+        self.depth -= records
+        self.size_bytes -= file_bytes
+        self.read_position = (self.segments[0], 0)
+        if self._pending_position:
+            # A replay is in flight: its messages of later segments must not be
+            # replayed again once it's committed
+            pending_segment, pending_offset, pending_count = self._pending_position
+            if pending_segment > segment:
+                self._pending_position = (
+                    pending_segment,
+                    pending_offset,
+                    pending_count - records,
+                )
+            else:
+                self._pending_position = None
+        self._save_read_position()
+        log.error(
+            f"Spool '{self.directory}' is full ({self.max_bytes} bytes), {records} oldest messages were dropped"
+        )
+
+    def peek(self, max_messages: int) -> list[bytes]:
+        """Read the oldest messages, without removing them from the spool
+        (see `commit()`)
+
+        Args:
+            max_messages (int): Max. number of messages to read
+
+        Returns:
+            list[bytes]: Oldest messages, in the order they were appended
+        """
+        messages = []
+        with self.lock:
+            segment, offset = self.read_position
+            for segment in [s for s in self.segments if s >= self.read_position[0]]:
+                if segment != self.read_position[0]:
+                    offset = 0
+                with open(self._segment_path(segment), "rb") as f:
+                    f.seek(offset)
+                    while len(messages) < max_messages:
+                        header = f.read(_LENGTH.size)
+                        if len(header) < _LENGTH.size:
+                            break
+                        (length,) = _LENGTH.unpack(header)
+                        messages.append(f.read(length))
+                        offset += _LENGTH.size + length
+                if len(messages) >= max_messages:
+                    break
+            self._pending_position = (segment, offset, len(messages))
+        return messages
+
+    def commit(self) -> None:
+        """Remove from the spool the messages returned by last `peek()`, once they were
+        replayed successfully. Fully replayed segments are deleted
+        """
+        with self.lock:
+            if not self._pending_position:
+                return
+            segment, offset, count = self._pending_position
+            self._pending_position = None
+            for old_segment in [s for s in self.segments if s < segment]:
+                self.segments.remove(old_segment)
+                self.size_bytes -= os.path.getsize(self._segment_path(old_segment))
+                os.remove(self._segment_path(old_segment))
+            self.read_position = (segment, offset)
+            self.depth -= count
+            if self.depth == 0:
+                # Everything replayed, start again from a fresh segment
+                if self.writer:
+                    self.writer.close()
+                    self.writer = None
+                for old_segment in self.segments:
+                    os.remove(self._segment_path(old_segment))
+                self.read_position = ((self.segments or [segment])[-1] + 1, 0)
+                self.segments = []
+                self.size_bytes = 0
+            self._save_read_position()
+
+    def close(self) -> None:
+        """Close the segment open for writing"""
+        with self.lock:
+            if self.writer:
+                self.writer.close()
+                self.writer = None
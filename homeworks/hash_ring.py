@@ -0,0 +1,75 @@
+"""Consistent hashing ring for splitting the monitored URLs among agent workers.
+Adding or removing a worker moves only about 1/N of the URLs, so the rest of
+workers keep their URLs (and their warm per-host connections)
+"""
+
+import bisect
+import hashlib
+
+
+class Hash_ring:
+    """Map keys (e.g. URLs) to nodes (e.g. worker names) with consistent hashing"""
+
+    def __init__(self, nodes: list[str] = (), replicas: int = 100) -> None:
+        """Default constructor
+
+        Args:
+            nodes (list[str], optional): Initial nodes of the ring. Defaults to none.
+            replicas (int, optional): Number of virtual nodes per node, the higher the
+            more even the distribution of keys. Defaults to 100.
+
+        Properties:
+            hashes (list[int]): Sorted hashes of all virtual nodes
+            ring (dict[int, str]): Node owning every virtual node hash
+        """
+        self.replicas = replicas
+        self.hashes = []
+        self.ring = {}
+        for node in nodes:
+            self.add_node(node)
+
+    def __len__(self) -> int:
+        return len(self.ring) // self.replicas
+
+    @staticmethod
+    def hash_key(key: str) -> int:
+        """Returns:
+        int: Stable hash of `key`, same value across processes and hosts (unlike hash())
+        """
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+    def add_node(self, node: str) -> None:
+        """Add `node` with its virtual nodes to the ring"""
+        for replica in range(self.replicas):
+            node_hash = self.hash_key(f"{node}#{replica}")
+            if node_hash not in self.ring:
+                bisect.insort(self.hashes, node_hash)
+            self.ring[node_hash] = node
+
+    def remove_node(self, node: str) -> None:
+        """Remove `node` and its virtual nodes from the ring"""
+        for replica in range(self.replicas):
+            node_hash = self.hash_key(f"{node}#{replica}")
+            if self.ring.get(node_hash) == node:
+                del self.ring[node_hash]
+                self.hashes.remove(node_hash)
+
+    def get_node(self, key: str) -> str:
+        """Find which node owns `key`: The first virtual node clockwise from its hash
+
+        Args:
+            key (str): Item to place in the ring, e.g. an URL
+
+        Returns:
+            str: Owner of `key` or None if the ring is empty
+        """
+        if not self.hashes:
+            return None
+        index = bisect.bisect(self.hashes, self.hash_key(key)) % len(self.hashes)
+        return self.ring[self.hashes[index]]
+
+    def get_shard(self, node: str, keys: list[str]) -> list[str]:
+        """Returns:
+        list[str]: Items of `keys` owned by `node`, in their original order
+        """
+        return [key for key in keys if self.get_node(key) == node]
@@ -0,0 +1,266 @@
+"""Background publisher of the agent's samples: probes hand their samples over to
+a bounded in-memory queue and never wait for Kafka. A dedicated thread sends them
+and, while Kafka is slow or unreachable, keeps them in a Disk_spool, which is
+replayed in order (and in bulk) once the producer recovers
+"""
+
+import collections
+import queue
+import threading
+import time
+from . import config
+from . import logging_console
+from .communication_manager import Communication_manager
+from .disk_spool import Disk_spool
+from . import wire_format
+
+log = logging_console.getLogger("homeworks")
+
+
+class Metrics_publisher(threading.Thread):
+    """Thread which publishes samples to Kafka, spooling them on disk on failure"""
+
+    def __init__(
+        self,
+        spool_directory: str,
+        name: str = "Metrics_publisher",
+        metrics_sender: Communication_manager = None,
+    ) -> None:
+        """Default constructor
+
+        Args:
+            spool_directory (str): Directory of the spool (one per agent process)
+            name (str, optional): Name of the thread. Defaults to "Metrics_publisher".
+            metrics_sender (Communication_manager, optional): Object for producing data
+            to Kafka, e.g. a stand-in of Kafka for benchmarks. Defaults to a new
+            Communication_manager.
+
+        Properties:
+            metrics_sender: Object for producing data to Kafka
+            pending (queue.Queue): Samples waiting for being published
+            overflow (collections.deque): Samples published while `pending` was full,
+            which the thread moves to the spool (probes never write to disk)
+            spool (Disk_spool): Samples not delivered to Kafka yet, waiting for a replay
+            retry_secs (float): How often the replay of the spool is tried while Kafka fails
+            replay_batch (int): Max. number of spooled messages sent at once
+            batch_samples (int): Max. number of samples framed in the same binary message
+            asynchronous (bool): Whether messages are sent without waiting for Kafka
+            (KAFKA_PRODUCER_MODE=async), their failed deliveries are spooled by a callback
+            stats_secs (float): How often delivery counters are logged
+            partitions (list[int]): Partitions of the topic, refreshed every `stats_secs`
+            stopping (threading.Event): Set for finishing the thread
+        """
+        super().__init__(name=name, daemon=True)
+        self.metrics_sender = metrics_sender or Communication_manager()
+        self.pending = queue.Queue(int(config.monitored_publish_queue_size))
+        self.overflow = collections.deque()
+        self.spool = Disk_spool(spool_directory, int(config.monitored_spool_max_bytes))
+        self.retry_secs = float(config.monitored_spool_retry_secs)
+        self.replay_batch = 500
+        self.batch_samples = 100
+        self.asynchronous = config.kafka_producer_mode == "async"
+        self.stats_secs = 60.0
+        self.next_stats = time.monotonic() + self.stats_secs
+        self.partitions = list(range(self.metrics_sender.kafka_topic_partitions))
+        self.next_partitions_refresh = 0.0
+        self.stopping = threading.Event()
+        self.next_replay = 0.0
+
+    @property
+    def spool_depth(self) -> int:
+        """Returns:
+        int: Number of messages waiting in the spool for Kafka (a binary message may
+        hold several samples)
+        """
+        return self.spool.depth
+
+    def publish(self, sample: dict) -> None:
+        """Hand a sample over for publishing, without blocking. If the queue is full
+        (Kafka is too slow), the sample is set aside for the spool, which is written
+        by the thread (see `spool_overflow()`)
+
+        Args:
+            sample (dict): Monitored information, it's copied
+        """
+        try:
+            self.pending.put_nowait(dict(sample))
+        except queue.Full:
+            log.warning(
+                f"{self.name}: Queue is full, spooling sample of {sample['web_url']}"
+            )
+            self.overflow.append(dict(sample))
+
+    def spool_overflow(self) -> None:
+        """Append the samples set aside by `publish()` to the spool"""
+        samples = []
+        while self.overflow:
+            samples.append(self.overflow.popleft())
+        for key, encoded_message in self.encode_messages(samples):
+            self.spool.append(encoded_message)
+
+    def encode_messages(self, samples: list[dict]) -> list[tuple[bytes, bytes]]:
+        """Encode samples in the wire format of `self.metrics_sender`: one message per
+        sample in JSON format, or messages of up to `self.batch_samples` samples in
+        binary format, where only samples whose URLs are keyed to the same partition
+        (see `wire_format.get_partition()`) share a message
+
+        Args:
+            samples (list[dict]): Samples to encode, in order
+
+        Returns:
+            list[tuple[bytes, bytes]]: Kafka key (URL of the first sample) and encoded
+            message of every message, samples of the same URL keep their order
+        """
+        message_format = self.metrics_sender.kafka_wire_format
+        if message_format != wire_format.BINARY_FORMAT:
+            return [
+                (
+                    sample["web_url"].encode("utf-8"),
+                    Communication_manager.serialize_and_encode(
+                        [sample], message_format
+                    ),
+                )
+                for sample in samples
+            ]
+        partition_samples = {}
+        for sample in samples:
+            partition = wire_format.get_partition(
+                sample["web_url"].encode("utf-8"), self.partitions
+            )
+            partition_samples.setdefault(partition, []).append(sample)
+        return [
+            (
+                samples[i]["web_url"].encode("utf-8"),
+                Communication_manager.serialize_and_encode(
+                    samples[i : i + self.batch_samples], message_format
+                ),
+            )
+            for samples in partition_samples.values()
+            for i in range(0, len(samples), self.batch_samples)
+        ]
+
+    def send_or_spool(self, keyed_messages: list[tuple[bytes, bytes]]) -> None:
+        """Send samples to Kafka, unless older samples are still spooled (they go
+        first), in which case, or if sending fails, they are appended to the spool
+
+        Args:
+            keyed_messages (list[tuple[bytes, bytes]]): Samples, already encoded with
+            their keys (see `encode_messages()`)
+        """
+        sent_messages = 0
+        if self.spool.depth == 0:
+            try:
+                if self.asynchronous:
+                    for key, encoded_message in keyed_messages:
+                        self.metrics_sender.send_encoded_message_async(
+                            encoded_message, on_error=self.spool_failed_message, key=key
+                        )
+                        sent_messages += 1
+                else:
+                    self.metrics_sender.produce_encoded_messages(
+                        [encoded_message for key, encoded_message in keyed_messages],
+                        keys=[key for key, encoded_message in keyed_messages],
+                    )
+                    sent_messages = len(keyed_messages)
+            except Exception:
+                log.warning(f"{self.name}: Kafka is not available, spooling samples")
+                self.next_replay = time.monotonic() + self.retry_secs
+        for key, encoded_message in keyed_messages[sent_messages:]:
+            self.spool.append(encoded_message)
+
+    def spool_failed_message(
+        self, encoded_message: bytes, exception: Exception
+    ) -> None:
+        """Delivery error callback of the asynchronous mode: Keep the message in the
+        spool, where it's retried by `replay_spool()`
+
+        Args:
+            encoded_message (bytes): Message which could not be delivered
+            exception (Exception): Reason of the failure
+        """
+        self.spool.append(encoded_message)
+        self.next_replay = time.monotonic() + self.retry_secs
+
+    def log_stats(self) -> None:
+        """Log the delivery counters of the asynchronous mode and the spool depth"""
+        log.info(
+            f"{self.name}: {self.metrics_sender.acked_messages} messages acknowledged, {self.metrics_sender.failed_messages} failed, {self.spool.depth} spooled"
+        )
+
+    def replay_spool(self) -> None:
+        """Send the spooled samples to Kafka, oldest first, in batches of
+        `self.replay_batch`, until the spool is empty or Kafka fails again. Every batch
+        is confirmed by Kafka before removing it from the spool, in both modes
+        """
+        while self.spool.depth and not self.stopping.is_set():
+            encoded_messages = self.spool.peek(self.replay_batch)
+            try:
+                self.metrics_sender.produce_encoded_messages(encoded_messages)
+            except Exception:
+                log.warning(
+                    f"{self.name}: Kafka is still not available, {self.spool.depth} messages spooled"
+                )
+                self.next_replay = time.monotonic() + self.retry_secs
+                return
+            self.spool.commit()
+            log.info(
+                f"{self.name}: Replayed {len(encoded_messages)} spooled messages, {self.spool.depth} left"
+            )
+
+    def run(self) -> None:
+        """Main method of this thread: In a continuous loop, publish the queued samples
+        (all the ones waiting, at once) and replay the spool when it's due
+        """
+        while not self.stopping.is_set():
+            self.spool_overflow()
+            if self.spool.depth and time.monotonic() >= self.next_replay:
+                self.replay_spool()
+            if self.asynchronous and time.monotonic() >= self.next_stats:
+                self.log_stats()
+                self.next_stats = time.monotonic() + self.stats_secs
+            try:
+                samples = [self.pending.get(timeout=1.0)]
+            except queue.Empty:
+                continue
+            samples.extend(self.get_pending_samples())
+            self.spool_overflow()
+            if (
+                self.spool.depth == 0
+                and time.monotonic() >= self.next_partitions_refresh
+            ):
+                self.partitions = self.metrics_sender.get_partitions()
+                self.next_partitions_refresh = time.monotonic() + self.stats_secs
+            self.send_or_spool(self.encode_messages(samples))
+
+    def get_pending_samples(self) -> list[dict]:
+        """Returns:
+        list[dict]: All samples in the queue, without waiting for new ones
+        """
+        samples = []
+        while True:
+            try:
+                samples.append(self.pending.get_nowait())
+            except queue.Empty:
+                return samples
+
+    def stop(self) -> None:
+        """Stop the thread and publish the samples left in the queue, at once (they are
+        kept in the spool for the next start if Kafka is not available). Messages
+        buffered by the producer are flushed once, when it's closed
+        """
+        self.stopping.set()
+        if self.is_alive():
+            self.join()
+        samples = self.get_pending_samples()
+        self.spool_overflow()
+        if samples:
+            self.send_or_spool(self.encode_messages(samples))
+        # Failed deliveries are still spooled while closing, so spool is closed after it
+        self.metrics_sender.close_producer()
+        if self.asynchronous:
+            self.log_stats()
+        if self.spool.depth:
+            log.warning(
+                f"{self.name}: {self.spool.depth} messages left in the spool, they will be replayed on next start"
+            )
+        self.spool.close()
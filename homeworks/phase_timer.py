@@ -0,0 +1,104 @@
+"""Collect the duration of every phase of a HTTP request (DNS lookup, connection,
+time to first byte and transfer) through aiohttp request tracing
+"""
+
+import aiohttp
+import time
+
+
+class Phase_timer:
+    """Timestamps of the phases of one HTTP request, in `time.perf_counter()` seconds"""
+
+    def __init__(self) -> None:
+        """Default constructor
+
+        Properties:
+            dns_start, dns_end (float): Host name resolution, None if it was cached
+            connect_start, connect_end (float): New connection (DNS, TCP connect and TLS
+            handshake), None if a pooled connection was reused
+            ready (float): Connection ready for sending the request
+            headers (float): Response headers received
+            body_end (float): Body read (or reading stopped)
+        """
+        self.dns_start = None
+        self.dns_end = None
+        self.connect_start = None
+        self.connect_end = None
+        self.ready = None
+        self.headers = None
+        self.body_end = None
+
+    @staticmethod
+    def elapsed(start: float, end: float) -> float:
+        """Returns:
+        float: Seconds between `start` and `end`, None if any of them is unknown
+        """
+        if start is None or end is None:
+            return None
+        return end - start
+
+    def to_sample(self, sample: dict) -> None:
+        """Store the duration of every phase in `sample`, None for the phases which
+        didn't happen (e.g. DNS and connect for a reused connection)
+        * dns_time: Host name resolution
+        * connect_time: TCP connect plus TLS handshake
+        * ttfb_time: From request sent until response headers are received (server think time)
+        * transfer_time: From response headers until the body is read
+
+        Args:
+            sample (dict): Sample to update
+        """
+        dns_time = self.elapsed(self.dns_start, self.dns_end)
+        connect_time = self.elapsed(self.connect_start, self.connect_end)
+        if connect_time is not None and dns_time is not None:
+            # Host resolution happens while the connection is being created
+            connect_time -= dns_time
+        sample["dns_time"] = dns_time
+        sample["connect_time"] = connect_time
+        sample["ttfb_time"] = self.elapsed(self.ready, self.headers)
+        sample["transfer_time"] = self.elapsed(self.headers, self.body_end)
+
+
+def _now() -> float:
+    return time.perf_counter()
+
+
+async def _on_dns_resolvehost_start(session, context, params) -> None:
+    context.trace_request_ctx.dns_start = _now()
+
+
+async def _on_dns_resolvehost_end(session, context, params) -> None:
+    context.trace_request_ctx.dns_end = _now()
+
+
+async def _on_connection_create_start(session, context, params) -> None:
+    context.trace_request_ctx.connect_start = _now()
+
+
+async def _on_connection_create_end(session, context, params) -> None:
+    context.trace_request_ctx.connect_end = context.trace_request_ctx.ready = _now()
+
+
+async def _on_connection_reuseconn(session, context, params) -> None:
+    context.trace_request_ctx.ready = _now()
+
+
+async def _on_request_end(session, context, params) -> None:
+    context.trace_request_ctx.headers = _now()
+
+
+def create_trace_config() -> aiohttp.TraceConfig:
+    """Create the tracing hooks which fill in the `Phase_timer` passed to every request
+    as `trace_request_ctx`, e.g. `session.get(url, trace_request_ctx=Phase_timer())`
+
+    Returns:
+        aiohttp.TraceConfig: Configuration to pass to `aiohttp.ClientSession`
+    """
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_dns_resolvehost_start.append(_on_dns_resolvehost_start)
+    trace_config.on_dns_resolvehost_end.append(_on_dns_resolvehost_end)
+    trace_config.on_connection_create_start.append(_on_connection_create_start)
+    trace_config.on_connection_create_end.append(_on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(_on_connection_reuseconn)
+    trace_config.on_request_end.append(_on_request_end)
+    return trace_config
@@ -0,0 +1,554 @@
+"""Asynchronous engine for probing the monitored URLs.
+One event loop per process runs all probes concurrently, bounded by a
+configurable concurrency cap, instead of one OS thread per slice of URLs
+(see issue #7). Every URL is fired at its own deadline by a Deadline_scheduler
+"""
+
+import aiohttp
+import asyncio
+import contextlib
+import os
+import re
+import ssl
+import time
+from . import config
+from . import logging_console
+from .circuit_breaker import Circuit_breaker
+from .deadline_scheduler import Deadline_scheduler
+from .metrics_publisher import Metrics_publisher
+from .phase_timer import Phase_timer, create_trace_config
+from .probe_spec import Probe_spec
+from .stream_matcher import Stream_matcher
+from .targets_watcher import Targets_watcher
+
+log = logging_console.getLogger("homeworks")
+
+
+class Probe_engine:
+    """Monitor a list of URLs from a single asyncio event loop"""
+
+    def __init__(
+        self,
+        specs: list[Probe_spec],
+        max_concurrency: int = None,
+        shard_filter=None,
+        name: str = None,
+        metrics_sender=None,
+    ) -> None:
+        """Default constructor
+
+        Args:
+            specs (list[Probe_spec]): Specs of the URLs to monitor by this engine
+            (URL, interval, timeout, method, regex, ...)
+            max_concurrency (int, optional): Max. number of HTTP requests in flight
+            at the same time. Defaults to `config.monitored_max_concurrency`.
+            shard_filter (callable, optional): Function which returns True for the URLs
+            owned by this engine, applied when targets file is reloaded. Defaults to None
+            (all URLs of the file are owned).
+            name (str, optional): Name of this engine, used in logs and as name of its
+            spool directory (under MONITORING_SPOOL_PATH). Defaults to "Probe_engine".
+            metrics_sender (Communication_manager, optional): Object for producing data
+            to Kafka, handed over to the publisher. Defaults to a new Communication_manager.
+
+        Properties:
+            specs (dict[str, Probe_spec]): How to probe every URL, keyed by URL
+            samples (dict[str, dict]): Structure with information to retrive from every
+            HTTP request, keyed by URL
+            publisher (Metrics_publisher): Thread which sends samples to Kafka,
+            created by `run()`
+            max_body_bytes (int): Max. number of body bytes inspected by a regex
+            body_chunk_bytes (int): Size of the chunks in which body is read
+            max_concurrency (int): Max. number of probes running at the same time
+            scheduler (Deadline_scheduler): Deadlines of every URL, keyed by URL
+            probe_tasks (dict[str, asyncio.Task]): Probes in flight, keyed by URL
+            max_connections_per_host (int): Max. number of pooled connections per host (0: no limit)
+            dns_cache_secs (int): How long resolved host names are cached
+            keepalive_secs (float): How long idle connections are kept in the pool
+            ssl_context (ssl.SSLContext): TLS settings shared by all connections of the process
+            reload_secs (float): How often targets file is polled for changes (0: never)
+            targets_watcher (Targets_watcher): Detects changes in targets file
+            targets_changed (asyncio.Event): Wakes up the scheduling loop after a reload
+            max_probes_per_host (int): Max. number of probes in flight per host (0: no limit)
+            host_semaphores (dict[str, asyncio.Semaphore]): Per-host concurrency caps
+            breakers (dict[str, Circuit_breaker]): Health of every host
+            breaker_failures (int): Consecutive failures which open a circuit
+            breaker_cooldown_secs (float): Initial time without probes of an open circuit
+            breaker_max_cooldown_secs (float): Max. time without probes of an open circuit
+            breaker_timeout_secs (float): Shortened timeout of the trial probe of a half-open circuit
+        """
+        self.name = name or self.__class__.__name__
+        self.specs = {spec.url: spec for spec in specs}
+        self.samples = {
+            sample["web_url"]: sample
+            for sample in self.initialize_sampling_data(list(self.specs))
+        }
+        self.publisher = None
+        self.metrics_sender = metrics_sender
+        self.max_body_bytes = int(config.monitored_max_body_bytes)
+        self.body_chunk_bytes = 64 * 1024
+        if max_concurrency is None:
+            max_concurrency = int(config.monitored_max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.scheduler = Deadline_scheduler(float(config.monitored_url_jitter_ratio))
+        self.probe_tasks = {}
+        self.max_connections_per_host = int(config.monitored_max_connections_per_host)
+        self.dns_cache_secs = int(config.monitored_dns_cache_secs)
+        self.keepalive_secs = float(config.monitored_keepalive_secs)
+        # Loading CA certificates is expensive, do it once per process
+        self.ssl_context = ssl.create_default_context()
+        self.shard_filter = shard_filter
+        self.reload_secs = float(config.monitored_targets_reload_secs)
+        self.targets_watcher = Targets_watcher(config.monitored_targets_path)
+        self.targets_changed = None
+        self.max_probes_per_host = int(config.monitored_max_probes_per_host)
+        self.host_semaphores = {}
+        self.breakers = {}
+        self.breaker_failures = int(config.monitored_breaker_failures)
+        self.breaker_cooldown_secs = float(config.monitored_breaker_cooldown_secs)
+        self.breaker_max_cooldown_secs = float(
+            config.monitored_breaker_max_cooldown_secs
+        )
+        self.breaker_timeout_secs = float(config.monitored_breaker_timeout_secs)
+        log.debug(
+            f"{self.name}: Instantiated for {len(self.specs)} URLs, max. concurrency: {self.max_concurrency}"
+        )
+
+    def close(self) -> None:
+        """Stop publishing samples, spooling the ones Kafka didn't get, and close
+        connection with Kafka
+        """
+        if self.publisher:
+            self.publisher.stop()
+            self.publisher = None
+
+    @staticmethod
+    def initialize_sampling_data(urls: list[str]) -> list[dict]:
+        """Initialize sampling data structure with default values
+
+        Args:
+            urls (list[str]): List of URLs to monitor by this engine
+
+        Returns:
+            list[dict]: Structure with our sampling dta, a list of dictionaries
+            where every item is one of the URLs to monitor
+        """
+        return [
+            {
+                "time": None,
+                "web_url": url,
+                "http_status": 0,
+                "resp_time": -1,
+                "regex_match": None,
+                "status_match": None,
+                "sched_delay": None,
+                "body_cap": None,
+                "body_truncated": None,
+                "dns_time": None,
+                "connect_time": None,
+                "ttfb_time": None,
+                "transfer_time": None,
+                "breaker_state": None,
+                "timeout_shortened": None,
+                "skipped_probes": 0,
+            }
+            for url in urls
+        ]
+
+    def create_session(self, cold: bool = False) -> aiohttp.ClientSession:
+        """Create a HTTP client session
+        * By default, its connections are pooled and kept alive per host, and host
+        names are resolved once per `self.dns_cache_secs`
+        * A `cold` session never reuses connections nor cached DNS resolutions
+
+        * Timeout is set by every request, see `Probe_spec.timeout`
+
+        Args:
+            cold (bool, optional): Create a session for one cold probe. Defaults to False.
+
+        Returns:
+            aiohttp.ClientSession: New session, it has to be closed by the caller
+        """
+        if cold:
+            connector = aiohttp.TCPConnector(
+                force_close=True, use_dns_cache=False, ssl=self.ssl_context
+            )
+        else:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_concurrency,
+                limit_per_host=self.max_connections_per_host,
+                ttl_dns_cache=self.dns_cache_secs,
+                keepalive_timeout=self.keepalive_secs,
+                ssl=self.ssl_context,
+            )
+        return aiohttp.ClientSession(
+            connector=connector, trace_configs=[create_trace_config()]
+        )
+
+    async def monitor_one_url(
+        self,
+        session: aiohttp.ClientSession,
+        spec: Probe_spec,
+        sample: dict,
+        timeout: float,
+    ):
+        """Collect the revelant info of the URL in `sample`, including the duration
+        of every phase of the request (see `Phase_timer.to_sample()`), even when
+        the request fails. Results of the previous probe are cleared first, so that a
+        failed request never publishes them again; then `resp_time` is the time until
+        the failure and `status_match` is False when a status is expected
+
+        Args:
+            session (aiohttp.ClientSession): Shared HTTP client session
+            spec (Probe_spec): How to probe the URL
+            sample (dict): Item of `self.samples` to refresh
+            timeout (float): Max. seconds for the request
+        """
+        # fmt: off
+        log.debug(f"{self.name}, {spec.url}: Collecting http metrics")
+        sample["time"] = time.time_ns()
+        sample["http_status"] = 0
+        sample["resp_time"] = -1
+        sample["regex_match"] = None
+        sample["status_match"] = False if spec.expected_status else None
+        sample["body_cap"] = None
+        sample["body_truncated"] = None
+        timer = Phase_timer()
+        start = time.perf_counter()
+        try:
+            async with session.request(
+                spec.method,
+                spec.url,
+                headers=dict(spec.headers),
+                timeout=aiohttp.ClientTimeout(total=timeout),
+                trace_request_ctx=timer,
+            ) as get_request:
+                # Same meaning as requests' `elapsed`: time until the response headers are parsed
+                sample["resp_time"] = time.perf_counter() - start
+                sample["http_status"] = get_request.status
+                if spec.expected_status:
+                    sample["status_match"] = get_request.status in spec.expected_status
+                if spec.regex_pattern:
+                    await self.match_body(get_request, spec.regex_pattern, sample)
+                await self.drain_body(get_request)
+                timer.body_end = time.perf_counter()
+        finally:
+            if sample["resp_time"] < 0:
+                sample["resp_time"] = time.perf_counter() - start
+            timer.to_sample(sample)
+        # fmt: on
+
+    async def match_body(
+        self,
+        get_request: aiohttp.ClientResponse,
+        regex_pattern: re.Pattern,
+        sample: dict,
+    ) -> None:
+        """Look for `regex_pattern` while the body is downloaded, stopping as soon
+        as it matches or `self.max_body_bytes` are read
+
+        Args:
+            get_request (aiohttp.ClientResponse): Response whose body is not read yet
+            regex_pattern (re.Pattern): Regex expresion to look for in http body
+            sample (dict): Item of `self.samples` to refresh
+        """
+        matcher = Stream_matcher(
+            regex_pattern,
+            self.max_body_bytes,
+            encoding=get_request.charset or "utf-8",
+        )
+        async for chunk in get_request.content.iter_chunked(self.body_chunk_bytes):
+            if matcher.feed(chunk):
+                break
+        sample["regex_match"] = matcher.close()
+        sample["body_cap"] = self.max_body_bytes
+        sample["body_truncated"] = matcher.truncated
+
+    async def drain_body(self, get_request: aiohttp.ClientResponse) -> None:
+        """Read the unread rest of the body if it's shorter than `self.body_chunk_bytes`,
+        so that its connection can be reused (cheaper than opening a new connection next
+        time); otherwise the connection is closed instead of downloading the rest
+
+        Args:
+            get_request (aiohttp.ClientResponse): Response whose body may be partially read
+        """
+        drained_bytes = 0
+        while (
+            not get_request.content.at_eof() and drained_bytes < self.body_chunk_bytes
+        ):
+            drained_bytes += len(await get_request.content.readany())
+
+    def get_breaker(self, host: str) -> Circuit_breaker:
+        """Returns:
+        Circuit_breaker: Circuit breaker of `host`, created on first use
+        """
+        breaker = self.breakers.get(host)
+        if breaker is None:
+            breaker = self.breakers[host] = Circuit_breaker(
+                host,
+                self.breaker_failures,
+                self.breaker_cooldown_secs,
+                self.breaker_max_cooldown_secs,
+                clock=self.scheduler.clock,
+            )
+        return breaker
+
+    def get_host_semaphore(self, host: str):
+        """Returns:
+        asyncio.Semaphore: Concurrency cap of `host`, created on first use (a no-op
+        context if there is no per-host limit)
+        """
+        if self.max_probes_per_host <= 0:
+            return contextlib.nullcontext()
+        semaphore = self.host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = self.host_semaphores[host] = asyncio.Semaphore(
+                self.max_probes_per_host
+            )
+        return semaphore
+
+    async def probe(
+        self,
+        session: aiohttp.ClientSession,
+        semaphore: asyncio.Semaphore,
+        spec: Probe_spec,
+        sample: dict,
+        deadline: float,
+    ) -> None:
+        """Probe one URL, without exceeding neither its host cap nor the global
+        concurrency cap, and publish its metrics. Its outcome is reported to the circuit
+        breaker of its host: any HTTP response is a success, while timeouts, connection
+        errors and unexpected errors (e.g. decoding the body) are failures. A trial
+        probe of a half-open circuit which ends without outcome (cancelled) gives its
+        turn to the next deadline, see `Circuit_breaker.cancel_trial()`
+
+        Args:
+            session (aiohttp.ClientSession): Shared HTTP client session
+            semaphore (asyncio.Semaphore): Concurrency cap shared by all probes
+            spec (Probe_spec): How to probe the URL
+            sample (dict): Item of `self.samples` to refresh
+            deadline (float): Scheduler clock value when this probe should have started
+        """
+        breaker = self.get_breaker(spec.host)
+        is_trial = breaker.state == Circuit_breaker.HALF_OPEN
+        outcome_recorded = False
+        try:
+            # Waiting for a busy host must not hold any slot of the global cap
+            async with self.get_host_semaphore(spec.host), semaphore:
+                # How late the probe started, e.g. while waiting for the concurrency cap
+                sample["sched_delay"] = self.scheduler.clock() - deadline
+                timeout = spec.timeout
+                if breaker.state == Circuit_breaker.HALF_OPEN:
+                    timeout = min(timeout, self.breaker_timeout_secs)
+                sample["breaker_state"] = breaker.state
+                sample["timeout_shortened"] = timeout < spec.timeout
+                try:
+                    if spec.cold_connection:
+                        async with self.create_session(cold=True) as cold_session:
+                            await self.monitor_one_url(
+                                cold_session, spec, sample, timeout
+                            )
+                    else:
+                        await self.monitor_one_url(session, spec, sample, timeout)
+                except asyncio.TimeoutError:
+                    log.warning(
+                        f"{self.name}, {spec.url}: {spec.method} request to timeout after {timeout} seconds"
+                    )
+                    sample["http_status"] = 504
+                    breaker.record_failure()
+                except aiohttp.ClientError:
+                    log.exception(
+                        f"{self.name}, {sample['web_url']}: Cannot stablish connection"
+                    )
+                    sample["http_status"] = 503
+                    breaker.record_failure()
+                except Exception:
+                    log.exception(
+                        f"{self.name}, {sample['web_url']}: Probe failed unexpectedly"
+                    )
+                    sample["http_status"] = 500
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                outcome_recorded = True
+        finally:
+            if is_trial and not outcome_recorded:
+                breaker.cancel_trial()
+
+        log.debug(
+            f"{self.name}, {sample['web_url']}: Collected metrics at {sample['time']}"
+        )
+        self.publish_data(sample)
+        sample["skipped_probes"] = 0
+        log.debug(f"{self.name}, {sample['web_url']}: Published metrics")
+
+    def start_probe(
+        self,
+        session: aiohttp.ClientSession,
+        semaphore: asyncio.Semaphore,
+        url: str,
+        deadline: float,
+    ) -> None:
+        """Start the probe of `url` as an independent task, unless its previous probe
+        is still in flight or the circuit breaker of its host doesn't allow it (in
+        both cases, this deadline is skipped; the latter ones are counted in
+        `skipped_probes` of its next sample)
+
+        Args:
+            session (aiohttp.ClientSession): Shared HTTP client session
+            semaphore (asyncio.Semaphore): Concurrency cap shared by all probes
+            url (str): URL to probe
+            deadline (float): Scheduler clock value when this probe should start
+        """
+        if url in self.probe_tasks:
+            log.warning(
+                f"{self.name}, {url}: Previous probe still in flight, skipping this deadline"
+            )
+            return
+        spec = self.specs[url]
+        if not self.get_breaker(spec.host).allow_probe():
+            log.debug(f"{self.name}, {url}: Circuit of its host is open, skipping it")
+            self.samples[url]["skipped_probes"] += 1
+            return
+        task = asyncio.create_task(
+            self.probe(session, semaphore, spec, self.samples[url], deadline)
+        )
+        self.probe_tasks[url] = task
+        task.add_done_callback(lambda task: self.probe_done(url, task))
+
+    def probe_done(self, url: str, task: asyncio.Task) -> None:
+        """Forget a finished probe and report it if it failed unexpectedly
+
+        Args:
+            url (str): URL of the finished probe
+            task (asyncio.Task): Finished probe
+        """
+        self.probe_tasks.pop(url, None)
+        if not task.cancelled() and task.exception():
+            log.error(
+                f"{self.name}, {url}: Probe failed unexpectedly",
+                exc_info=task.exception(),
+            )
+
+    def update_specs(self, specs: list[Probe_spec]) -> None:
+        """Apply a new list of targets to the running engine: Only added, removed and
+        modified URLs are touched, the rest keep their deadlines (and their pooled
+        connections). Probes in flight of removed URLs are allowed to finish.
+        The whole list is validated before touching anything, so an invalid spec
+        leaves the current targets as they are
+
+        Args:
+            specs (list[Probe_spec]): New specs of all URLs (`self.shard_filter` is applied)
+
+        Raises:
+            ValueError: When the interval or timeout of any spec is not positive
+        """
+        new_specs = {
+            spec.url: spec
+            for spec in specs
+            if self.shard_filter is None or self.shard_filter(spec.url)
+        }
+        for spec in new_specs.values():
+            if spec.interval <= 0 or spec.timeout <= 0:
+                raise ValueError(
+                    f"Interval and timeout for '{spec.url}' must be positive, got {spec.interval} and {spec.timeout}"
+                )
+        removed_urls = self.specs.keys() - new_specs.keys()
+        for url in removed_urls:
+            self.scheduler.remove(url)
+            del self.specs[url]
+            del self.samples[url]
+
+        added_urls = []
+        modified_urls = []
+        for url, spec in new_specs.items():
+            old_spec = self.specs.get(url)
+            if old_spec == spec:
+                continue
+            self.specs[url] = spec
+            if old_spec is None:
+                added_urls.append(url)
+                self.samples[url] = self.initialize_sampling_data([url])[0]
+                self.scheduler.add(url, spec.interval)
+            else:
+                modified_urls.append(url)
+                if old_spec.interval != spec.interval:
+                    self.scheduler.add(url, spec.interval)
+
+        log.info(
+            f"{self.name}: Targets reloaded, {len(added_urls)} added, {len(removed_urls)} removed and {len(modified_urls)} modified"
+        )
+        log.debug(
+            f"{self.name}: Added: {added_urls}, removed: {sorted(removed_urls)}, modified: {modified_urls}"
+        )
+        if self.targets_changed:
+            self.targets_changed.set()
+
+    async def watch_targets(self) -> None:
+        """In a continuous loop, poll targets file and reload it when it changes.
+        If the new file is not valid, current targets are kept
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.reload_secs)
+            if not self.targets_watcher.has_changed():
+                continue
+            log.info(f"{self.name}: Targets file changed, reloading it")
+            try:
+                specs = await loop.run_in_executor(
+                    None, config.load_monitored_probe_specs
+                )
+                self.update_specs(specs)
+            except (IOError, ValueError):
+                log.exception(f"{self.name}: Keeping current targets")
+
+    async def run_async(self) -> None:
+        """Main coroutine of this class: Fire every URL at its own deadline"""
+        log.info(f"{self.name}: Starting monitoring")
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.targets_changed = asyncio.Event()
+        for spec in self.specs.values():
+            self.scheduler.add(spec.url, spec.interval)
+        watcher_task = None
+        if self.reload_secs > 0:
+            watcher_task = asyncio.create_task(self.watch_targets())
+
+        try:
+            async with self.create_session() as session:
+                while True:
+                    next_deadline = self.scheduler.next_deadline()
+                    if next_deadline is None:
+                        delay = float(config.monitored_url_retry_secs)
+                    else:
+                        delay = next_deadline - self.scheduler.clock()
+                    if delay > 0:
+                        # A reload may bring earlier deadlines, it wakes us up
+                        try:
+                            await asyncio.wait_for(self.targets_changed.wait(), delay)
+                        except asyncio.TimeoutError:
+                            pass
+                        self.targets_changed.clear()
+                    for url, deadline in self.scheduler.pop_due():
+                        self.start_probe(session, semaphore, url, deadline)
+        finally:
+            if watcher_task:
+                watcher_task.cancel()
+
+    def run(self) -> None:
+        """Run the engine until it is interrupted"""
+        self.publisher = Metrics_publisher(
+            os.path.join(config.monitored_spool_path, self.name),
+            name=f"{self.name}-publisher",
+            metrics_sender=self.metrics_sender,
+        )
+        self.publisher.start()
+        try:
+            asyncio.run(self.run_async())
+        finally:
+            self.close()
+
+    def publish_data(self, sample: dict) -> None:
+        """Monitored information is handed over to `self.publisher`, which sends it
+        to Kafka from its own thread: probes never wait for Kafka, even when it's slow
+        or unreachable (samples are spooled on disk meanwhile)
+        """
+        self.publisher.publish(sample)
@@ -0,0 +1,177 @@
+"""Specifications of the monitoring targets: what to probe and how.
+Targets file (MONITORING_TARGETS_PATH) is read line by line, where every line is either:
+* A bare URL, e.g. `http://gmail.com`, probed with the global settings (.env)
+* A JSON object (JSON lines), e.g.
+  `{"url": "http://gmail.com", "interval": 30, "timeout": 5, "method": "HEAD",
+  "expected_status": [200, 302], "headers": {"Accept": "text/html"}, "regex": "Gmail",
+  "cold_connection": false}`, where only "url" is mandatory and the rest of keys
+  default to the global settings
+Empty lines and lines starting with '#' are ignored
+"""
+
+import dataclasses
+import functools
+import json
+import re
+import urllib.parse
+
+
+@functools.lru_cache(maxsize=None)
+def compile_pattern(regex: str) -> re.Pattern:
+    """Compile `regex` once, identical expressions share the same compiled pattern
+
+    Args:
+        regex (str): Regex expression to look for in http body
+
+    Returns:
+        re.Pattern: Compiled pattern (multiline mode)
+    """
+    return re.compile(regex, re.MULTILINE)
+
+
+@dataclasses.dataclass(frozen=True)
+class Probe_spec:
+    """How to probe one URL. It's immutable and hashable, so that two versions of the
+    targets file can be compared spec by spec
+
+    Properties:
+        url (str): URL to probe
+        interval (float): Seconds between two consecutive probes
+        timeout (float): Max. seconds for a probe
+        method (str): HTTP method, e.g. "GET" or "HEAD"
+        expected_status (tuple[int]): HTTP status codes considered as healthy, empty if
+        any status is accepted
+        headers (tuple[tuple[str, str]]): Extra HTTP request headers
+        regex (str): Regex expression to look for in http body, empty for no lookup
+        cold_connection (bool): Always probe with a new connection
+    """
+
+    url: str
+    interval: float
+    timeout: float
+    method: str = "GET"
+    expected_status: tuple = ()
+    headers: tuple = ()
+    regex: str = ""
+    cold_connection: bool = False
+
+    @property
+    def host(self) -> str:
+        """Host (and port) of `url`, used for per-host limits and circuit breakers"""
+        return urllib.parse.urlsplit(self.url).netloc.lower() or self.url
+
+    @property
+    def regex_pattern(self) -> re.Pattern:
+        """Compiled `regex` (shared by all specs with the same expression) or None"""
+        if self.regex:
+            return compile_pattern(self.regex)
+        return None
+
+
+def parse_probe_spec(line: str, defaults: dict) -> Probe_spec:
+    """Build the spec of one line of the targets file
+
+    Args:
+        line (str): A bare URL or a JSON object
+        defaults (dict): Values for the keys missing in `line`, at least
+        "interval" and "timeout"
+
+    Returns:
+        Probe_spec: Specification of the target
+
+    Raises:
+        ValueError: When a key is unknown or a value is not valid, e.g. a
+        non-positive interval or timeout
+    """
+    if not line.startswith("{"):
+        return validate_probe_spec(Probe_spec(**{**defaults, "url": line}))
+
+    values = json.loads(line)
+    unknown_keys = set(values) - {
+        field.name for field in dataclasses.fields(Probe_spec)
+    }
+    if unknown_keys:
+        raise ValueError(f"Unknown keys {sorted(unknown_keys)} in target '{line}'")
+    if "url" not in values:
+        raise ValueError(f"Target '{line}' has no 'url'")
+    field_defaults = {
+        field.name: field.default
+        for field in dataclasses.fields(Probe_spec)
+        if field.default is not dataclasses.MISSING
+    }
+    values = {**field_defaults, **defaults, **values}
+    values["method"] = values["method"].upper()
+    values["interval"] = float(values["interval"])
+    values["timeout"] = float(values["timeout"])
+    expected_status = values["expected_status"]
+    if is_status_code(expected_status):
+        expected_status = [expected_status]
+    if not isinstance(expected_status, (list, tuple)) or not all(
+        is_status_code(status) for status in expected_status
+    ):
+        raise ValueError(
+            f"'expected_status' must be an integer or a list of integers, got {expected_status!r}"
+        )
+    values["expected_status"] = tuple(expected_status)
+    headers = values["headers"]
+    if isinstance(headers, dict):
+        headers = headers.items()
+    values["headers"] = tuple((str(key), str(value)) for key, value in headers)
+    return validate_probe_spec(Probe_spec(**values))
+
+
+def is_status_code(value) -> bool:
+    """Returns:
+    bool: True if `value` is an integer, JSON booleans are not accepted as integers
+    """
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def validate_probe_spec(spec: Probe_spec) -> Probe_spec:
+    """Check the values which would break the scheduling of `spec`
+
+    Args:
+        spec (Probe_spec): Spec to check
+
+    Raises:
+        ValueError: When its interval or timeout is not positive
+
+    Returns:
+        Probe_spec: The same `spec`
+    """
+    if spec.interval <= 0:
+        raise ValueError(f"'interval' must be positive, got {spec.interval}")
+    if spec.timeout <= 0:
+        raise ValueError(f"'timeout' must be positive, got {spec.timeout}")
+    return spec
+
+
+def load_probe_specs(file_path: str, defaults: dict) -> list[Probe_spec]:
+    """Read the specs of all monitoring targets from the targets file.
+    When an URL is listed more than once, its first spec is kept
+
+    Args:
+        file_path (str): Full path to the targets file
+        defaults (dict): Values for the keys missing in every line, see `parse_probe_spec()`
+
+    Returns:
+        list[Probe_spec]: Specs of the targets, in file order
+    """
+    specs = {}
+    try:
+        with open(file_path, "rt") as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                try:
+                    spec = parse_probe_spec(line, defaults)
+                    spec.regex_pattern  # Fail early with invalid expressions
+                except (ValueError, TypeError, re.error) as e:
+                    raise ValueError(
+                        f"Invalid target in '{file_path}', line {line_number}: {e}"
+                    ) from e
+                specs.setdefault(spec.url, spec)
+    except IOError:
+        raise IOError(f"Could not read config file '{file_path}'")
+    return list(specs.values())
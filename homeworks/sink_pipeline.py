@@ -0,0 +1,325 @@
+"""Pipeline of the sink: a consumer thread polls and decodes batches of messages from
+Kafka, while the writer (the calling thread) stores the previous ones in Postgres.
+Batches are handed over through a bounded queue (by default 2 batches, i.e. double
+buffering), so when the DB falls behind, the consumer stops fetching from Kafka instead
+of piling up messages in memory
+
+Every batch is stored together with the Kafka offsets after it, in the same
+transaction, and partitions are consumed from those stored offsets when they are
+assigned to this sink, so that messages are stored exactly once, even after restarts
+and rebalances. Offsets are also committed to Kafka once their batch is stored, always
+by the consumer thread, since KafkaConsumer is not thread-safe
+"""
+
+import collections
+import kafka
+import queue
+import threading
+import time
+from . import config
+from . import logging_console
+
+log = logging_console.getLogger("homeworks")
+
+
+class Batch_flusher(kafka.ConsumerRebalanceListener):
+    """Store the in-flight batches of messages and commit their offsets before the
+    consumer group takes partitions away from this sink, so that its new owner
+    neither loses nor repeats them
+    """
+
+    def __init__(self, pipeline) -> None:
+        """Default constructor
+
+        Args:
+            pipeline (Sink_pipeline): Pipeline whose consumer gets the partitions
+        """
+        self.pipeline = pipeline
+
+    def on_partitions_revoked(self, revoked) -> None:
+        if not revoked:
+            return
+        log.info(
+            f"Partitions {sorted(partition.partition for partition in revoked)} revoked, storing in-flight messages"
+        )
+        self.pipeline.flush_in_flight()
+
+    def on_partitions_assigned(self, assigned) -> None:
+        log.info(
+            f"Partitions {sorted(partition.partition for partition in assigned)} assigned"
+        )
+        if assigned:
+            self.pipeline.seek_to_stored_offsets(assigned)
+
+
+class Sink_pipeline:
+    """Overlap Kafka polling with Postgres writes (see module description)"""
+
+    # Methods of Store_manager which store a batch, by name of insert method
+    insert_methods = {"batch": "insert_metrics_batch", "copy": "insert_metrics_copy"}
+
+    def __init__(
+        self,
+        metrics_retriever: None,
+        metrics_inserter: None,
+        queue_batches: int = None,
+        insert_method: str = "batch",
+    ) -> None:
+        """Default constructor
+
+        Args:
+            metrics_retriever (Communication_manager): Manages Kafka communication
+            metrics_inserter (Store_manager): Manages PostgresSQL storage
+            queue_batches (int, optional): Max. batches consumed but not stored yet.
+            Defaults to SINK_QUEUE_BATCHES.
+            insert_method (str, optional): How batches are stored, "batch"
+            (`Store_manager.insert_metrics_batch()`) or "copy"
+            (`Store_manager.insert_metrics_copy()`). Defaults to "batch".
+
+        Properties:
+            insert_metrics (callable): Method of `metrics_inserter` storing a batch
+            store_lock (threading.Lock): Serializes the use of the DB connection
+            batches (queue.Queue): Batches consumed and not stored yet, as tuples of
+            messages and their offsets
+            consumer (threading.Thread): Thread polling Kafka, see `run_consumer()`
+            consumer_error (Exception): Error which stopped the consumer thread
+            pending_batch (tuple): Batch waiting for room in `batches`
+            written (threading.Condition): Guards `written_offsets` and the counters of
+            batches, notified every time a batch is stored
+            written_offsets (dict): Offsets of the stored batches, not committed yet
+            queued_batches (int): Batches put in `batches`
+            written_batches (int): Batches stored
+            stopping (threading.Event): Set once the pipeline is stopping
+            stats (dict): Counters and accumulated seconds of every stage, see
+            `get_stats()`
+            stats_secs (int): Period of the statistics in the log
+        """
+        self.metrics_retriever = metrics_retriever
+        self.metrics_inserter = metrics_inserter
+        self.insert_metrics = getattr(
+            metrics_inserter, self.insert_methods[insert_method]
+        )
+        self.store_lock = threading.Lock()
+        self.batches = queue.Queue(int(queue_batches or config.sink_queue_batches))
+        self.consumer = threading.Thread(
+            target=self.run_consumer, name="Sink_consumer", daemon=True
+        )
+        self.consumer_error = None
+        self.pending_batch = None
+        self.written = threading.Condition()
+        self.written_offsets = {}
+        self.queued_batches = 0
+        self.written_batches = 0
+        self.stopping = threading.Event()
+        self.stats = {
+            "messages": 0,
+            "consume_secs": 0.0,
+            "backpressure_secs": 0.0,
+            "insert_secs": 0.0,
+            "flush_reasons": collections.Counter(),
+            "last_batch": {},
+        }
+        self.stats_secs = 60
+        self.next_stats = time.monotonic() + self.stats_secs
+
+    def run(self) -> None:
+        """Start the consumer thread and store its batches until it fails or this
+        thread is interrupted (e.g. Ctrl+Break)
+        """
+        self.consumer.start()
+        try:
+            while True:
+                try:
+                    batch = self.batches.get(timeout=1.0)
+                except queue.Empty:
+                    if not self.consumer.is_alive():
+                        raise RuntimeError(
+                            "Consumer thread stopped"
+                        ) from self.consumer_error
+                else:
+                    self.write_batch(*batch)
+                if time.monotonic() >= self.next_stats:
+                    self.log_stats()
+        finally:
+            self.stop()
+
+    def write_batch(self, messages: list[dict], offsets: dict) -> None:
+        """Store a batch with its offsets, and record them for the consumer thread to
+        commit them to Kafka
+
+        Args:
+            messages (list[dict]): Decoded messages
+            offsets (dict): Next offset of every partition, after `messages`
+        """
+        start = time.perf_counter()
+        with self.store_lock:
+            self.insert_metrics(messages, offsets)
+        insert_secs = time.perf_counter() - start
+        with self.written:
+            for topic_partition, offset in offsets.items():
+                self.written_offsets[topic_partition] = max(
+                    offset, self.written_offsets.get(topic_partition, 0)
+                )
+            self.written_batches += 1
+            self.stats["messages"] += len(messages)
+            self.stats["insert_secs"] += insert_secs
+            self.written.notify_all()
+        log.debug(
+            f"Stored {len(messages)} messages in {insert_secs:.3f}s, queue depth: {self.batches.qsize()}"
+        )
+
+    def run_consumer(self) -> None:
+        """Body of the consumer thread: poll batches, queue them and commit the
+        offsets of the stored ones
+        """
+        try:
+            self.metrics_retriever.connect_consumer(
+                rebalance_listener=Batch_flusher(self)
+            )
+            while not self.stopping.is_set():
+                start = time.perf_counter()
+                messages = self.metrics_retriever.consume_messages()
+                self.stats["consume_secs"] += time.perf_counter() - start
+                report = self.metrics_retriever.last_batch_report
+                self.stats["flush_reasons"][report["reason"]] += 1
+                self.stats["last_batch"] = report
+                if messages:
+                    self.put_batch(
+                        (messages, self.metrics_retriever.last_batch_offsets)
+                    )
+                self.commit_written_offsets()
+        except Exception as error:
+            self.consumer_error = error
+            if not self.stopping.is_set():
+                log.exception("Consumer thread stopped by an unexpected error")
+
+    def put_batch(self, batch: tuple) -> None:
+        """Queue a batch. While the queue is full (the DB falls behind), fetching is
+        paused, but Kafka is still polled so that the consumer keeps its partitions
+
+        Args:
+            batch (tuple): Messages and their offsets
+        """
+        start = time.perf_counter()
+        self.pending_batch = batch
+        paused = False
+        while self.pending_batch is not None and not self.stopping.is_set():
+            try:
+                # Pause as soon as the queue is full, then wait for room
+                self.batches.put(self.pending_batch, block=paused, timeout=1.0)
+            except queue.Full:
+                if not paused:
+                    log.debug("Queue of batches is full, pausing consumption")
+                    self.metrics_retriever.pause_consumer()
+                    paused = True
+                # A rebalance listener may queue the pending batch meanwhile
+                self.metrics_retriever.poll_messages(timeout_ms=0)
+            else:
+                self.pending_batch = None
+                self.queued_batches += 1
+        if paused:
+            self.metrics_retriever.resume_consumer()
+        self.stats["backpressure_secs"] += time.perf_counter() - start
+
+    def put_batch_blocking(self, batch: tuple) -> None:
+        """Queue a batch without polling Kafka, e.g. from a rebalance listener
+
+        Args:
+            batch (tuple): Messages and their offsets
+        """
+        while not self.stopping.is_set():
+            try:
+                self.batches.put(batch, timeout=1.0)
+            except queue.Full:
+                continue
+            else:
+                self.queued_batches += 1
+                return
+
+    def flush_in_flight(self) -> None:
+        """Queue all consumed messages, wait until they are stored and commit their
+        offsets (called by `Batch_flusher`, in the consumer thread)
+        """
+        if self.pending_batch is not None:
+            self.put_batch_blocking(self.pending_batch)
+            self.pending_batch = None
+        messages = self.metrics_retriever.take_consumed_messages()
+        if messages:
+            self.put_batch_blocking(
+                (messages, self.metrics_retriever.last_batch_offsets)
+            )
+        with self.written:
+            while (
+                self.written_batches < self.queued_batches
+                and not self.stopping.is_set()
+            ):
+                self.written.wait(1.0)
+        self.commit_written_offsets()
+
+    def seek_to_stored_offsets(self, assigned) -> None:
+        """Consume assigned partitions from the offsets stored with their messages
+        (called by `Batch_flusher`, in the consumer thread). Partitions without stored
+        offsets are consumed from their committed offsets
+
+        Args:
+            assigned (set[kafka.TopicPartition]): Partitions assigned to this sink
+        """
+        with self.store_lock:
+            stored_offsets = self.metrics_inserter.get_stored_offsets(
+                self.metrics_retriever.kafka_topic_name
+            )
+        offsets = {
+            topic_partition: stored_offsets[topic_partition.partition]
+            for topic_partition in assigned
+            if topic_partition.partition in stored_offsets
+        }
+        log.info(
+            f"Consuming partitions {sorted(topic_partition.partition for topic_partition in offsets)} from their stored offsets"
+        )
+        self.metrics_retriever.seek_consumer(offsets)
+
+    def commit_written_offsets(self) -> None:
+        """Commit the offsets of the batches stored so far"""
+        with self.written:
+            offsets = self.written_offsets
+            self.written_offsets = {}
+        self.metrics_retriever.commit_consumed_messages(offsets)
+
+    def get_stats(self) -> dict:
+        """Returns:
+        dict: Queue depth, number of stored batches and messages, accumulated
+        seconds consuming (polling and decoding), waiting for room in the queue
+        (backpressure) and inserting, number of batches by flush reason and report of
+        the last consumed batch (see `Communication_manager.last_batch_report`)
+        """
+        with self.written:
+            return {
+                "queue_depth": self.batches.qsize(),
+                "batches": self.written_batches,
+                **self.stats,
+            }
+
+    def log_stats(self) -> None:
+        """Log the statistics of the pipeline, see `get_stats()`"""
+        self.next_stats = time.monotonic() + self.stats_secs
+        stats = self.get_stats()
+        log.info(
+            f"Sink pipeline: queue depth {stats['queue_depth']}, {stats['batches']} batches ({stats['messages']} messages) stored, consume {stats['consume_secs']:.1f}s, backpressure {stats['backpressure_secs']:.1f}s, insert {stats['insert_secs']:.1f}s, flush reasons {dict(stats['flush_reasons'])}, last batch {stats['last_batch']}"
+        )
+
+    def stop(self) -> None:
+        """Stop the consumer thread and commit the offsets of the stored batches.
+        Batches still queued are not stored, they will be consumed again
+        """
+        self.stopping.set()
+        if self.consumer.is_alive():
+            self.consumer.join()
+        try:
+            self.commit_written_offsets()
+        except Exception:
+            log.warning("Offsets of the stored batches could not be committed")
+        if not self.batches.empty():
+            log.info(
+                f"{self.batches.qsize()} batches not stored, they will be consumed again"
+            )
+        self.log_stats()
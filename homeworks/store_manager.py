@@ -1,15 +1,136 @@
+import collections
+import contextlib
+import datetime
+import io
 import psycopg2
+import struct
 from psycopg2 import extras
 from . import config
 from . import logging_console
+from dateutil import parser
 
 
 log = logging_console.getLogger("homeworks")
 
+# PostgreSQL binary COPY format, see https://www.postgresql.org/docs/current/sql-copy.html
+_COPY_HEADER = b"PGCOPY\n\377\r\n\0" + struct.pack(">ii", 0, 0)
+_COPY_TRAILER = struct.pack(">h", -1)
+# Field count, time (timestamptz) and url_id (integer)
+_COPY_ROW_START = struct.Struct(">hiqii")
+# http_status (smallint) and resp_time (double precision)
+_COPY_ROW_STATUS = struct.Struct(">ihid")
+_COPY_FLOAT8 = struct.Struct(">id")
+_COPY_NULL = struct.pack(">i", -1)
+_COPY_BOOLS = {True: struct.pack(">i?", 1, True), False: struct.pack(">i?", 1, False)}
+# Timestamps are sent as microseconds since 2000-01-01 UTC
+_PG_EPOCH = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def to_pg_timestamp(metric_time) -> int:
+    """Convert the "time" of a metric to a binary COPY timestamptz
+
+    Args:
+        metric_time (datetime.datetime | str): Time of the metric, as decoded from the binary
+        (datetime.datetime) or JSON (ISO 8601 string) wire formats. Times without
+        TimeZone are taken as UTC
+
+    Returns:
+        int: Microseconds since 2000-01-01 UTC
+    """
+    if isinstance(metric_time, str):
+        metric_time = parser.isoparse(metric_time)
+    if metric_time.tzinfo is None:
+        metric_time = metric_time.replace(tzinfo=datetime.timezone.utc)
+    return (metric_time - _PG_EPOCH) // _MICROSECOND
+
+
+def select_latest_metrics(metrics: list[dict]) -> dict[str, dict]:
+    """Args:
+        metrics (list[dict]): List of web metrics
+
+    Returns:
+        dict[str, dict]: Most recent metric of every web_url of `metrics` (the last one
+        received, among the ones with the same time)
+    """
+    result = {}
+    latest_times = {}
+    for metric in metrics:
+        url = metric["web_url"]
+        metric_time = to_pg_timestamp(metric["time"])
+        if url not in result or metric_time >= latest_times[url]:
+            result[url] = metric
+            latest_times[url] = metric_time
+    return result
+
+
+def estimate_percentile(
+    histogram: list[int], quantile: float, lower: float, upper: float
+) -> float:
+    """Estimate a percentile from a TimescaleDB histogram, interpolating linearly within
+    its bucket
+
+    Args:
+        histogram (list[int]): Result of `histogram(value, lower, upper, n)`: n buckets
+        of the same width, preceded by the values below `lower` and followed by the
+        values above `upper`
+        quantile (float): Percentile to estimate, between 0 and 1 (e.g. 0.95)
+        lower (float): Lower bound of the histogram
+        upper (float): Upper bound of the histogram
+
+    Returns:
+        float: Estimated percentile (`lower` or `upper` when it falls out of bounds),
+        None for an empty histogram
+    """
+    total = sum(histogram)
+    if not total:
+        return None
+    rank = quantile * total
+    width = (upper - lower) / (len(histogram) - 2)
+    cumulative = 0
+    for index, count in enumerate(histogram):
+        if count and cumulative + count >= rank:
+            if index == 0:
+                return lower
+            if index == len(histogram) - 1:
+                return upper
+            return lower + width * (index - 1 + (rank - cumulative) / count)
+        cumulative += count
+    return upper
+
 
 class Store_manager:
     """Implement the methods for storing the metrics collected by the monitoring application"""
 
+    # Columns of `db_table`, in the same order as they are defined
+    metric_columns = (
+        "time",
+        "url_id",
+        "http_status",
+        "resp_time",
+        "regex_match",
+        "dns_time",
+        "connect_time",
+        "ttfb_time",
+        "transfer_time",
+    )
+    # Phase timings are nullable, they are added to tables created by older versions
+    metric_phase_columns = ("dns_time", "connect_time", "ttfb_time", "transfer_time")
+    # Continuous aggregates (rollups) per url_id of `db_table`: suffix of their view,
+    # time bucket, and start offset, end offset and schedule of their refresh policy
+    rollups = (
+        ("1m", "1 minute", "1 hour", "1 minute", "1 minute"),
+        ("1h", "1 hour", "3 days", "1 hour", "1 hour"),
+    )
+    # Buckets of the histograms of resp_time in rollups, from which percentiles are
+    # estimated (continuous aggregates don't support ordered-set aggregates, like
+    # percentile_cont): lower and upper bound (seconds) and number of buckets
+    rollup_histogram = (0.0, 10.0, 100)
+    # Percentiles of resp_time reported by `query_url_stats()`
+    query_percentiles = (0.5, 0.95, 0.99)
+    # Rows fetched from the server at once by the cursors of queries
+    query_itersize = 2000
+
     def __init__(self) -> None:
         """Default constructor
 
@@ -17,15 +138,38 @@ class Store_manager:
             db_connect = DB connection
             db_autocommit (bool) = If True, no transaction is handled by the driver and every statement sent to the backend has immediate effect
             db_table (str): Name of the DB hypertable where metrics will be stored
+            db_offsets_table (str): Name of the DB table with the next Kafka offset of
+            every partition, written in the same transaction as the metrics
+            db_urls_table (str): Name of the DB table of monitored URLs, whose integer
+            url_id is stored in `db_table` instead of the whole web_url
+            db_wide_view (str): Name of the DB view of `db_table` with the web_url of
+            every metric, for readers
+            db_latest_table (str): Name of the DB table with the most recent metric of
+            every URL, updated together with every batch
+            url_ids (collections.OrderedDict): Cache of the url_id of every web_url, in
+            least recently used order
+            url_cache_size (int): Max. URLs in `url_ids`
             hypertable_number_partitions (int, optional): Number of partitions for `db_table` . Defaults to 4.
             hypertable_chunk_time_interval (str, optional): How long in time will chunk metrics data. Defaults to "1 week".
+            hypertable_compress_after (str): Age (interval) of the chunks compressed by
+            the compression policy, empty for no compression policy
+            hypertable_drop_after (str): Age (interval) of the chunks dropped by the
+            retention policy, empty for keeping metrics forever
         """
         self.db_connect = None
         self.db_autocommit = config.db_autocommit
         self.db_table = config.db_table
+        self.db_offsets_table = f"{config.db_table}_offsets"
+        self.db_urls_table = f"{config.db_table}_urls"
+        self.db_wide_view = f"{config.db_table}_wide"
+        self.db_latest_table = f"{config.db_table}_latest"
+        self.url_ids = collections.OrderedDict()
+        self.url_cache_size = int(config.db_url_cache_size)
         # TODO: Create a tuning-setup config file for the values below
         self.hypertable_number_partitions = 4
         self.hypertable_chunk_time_interval = "1 week"
+        self.hypertable_compress_after = config.db_compress_after
+        self.hypertable_drop_after = config.db_drop_after
 
     def __del__(self) -> None:
         self.close()
@@ -62,15 +206,335 @@ class Store_manager:
                     f"Established connection with DB, status code: {self.db_connect.status}"
                 )
 
-    def validate_metric_store(self) -> bool:
+    def set_storage_policies(self, db_cursor) -> None:
+        """Enable native compression of `db_table` (segmented by url_id, ordered by time
+        DESC) and replace its compression and retention policies by the configured ones
+        (`hypertable_compress_after`, `hypertable_drop_after`); an empty setting removes
+        its policy
+
+        Args:
+            db_cursor (psycopg2.extensions.cursor): Cursor of the DB connection
+        """
+        db_cursor.execute(
+            "SELECT compression_enabled FROM timescaledb_information.hypertables WHERE hypertable_name = %s",
+            (self.db_table,),
+        )
+        if not db_cursor.fetchone()[0]:
+            log.info(
+                f"Enabling compression of '{self.db_table}', segmented by 'url_id' and ordered by 'time'"
+            )
+            db_cursor.execute(
+                f"""ALTER TABLE {self.db_table} SET (
+                        timescaledb.compress,
+                        timescaledb.compress_segmentby = 'url_id',
+                        timescaledb.compress_orderby = 'time DESC'
+                    )"""
+            )
+        db_cursor.execute(
+            "SELECT remove_compression_policy(%s, if_exists => TRUE)", (self.db_table,)
+        )
+        if self.hypertable_compress_after:
+            log.info(
+                f"Compressing chunks of '{self.db_table}' older than {self.hypertable_compress_after}"
+            )
+            db_cursor.execute(
+                "SELECT add_compression_policy(%s, %s::INTERVAL)",
+                (self.db_table, self.hypertable_compress_after),
+            )
+        db_cursor.execute(
+            "SELECT remove_retention_policy(%s, if_exists => TRUE)", (self.db_table,)
+        )
+        if self.hypertable_drop_after:
+            log.info(
+                f"Dropping chunks of '{self.db_table}' older than {self.hypertable_drop_after}"
+            )
+            db_cursor.execute(
+                "SELECT add_retention_policy(%s, %s::INTERVAL)",
+                (self.db_table, self.hypertable_drop_after),
+            )
+
+    def get_rollup_view(self, suffix: str) -> str:
+        """Returns:
+        str: Name of the view of the rollup (continuous aggregate) `suffix`, e.g. "1m"
+        """
+        return f"{self.db_table}_{suffix}"
+
+    def get_rollup_buckets(self) -> dict[str, float]:
+        """Returns:
+        dict[str, float]: Width (seconds) of the time bucket of every existing rollup,
+        by its view name
+        """
+        buckets = {
+            self.get_rollup_view(rollup[0]): rollup[1] for rollup in self.rollups
+        }
+        try:
+            self.connect()
+            with self.db_connect.cursor() as db_cursor:
+                db_cursor.execute(
+                    """SELECT view_name FROM timescaledb_information.continuous_aggregates
+                       WHERE hypertable_name = %s""",
+                    (self.db_table,),
+                )
+                views = [row[0] for row in db_cursor.fetchall() if row[0] in buckets]
+                result = {
+                    view: self.get_interval_secs(db_cursor, buckets[view])
+                    for view in views
+                }
+        except (psycopg2.Error, Exception):
+            log.exception("Rollups (continuous aggregates) could not be listed")
+            raise
+        return result
+
+    @staticmethod
+    def get_interval_secs(db_cursor, interval: str) -> float:
+        """Returns:
+        float: Length of a PostgreSQL interval (e.g. "5 minutes") in seconds
+        """
+        db_cursor.execute("SELECT EXTRACT(EPOCH FROM %s::INTERVAL)", (interval,))
+        return float(db_cursor.fetchone()[0])
+
+    @contextlib.contextmanager
+    def named_cursor(self, name: str):
+        """Server-side cursor, which fetches the rows of large results in chunks of
+        `query_itersize`, instead of loading them all in memory. It runs in a
+        transaction, since named cursors need one (autocommit is suspended meanwhile)
+
+        Args:
+            name (str): Name of the cursor
+
+        Yields:
+            psycopg2.extras.RealDictCursor: Cursor, returning rows as dictionaries
+        """
+        self.connect()
+        autocommit = self.db_connect.autocommit
+        self.db_connect.autocommit = False
+        try:
+            with self.db_connect.cursor(
+                name=name, cursor_factory=extras.RealDictCursor
+            ) as db_cursor:
+                db_cursor.itersize = self.query_itersize
+                yield db_cursor
+        finally:
+            # Queries are read-only, nothing to commit
+            self.db_connect.rollback()
+            self.db_connect.autocommit = autocommit
+
+    def get_url_filter(self, web_url: str = None) -> str:
+        """Args:
+            web_url (str, optional): URL to filter by, as `%(web_url)s` parameter.
+            Defaults to None.
+
+        Returns:
+            str: SQL condition (`AND ...`) on the url_id of `web_url`, empty for None
+        """
+        if not web_url:
+            return ""
+        return f"AND url_id = (SELECT url_id FROM {self.db_urls_table} WHERE web_url = %(web_url)s)"
+
+    def query_latest_status(self, web_url: str = None):
+        """Most recent metric of every URL, read from `db_latest_table`, which has one
+        row per URL
+
+        Args:
+            web_url (str, optional): Only this URL. Defaults to all URLs.
+
+        Yields:
+            dict: Row per URL (ordered by URL) with: web_url, time, up (HTTP status is
+            2xx or 3xx), http_status, resp_time, regex_match and phase timings
+        """
+        sql_url_filter = self.get_url_filter(web_url)
+        sql_query = f"""SELECT urls.web_url, latest.time,
+                               latest.http_status BETWEEN 200 AND 399 AS up,
+                               {", ".join(f"latest.{column}" for column in self.metric_columns[2:])}
+                        FROM {self.db_latest_table} AS latest
+                        JOIN {self.db_urls_table} AS urls USING (url_id)
+                        WHERE TRUE {sql_url_filter}
+                        ORDER BY urls.web_url"""
+        try:
+            with self.named_cursor("query_latest_status") as db_cursor:
+                db_cursor.execute(sql_query, {"web_url": web_url})
+                for row in db_cursor:
+                    yield dict(row)
+        except (psycopg2.Error, Exception):
+            log.exception("Latest status of URLs could not be queried")
+            raise
+
+    def query_url_stats(self, start, end, bucket: str, web_url: str = None):
+        """Uptime, regex failure rate and resp_time (min., avg., max. and percentiles,
+        see `query_percentiles`) per URL and time bucket. It reads the coarsest rollup
+        whose bucket divides `bucket` (percentiles are then estimated from its
+        histograms, see `estimate_percentile()`), and the raw hypertable otherwise
+
+        Args:
+            start (datetime.datetime | str): Start of the time range (included)
+            end (datetime.datetime | str): End of the time range (excluded)
+            bucket (str): Width of the time buckets, as PostgreSQL interval (e.g. "1 hour")
+            web_url (str, optional): Only this URL. Defaults to all URLs.
+
+        Yields:
+            dict: Row per URL and bucket (ordered by URL and bucket) with: bucket,
+            web_url, samples, errors, uptime_pct, regex_failure_rate, min_resp_time,
+            avg_resp_time, max_resp_time and p50, p95, p99 (or the percentiles of
+            `query_percentiles`)
+        """
+        rollup_buckets = self.get_rollup_buckets()
+        with self.db_connect.cursor() as db_cursor:
+            bucket_secs = self.get_interval_secs(db_cursor, bucket)
+        rollup_view = None
+        for view, rollup_bucket_secs in sorted(
+            rollup_buckets.items(), key=lambda item: item[1], reverse=True
+        ):
+            if (
+                bucket_secs >= rollup_bucket_secs
+                and bucket_secs % rollup_bucket_secs == 0
+            ):
+                rollup_view = view
+                break
+        parameters = {"bucket": bucket, "start": start, "end": end, "web_url": web_url}
+        sql_url_filter = self.get_url_filter(web_url)
+        if rollup_view:
+            log.info(f"Querying stats per {bucket} from rollup '{rollup_view}'")
+            sql_stats = f"""WITH buckets AS (
+                                SELECT time_bucket(%(bucket)s::INTERVAL, bucket) AS bucket,
+                                       url_id, samples, errors, regex_failures,
+                                       min_resp_time, avg_resp_time, max_resp_time,
+                                       resp_time_histogram
+                                FROM {rollup_view}
+                                WHERE bucket >= %(start)s AND bucket < %(end)s {sql_url_filter}
+                            ),
+                            histograms AS (
+                                SELECT bucket, url_id, position, sum(count)::BIGINT AS count
+                                FROM buckets,
+                                     unnest(resp_time_histogram) WITH ORDINALITY AS h(count, position)
+                                GROUP BY bucket, url_id, position
+                            )
+                            SELECT bucket, url_id,
+                                   sum(samples) AS samples,
+                                   sum(errors) AS errors,
+                                   sum(regex_failures) AS regex_failures,
+                                   min(min_resp_time) AS min_resp_time,
+                                   sum(avg_resp_time * samples) / sum(samples) AS avg_resp_time,
+                                   max(max_resp_time) AS max_resp_time,
+                                   (SELECT array_agg(histograms.count ORDER BY histograms.position)
+                                    FROM histograms
+                                    WHERE histograms.bucket = buckets.bucket
+                                    AND histograms.url_id = buckets.url_id) AS resp_time_histogram
+                            FROM buckets
+                            GROUP BY bucket, url_id"""
+        else:
+            log.info(f"Querying stats per {bucket} from raw table '{self.db_table}'")
+            parameters["percentiles"] = list(self.query_percentiles)
+            sql_stats = f"""SELECT time_bucket(%(bucket)s::INTERVAL, time) AS bucket,
+                                   url_id,
+                                   count(*) AS samples,
+                                   count(*) FILTER (WHERE http_status NOT BETWEEN 200 AND 399) AS errors,
+                                   count(*) FILTER (WHERE regex_match IS FALSE) AS regex_failures,
+                                   min(resp_time) AS min_resp_time,
+                                   avg(resp_time) AS avg_resp_time,
+                                   max(resp_time) AS max_resp_time,
+                                   percentile_cont(%(percentiles)s::DOUBLE PRECISION[])
+                                       WITHIN GROUP (ORDER BY resp_time) AS percentiles
+                            FROM {self.db_table}
+                            WHERE time >= %(start)s AND time < %(end)s {sql_url_filter}
+                            GROUP BY 1, 2"""
+        # URLs are joined once the samples are aggregated by url_id
+        sql_query = f"""SELECT urls.web_url, stats.*
+                        FROM ({sql_stats}) AS stats
+                        JOIN {self.db_urls_table} AS urls USING (url_id)
+                        ORDER BY urls.web_url, stats.bucket"""
+        histogram_min, histogram_max, _ = self.rollup_histogram
+        try:
+            with self.named_cursor("query_url_stats") as db_cursor:
+                db_cursor.execute(sql_query, parameters)
+                for row in db_cursor:
+                    # Same columns as before URLs were moved to `db_urls_table`
+                    row = {"bucket": row["bucket"], **row}
+                    del row["url_id"]
+                    if rollup_view:
+                        histogram = row.pop("resp_time_histogram")
+                        percentiles = [
+                            estimate_percentile(
+                                histogram, quantile, histogram_min, histogram_max
+                            )
+                            for quantile in self.query_percentiles
+                        ]
+                    else:
+                        percentiles = row.pop("percentiles")
+                    samples = int(row["samples"])
+                    regex_failures = int(row.pop("regex_failures"))
+                    row["samples"] = samples
+                    row["errors"] = int(row["errors"])
+                    row["uptime_pct"] = 100.0 * (samples - row["errors"]) / samples
+                    row["regex_failure_rate"] = regex_failures / samples
+                    row["avg_resp_time"] = float(row["avg_resp_time"])
+                    for quantile, percentile in zip(
+                        self.query_percentiles, percentiles
+                    ):
+                        row[f"p{round(quantile * 100)}"] = percentile
+                    yield row
+        except (psycopg2.Error, Exception):
+            log.exception("Stats of URLs could not be queried")
+            raise
+
+    def query_error_breakdown(self, start, end, web_url: str = None):
+        """Number of errors (HTTP status neither 2xx nor 3xx) per URL and HTTP status,
+        read from the raw hypertable
+
+        Args:
+            start (datetime.datetime | str): Start of the time range (included)
+            end (datetime.datetime | str): End of the time range (excluded)
+            web_url (str, optional): Only this URL. Defaults to all URLs.
+
+        Yields:
+            dict: Row per URL and HTTP status (ordered by URL and number of errors,
+            descending) with: web_url, http_status, errors and share (of all samples
+            of the URL)
+        """
+        sql_url_filter = self.get_url_filter(web_url)
+        sql_query = f"""SELECT urls.web_url, http_status, errors,
+                               errors::DOUBLE PRECISION / samples AS share
+                        FROM (
+                            SELECT url_id, http_status, count(*) AS errors,
+                                   sum(count(*)) OVER (PARTITION BY url_id) AS samples
+                            FROM {self.db_table}
+                            WHERE time >= %(start)s AND time < %(end)s {sql_url_filter}
+                            GROUP BY url_id, http_status
+                        ) AS statuses
+                        JOIN {self.db_urls_table} AS urls USING (url_id)
+                        WHERE http_status NOT BETWEEN 200 AND 399
+                        ORDER BY urls.web_url, errors DESC"""
+        try:
+            with self.named_cursor("query_error_breakdown") as db_cursor:
+                db_cursor.execute(
+                    sql_query, {"start": start, "end": end, "web_url": web_url}
+                )
+                for row in db_cursor:
+                    yield dict(row)
+        except (psycopg2.Error, Exception):
+            log.exception("Error breakdown of URLs could not be queried")
+            raise
+
+    def validate_metric_store(self, check_rollups: bool = False) -> bool:
         """Validate that both TimescaleDB extension and a hypertable for storing monitoring metrics
         are properly created
 
+        Args:
+            check_rollups (bool, optional): Validate also that all rollups (continuous
+            aggregates) and their refresh policies exist, see `initialize_rollups()`.
+            Defaults to False.
+
         Returns:
             bool: Return True when DB is ready for storing our metrics
         """
         result = False
         hypertable_result = None
+        offsets_table_result = None
+        urls_result = None
+        rollups_result = {}
+        compress_after = None
+        drop_after = None
+        policies_match = False
+        compression_result = None
         try:
             self.connect()
             with self.db_connect.cursor(
@@ -81,13 +545,117 @@ class Store_manager:
                     f"SELECT * FROM _timescaledb_catalog.hypertable WHERE table_name='{self.db_table}'"
                 )
                 hypertable_result = db_cursor.fetchone()
+                db_cursor.execute(
+                    "SELECT to_regclass(%s) AS offsets_table", (self.db_offsets_table,)
+                )
+                offsets_table_result = db_cursor.fetchone()["offsets_table"]
+                # Tables created by older versions store web_url instead of url_id
+                db_cursor.execute(
+                    """SELECT to_regclass(%(urls_table)s) AS urls_table,
+                              to_regclass(%(wide_view)s) AS wide_view,
+                              to_regclass(%(latest_table)s) AS latest_table,
+                              EXISTS (
+                                  SELECT 1 FROM information_schema.columns
+                                  WHERE table_name = %(table)s AND column_name = 'url_id'
+                              ) AS url_id_column""",
+                    {
+                        "urls_table": self.db_urls_table,
+                        "wide_view": self.db_wide_view,
+                        "latest_table": self.db_latest_table,
+                        "table": self.db_table,
+                    },
+                )
+                urls_result = db_cursor.fetchone()
+                # Number of refresh policies of every continuous aggregate of our table
+                db_cursor.execute(
+                    """SELECT aggregate.view_name, count(job.job_id) AS refresh_policies
+                       FROM timescaledb_information.continuous_aggregates AS aggregate
+                       LEFT JOIN timescaledb_information.jobs AS job
+                       ON job.hypertable_name = aggregate.materialization_hypertable_name
+                       AND job.proc_name = 'policy_refresh_continuous_aggregate'
+                       WHERE aggregate.hypertable_name = %s
+                       GROUP BY aggregate.view_name""",
+                    (self.db_table,),
+                )
+                rollups_result = {
+                    row["view_name"]: row["refresh_policies"]
+                    for row in db_cursor.fetchall()
+                }
+                # Compression and retention policies, and their age thresholds
+                db_cursor.execute(
+                    """SELECT proc_name, config FROM timescaledb_information.jobs
+                       WHERE hypertable_name = %s
+                       AND proc_name IN ('policy_compression', 'policy_retention')""",
+                    (self.db_table,),
+                )
+                policies_result = {
+                    row["proc_name"]: row["config"] for row in db_cursor.fetchall()
+                }
+                compress_after = policies_result.get("policy_compression", {}).get(
+                    "compress_after"
+                )
+                drop_after = policies_result.get("policy_retention", {}).get(
+                    "drop_after"
+                )
+                policies_match = self.intervals_match(
+                    db_cursor, compress_after, self.hypertable_compress_after
+                ) and self.intervals_match(
+                    db_cursor, drop_after, self.hypertable_drop_after
+                )
+                db_cursor.execute(
+                    "SELECT compression_enabled FROM timescaledb_information.hypertables WHERE hypertable_name = %s",
+                    (self.db_table,),
+                )
+                compression_enabled = db_cursor.fetchone()
+                if compression_enabled and compression_enabled["compression_enabled"]:
+                    db_cursor.execute(
+                        "SELECT * FROM hypertable_compression_stats(%s)",
+                        (self.db_table,),
+                    )
+                    compression_result = db_cursor.fetchone()
         except (psycopg2.Error, Exception):
             log.exception(
                 "DB catalog (_timescaledb_catalog.hypertable) could not be accessed"
             )
             raise
         else:
-            if hypertable_result and hypertable_result["num_dimensions"] == 2:
+            rollup_views = [self.get_rollup_view(rollup[0]) for rollup in self.rollups]
+            missing_rollups = [
+                view for view in rollup_views if not rollups_result.get(view)
+            ]
+            log.info(
+                f"Rollups (continuous aggregates) with refresh policy: {[view for view in rollup_views if view not in missing_rollups]}"
+            )
+            log.info(
+                f"Storage policies of '{self.db_table}': compress after {compress_after or '(never)'}, drop after {drop_after or '(never)'}"
+            )
+            if compression_result:
+                log.info(f"Compression of '{self.db_table}': {compression_result}")
+            if not offsets_table_result:
+                log.error(
+                    f"Table of Kafka offsets '{self.db_offsets_table}' is missing"
+                )
+            elif not urls_result["url_id_column"]:
+                log.error(
+                    f"'{self.db_table}' stores web_url instead of url_id, it was created by an older version and must be migrated (see README)"
+                )
+            elif not (urls_result["urls_table"] and urls_result["wide_view"]):
+                log.error(
+                    f"Table of URLs '{self.db_urls_table}' or view '{self.db_wide_view}' is missing"
+                )
+            elif not urls_result["latest_table"]:
+                log.error(
+                    f"Table of the latest metrics '{self.db_latest_table}' is missing"
+                )
+            elif not policies_match:
+                log.error(
+                    f"Storage policies of '{self.db_table}' don't match POSTGRES_COMPRESS_AFTER and POSTGRES_DROP_AFTER, run initialize_infra.py again"
+                )
+            elif check_rollups and missing_rollups:
+                log.error(
+                    f"Rollups (continuous aggregates) or their refresh policies are missing: {missing_rollups}"
+                )
+            elif hypertable_result and hypertable_result["num_dimensions"] == 2:
                 log.info(f"Database ready for storing metrics, all resources created")
                 log.info(
                     f"Extra details in catalog (_timescaledb_catalog.hypertable):\n\t{hypertable_result}"
@@ -101,36 +669,130 @@ class Store_manager:
             self.close()
             return result
 
+    @staticmethod
+    def intervals_match(db_cursor, current: str, configured: str) -> bool:
+        """Compare the age threshold of a storage policy with its setting, as intervals
+        (e.g. '7 days' and '1 week' match), since policies store them normalized
+
+        Args:
+            db_cursor (psycopg2.extensions.cursor): Cursor of an open connection
+            current (str): Threshold of the existing policy, None if there is no policy
+            configured (str): Setting of the policy, empty for no policy
+
+        Returns:
+            bool: True if both are missing or both are the same interval
+        """
+        if not current or not configured:
+            return not current and not configured
+        db_cursor.execute(
+            "SELECT %s::interval = %s::interval AS same_interval", (current, configured)
+        )
+        return db_cursor.fetchone()["same_interval"]
+
     def initialize_metrics_store(self) -> None:
-        """Create both TimescaleDB extension and a hypertable for storing our monitoring metrics"""
+        """Create both TimescaleDB extension and a hypertable for storing our monitoring
+        metrics, with the table of their URLs and a view with the web_url of every metric.
+        Nothing is created when `db_table` was created by an older version (with web_url
+        instead of url_id), it must be migrated first (see README)
+        """
         sql_enable_timescaleDB = "CREATE EXTENSION IF NOT EXISTS timescaledb CASCADE"
+        sql_create_urls_table = f"""CREATE TABLE IF NOT EXISTS {self.db_urls_table} (
+                                     url_id   INTEGER  GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+                                     web_url  TEXT     NOT NULL UNIQUE
+                                    )"""
         sql_create_table = f"""CREATE TABLE IF NOT EXISTS {self.db_table} (
-                                time         TIMESTAMPTZ       NOT NULL,
-                                web_url      TEXT              NOT NULL,
-                                http_status  SMALLINT          NOT NULL,
-                                resp_time    DOUBLE PRECISION  NOT NULL,
-                                regex_match  BOOLEAN           NULL
+                                time           TIMESTAMPTZ       NOT NULL,
+                                url_id         INTEGER           NOT NULL,
+                                http_status    SMALLINT          NOT NULL,
+                                resp_time      DOUBLE PRECISION  NOT NULL,
+                                regex_match    BOOLEAN           NULL,
+                                dns_time       DOUBLE PRECISION  NULL,
+                                connect_time   DOUBLE PRECISION  NULL,
+                                ttfb_time      DOUBLE PRECISION  NULL,
+                                transfer_time  DOUBLE PRECISION  NULL
                                )"""
+        sql_create_latest_table = f"""CREATE TABLE IF NOT EXISTS {self.db_latest_table} (
+                                       url_id         INTEGER           PRIMARY KEY,
+                                       time           TIMESTAMPTZ       NOT NULL,
+                                       http_status    SMALLINT          NOT NULL,
+                                       resp_time      DOUBLE PRECISION  NOT NULL,
+                                       regex_match    BOOLEAN           NULL,
+                                       dns_time       DOUBLE PRECISION  NULL,
+                                       connect_time   DOUBLE PRECISION  NULL,
+                                       ttfb_time      DOUBLE PRECISION  NULL,
+                                       transfer_time  DOUBLE PRECISION  NULL
+                                      )"""
+        sql_create_offsets_table = f"""CREATE TABLE IF NOT EXISTS {self.db_offsets_table} (
+                                        topic            TEXT     NOT NULL,
+                                        kafka_partition  INTEGER  NOT NULL,
+                                        next_offset      BIGINT   NOT NULL,
+                                        PRIMARY KEY (topic, kafka_partition)
+                                       )"""
+        sql_add_phase_columns = f"ALTER TABLE {self.db_table} " + ", ".join(
+            f"ADD COLUMN IF NOT EXISTS {column} DOUBLE PRECISION NULL"
+            for column in self.metric_phase_columns
+        )
         sql_convert_to_hypertable = f"""SELECT create_hypertable(
                                         '{self.db_table}',
-                                        'time', 'web_url',
+                                        'time', 'url_id',
                                         {self.hypertable_number_partitions},
                                         chunk_time_interval => interval '{self.hypertable_chunk_time_interval}',
                                         if_not_exists => TRUE
                                     )"""
+        # Same name as the index created by default by create_hypertable() for its
+        # space dimension, if any
+        sql_create_url_index = f"""CREATE INDEX IF NOT EXISTS {self.db_table}_url_id_time_idx
+                                   ON {self.db_table} (url_id, time DESC)"""
+        # Same columns as `db_table` had before URLs were moved to `db_urls_table`
+        sql_create_wide_view = f"""CREATE OR REPLACE VIEW {self.db_wide_view} AS
+                                    SELECT metrics.time, urls.web_url,
+                                           {", ".join(f"metrics.{column}" for column in self.metric_columns[2:])}
+                                    FROM {self.db_table} AS metrics
+                                    JOIN {self.db_urls_table} AS urls USING (url_id)"""
+        sql_get_columns = """SELECT column_name FROM information_schema.columns
+                             WHERE table_name = %s"""
         try:
             self.connect()
             with self.db_connect.cursor() as db_cursor:
+                db_cursor.execute(sql_get_columns, (self.db_table,))
+                columns = {row[0] for row in db_cursor.fetchall()}
+                if "web_url" in columns and "url_id" not in columns:
+                    raise RuntimeError(
+                        f"'{self.db_table}' stores web_url instead of url_id, it was created by an older version and must be migrated (see README)"
+                    )
                 log.info("Enabling TimescaleDB extension, if it doesn't exist")
                 db_cursor.execute(sql_enable_timescaleDB)
+                log.info(
+                    f"Creating table for URLs ({self.db_urls_table}), if it doesn't exist"
+                )
+                db_cursor.execute(sql_create_urls_table)
                 log.info(
                     f"Creating table for metrics ({self.db_table}), if it doesn't exist"
                 )
                 db_cursor.execute(sql_create_table)
                 log.info(
-                    f"Turning '{self.db_table}' to a hypertable partitioned by 2 dimensions: 'time' and 'web_url', if it doesn't exist"
+                    f"Adding phase timing columns to '{self.db_table}', if they don't exist"
+                )
+                db_cursor.execute(sql_add_phase_columns)
+                log.info(
+                    f"Turning '{self.db_table}' to a hypertable partitioned by 2 dimensions: 'time' and 'url_id', if it doesn't exist"
                 )
                 db_cursor.execute(sql_convert_to_hypertable)
+                log.info(
+                    f"Creating index of '{self.db_table}' on 'url_id' and 'time DESC', if it doesn't exist"
+                )
+                db_cursor.execute(sql_create_url_index)
+                log.info(f"Creating view with web_url ({self.db_wide_view})")
+                db_cursor.execute(sql_create_wide_view)
+                log.info(
+                    f"Creating table for Kafka offsets ({self.db_offsets_table}), if it doesn't exist"
+                )
+                db_cursor.execute(sql_create_offsets_table)
+                log.info(
+                    f"Creating table for the latest metric of every URL ({self.db_latest_table}), if it doesn't exist"
+                )
+                db_cursor.execute(sql_create_latest_table)
+                self.set_storage_policies(db_cursor)
         except (psycopg2.Error, Exception):
             log.exception("TimescaleDB extension could not be created")
             raise
@@ -139,26 +801,326 @@ class Store_manager:
         finally:
             self.close()
 
-    def insert_metrics_batch(self, metrics: list[dict]) -> None:
+    def initialize_rollups(self) -> None:
+        """Create the rollups of `db_table` (continuous aggregates, see `rollups`) and
+        their refresh policies, if they don't exist. Every rollup has, per time bucket
+        and url_id: number of samples, errors (HTTP status not 2xx nor 3xx) and regex
+        failures, and min., avg., max. and histogram (see `rollup_histogram`) of
+        resp_time
+        """
+        histogram_min, histogram_max, histogram_buckets = self.rollup_histogram
+        try:
+            self.connect()
+            with self.db_connect.cursor() as db_cursor:
+                for suffix, bucket, start_offset, end_offset, schedule in self.rollups:
+                    view = self.get_rollup_view(suffix)
+                    log.info(
+                        f"Creating rollup '{view}' of {bucket} buckets, if it doesn't exist"
+                    )
+                    db_cursor.execute(
+                        f"""CREATE MATERIALIZED VIEW IF NOT EXISTS {view}
+                            WITH (timescaledb.continuous) AS
+                            SELECT time_bucket(INTERVAL '{bucket}', time) AS bucket,
+                                   url_id,
+                                   count(*) AS samples,
+                                   count(*) FILTER (WHERE http_status NOT BETWEEN 200 AND 399) AS errors,
+                                   count(*) FILTER (WHERE regex_match IS FALSE) AS regex_failures,
+                                   min(resp_time) AS min_resp_time,
+                                   avg(resp_time) AS avg_resp_time,
+                                   max(resp_time) AS max_resp_time,
+                                   histogram(resp_time, {histogram_min}, {histogram_max}, {histogram_buckets}) AS resp_time_histogram
+                            FROM {self.db_table}
+                            GROUP BY bucket, url_id
+                            WITH NO DATA"""
+                    )
+                    log.info(
+                        f"Adding refresh policy to '{view}' (every {schedule}), if it doesn't exist"
+                    )
+                    db_cursor.execute(
+                        f"""SELECT add_continuous_aggregate_policy(
+                                '{view}',
+                                start_offset => INTERVAL '{start_offset}',
+                                end_offset => INTERVAL '{end_offset}',
+                                schedule_interval => INTERVAL '{schedule}',
+                                if_not_exists => TRUE
+                            )"""
+                    )
+        except (psycopg2.Error, Exception):
+            log.exception("Rollups (continuous aggregates) could not be created")
+            raise
+        else:
+            log.info("All rollups were created")
+        finally:
+            self.close()
+
+    @classmethod
+    def encode_copy_binary(cls, metrics: list[dict], url_ids: dict) -> io.BytesIO:
+        """Encode metrics as PostgreSQL binary COPY data, for the columns `metric_columns`
+
+        Args:
+            metrics (list[dict]): List of web metrics
+            url_ids (dict): url_id of every web_url of `metrics`, see `get_url_ids()`
+
+        Returns:
+            io.BytesIO: Buffer with the COPY data, ready to be read
+        """
+        null = _COPY_NULL
+        bools = _COPY_BOOLS
+        pack_float8 = _COPY_FLOAT8.pack
+        pack_start = _COPY_ROW_START.pack
+        pack_status = _COPY_ROW_STATUS.pack
+        field_count = len(cls.metric_columns)
+        buffer = io.BytesIO()
+        write = buffer.write
+        write(_COPY_HEADER)
+        for metric in metrics:
+            write(
+                pack_start(
+                    field_count,
+                    8,
+                    to_pg_timestamp(metric["time"]),
+                    4,
+                    url_ids[metric["web_url"]],
+                )
+            )
+            write(pack_status(2, metric["http_status"], 8, metric["resp_time"]))
+            regex_match = metric.get("regex_match")
+            write(null if regex_match is None else bools[bool(regex_match)])
+            # Messages from older agents may lack the newest (nullable) fields
+            for column in cls.metric_phase_columns:
+                value = metric.get(column)
+                write(null if value is None else pack_float8(8, value))
+        write(_COPY_TRAILER)
+        buffer.seek(0)
+        return buffer
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run the statements of the `with` block in one transaction, also when
+        the connection is in autocommit mode: it's committed when the block ends and
+        rolled back if it raises
+
+        Yields:
+            psycopg2.extensions.cursor: Cursor for the statements of the transaction
+        """
+        self.connect()
+        autocommit = self.db_connect.autocommit
+        with self.db_connect.cursor() as db_cursor:
+            if autocommit:
+                db_cursor.execute("BEGIN")
+            try:
+                yield db_cursor
+            except BaseException:
+                try:
+                    if autocommit:
+                        db_cursor.execute("ROLLBACK")
+                    else:
+                        self.db_connect.rollback()
+                except psycopg2.Error:
+                    log.warning("Transaction could not be rolled back")
+                raise
+            if autocommit:
+                db_cursor.execute("COMMIT")
+            else:
+                self.db_connect.commit()
+
+    def store_offsets(self, db_cursor, offsets: dict) -> None:
+        """Record the next Kafka offset of some partitions, see `get_stored_offsets()`
+
+        Args:
+            db_cursor (psycopg2.extensions.cursor): Cursor of the transaction which
+            stores the messages before those offsets
+            offsets (dict): Next offset of every partition (kafka.TopicPartition, or
+            tuple of topic and partition, -> int)
+        """
+        if offsets:
+            extras.execute_values(
+                db_cursor,
+                f"""INSERT INTO {self.db_offsets_table} (topic, kafka_partition, next_offset)
+                    VALUES %s
+                    ON CONFLICT (topic, kafka_partition) DO UPDATE
+                    SET next_offset = EXCLUDED.next_offset""",
+                [
+                    (topic, partition, offset)
+                    for (topic, partition), offset in offsets.items()
+                ],
+            )
+
+    def store_latest_metrics(
+        self, db_cursor, metrics: list[dict], url_ids: dict
+    ) -> None:
+        """Replace, with one UPSERT, the row of `db_latest_table` of every URL of
+        `metrics` by its most recent metric, unless the stored one is more recent
+
+        Args:
+            db_cursor (psycopg2.extensions.cursor): Cursor of the transaction which
+            stores `metrics`
+            metrics (list[dict]): List of web metrics
+            url_ids (dict): url_id of every web_url of `metrics`, see `get_url_ids()`
+        """
+        if metrics:
+            # A row cannot be updated twice by the same statement
+            latest_metrics = select_latest_metrics(metrics)
+            columns = self.metric_columns[2:]
+            extras.execute_values(
+                db_cursor,
+                f"""INSERT INTO {self.db_latest_table} AS latest (url_id, time, {", ".join(columns)})
+                    VALUES %s
+                    ON CONFLICT (url_id) DO UPDATE
+                    SET time = EXCLUDED.time, {", ".join(f"{column} = EXCLUDED.{column}" for column in columns)}
+                    WHERE latest.time <= EXCLUDED.time""",
+                [
+                    (url_ids[url], metric["time"])
+                    + tuple(metric.get(column) for column in columns)
+                    for url, metric in latest_metrics.items()
+                ],
+                page_size=len(latest_metrics),
+            )
+
+    def get_stored_offsets(self, topic: str) -> dict[int, int]:
+        """Args:
+            topic (str): Kafka topic
+
+        Returns:
+            dict[int, int]: Next Kafka offset to consume of every partition of `topic`
+            whose messages were stored
+        """
+        try:
+            self.connect()
+            with self.db_connect.cursor() as db_cursor:
+                db_cursor.execute(
+                    f"SELECT kafka_partition, next_offset FROM {self.db_offsets_table} WHERE topic = %s",
+                    (topic,),
+                )
+                result = dict(db_cursor.fetchall())
+        except (psycopg2.Error, Exception):
+            log.exception(f"Stored offsets of topic '{topic}' could not be retrieved")
+            raise
+        return result
+
+    def get_url_ids(self, urls) -> dict[str, int]:
+        """url_id of some URLs, from the cache `url_ids` or, for the ones missing there,
+        from `db_urls_table` (see `create_url_ids()`), which are then cached evicting
+        the least recently used URLs beyond `url_cache_size`
+
+        Args:
+            urls (iterable[str]): web_url of some metrics, repetitions are allowed
+
+        Returns:
+            dict[str, int]: url_id of every URL of `urls`
+        """
+        result = {}
+        missing = set()
+        for url in urls:
+            if url in result or url in missing:
+                continue
+            url_id = self.url_ids.get(url)
+            if url_id is None:
+                missing.add(url)
+            else:
+                self.url_ids.move_to_end(url)
+                result[url] = url_id
+        if missing:
+            # Sorted, so that concurrent sinks lock new URLs in the same order
+            created = self.create_url_ids(sorted(missing))
+            result.update(created)
+            self.url_ids.update(created)
+            while len(self.url_ids) > self.url_cache_size:
+                self.url_ids.popitem(last=False)
+        return result
+
+    def create_url_ids(self, urls: list[str]) -> dict[str, int]:
+        """Get or create, in one statement, the url_id of some URLs in `db_urls_table`.
+        It's committed at once, in its own transaction, so that ids are never rolled
+        back after being cached
+
+        Args:
+            urls (list[str]): Distinct URLs
+
+        Returns:
+            dict[str, int]: url_id of every URL of `urls`
+        """
+        # URLs inserted by other sinks after this statement started are neither
+        # inserted (conflict) nor visible (snapshot) to it, so they are asked again
+        sql_get_or_create = f"""WITH created AS (
+                                    INSERT INTO {self.db_urls_table} (web_url)
+                                    SELECT unnest(%(urls)s::TEXT[])
+                                    ON CONFLICT (web_url) DO NOTHING
+                                    RETURNING web_url, url_id
+                                )
+                                SELECT web_url, url_id FROM created
+                                UNION ALL
+                                SELECT web_url, url_id FROM {self.db_urls_table}
+                                WHERE web_url = ANY(%(urls)s::TEXT[])"""
+        result = {}
+        pending = urls
+        try:
+            while pending:
+                with self.transaction() as db_cursor:
+                    db_cursor.execute(sql_get_or_create, {"urls": pending})
+                    result.update(db_cursor.fetchall())
+                pending = [url for url in pending if url not in result]
+        except (psycopg2.Error, Exception):
+            log.exception("url_id of URLs could not be retrieved")
+            raise
+        log.debug(f"{len(result)} URLs added to cache of url_id")
+        return result
+
+    def insert_metrics_copy(self, metrics: list[dict], offsets: dict = None) -> None:
+        """Store a list of dictionary elements (the collected web metrics) in DB
+        Implementation is based on `COPY ... FROM STDIN` in binary format, streamed from
+        an in-memory buffer, which is several times faster than `insert_metrics_batch()`
+
+        Args:
+            metrics (list[dict]): List of web metrics to store
+            offsets (dict, optional): Kafka offsets after `metrics`, stored in the same
+            transaction (see `store_offsets()`). Defaults to None.
+        """
+        if len(metrics) > 0 or offsets:
+            log.debug(f"Copying, in DB, metrics:\n\t{metrics}")
+            sql_copy_string = f"""COPY {self.db_table} ({", ".join(self.metric_columns)})
+                                  FROM STDIN WITH (FORMAT binary)"""
+            try:
+                url_ids = self.get_url_ids(metric["web_url"] for metric in metrics)
+                buffer = self.encode_copy_binary(metrics, url_ids)
+                with self.transaction() as db_cursor:
+                    if metrics:
+                        db_cursor.copy_expert(sql_copy_string, buffer)
+                    self.store_latest_metrics(db_cursor, metrics, url_ids)
+                    self.store_offsets(db_cursor, offsets)
+            except (psycopg2.Error, Exception):
+                log.exception("Could not copy metrics in DB")
+                raise
+            else:
+                log.info("Metrics inserted in DB")
+        else:
+            log.info("Nothing to insert in DB")
+
+    def insert_metrics_batch(self, metrics: list[dict], offsets: dict = None) -> None:
         """Store a list of dictionary elements (the collected web metrics) in DB
         Implementation is based on direct inserts on DB
 
         Args:
             metrics (list[dict]): List of web metrics to store
+            offsets (dict, optional): Kafka offsets after `metrics`, stored in the same
+            transaction (see `store_offsets()`). Defaults to None.
         """
-        if len(metrics) > 0:
+        if len(metrics) > 0 or offsets:
             log.debug(f"Inserting, in DB, metrics:\n\t{metrics}")
-            sql_insert_string = f"""INSERT INTO {self.db_table} VALUES (
-                                    %(time)s,
-                                    %(web_url)s,
-                                    %(http_status)s,
-                                    %(resp_time)s,
-                                    %(regex_match)s
-                                )"""
+            sql_insert_string = f"""INSERT INTO {self.db_table} ({", ".join(self.metric_columns)})
+                                    VALUES ({", ".join(["%s"] * len(self.metric_columns))})"""
             try:
-                self.connect()
-                with self.db_connect.cursor() as db_cursor:
-                    psycopg2.extras.execute_batch(db_cursor, sql_insert_string, metrics)
+                url_ids = self.get_url_ids(metric["web_url"] for metric in metrics)
+                # Messages from older agents may lack the newest (nullable) fields
+                rows = [
+                    (metric["time"], url_ids[metric["web_url"]])
+                    + tuple(metric.get(column) for column in self.metric_columns[2:])
+                    for metric in metrics
+                ]
+                with self.transaction() as db_cursor:
+                    psycopg2.extras.execute_batch(db_cursor, sql_insert_string, rows)
+                    self.store_latest_metrics(db_cursor, metrics, url_ids)
+                    self.store_offsets(db_cursor, offsets)
             except (psycopg2.Error, Exception):
                 log.exception("Could not insert metrics in DB")
                 raise
@@ -0,0 +1,91 @@
+"""Look for a regex pattern in a HTTP body while it is being downloaded,
+chunk by chunk, instead of decoding the whole body into one string.
+Reading stops as soon as the pattern matches or a size cap is reached
+"""
+
+import codecs
+import re
+
+
+class Stream_matcher:
+    """Incremental regex search over a stream of bytes"""
+
+    def __init__(
+        self,
+        regex_pattern: re.Pattern,
+        max_bytes: int,
+        encoding: str = "utf-8",
+        overlap_chars: int = 4096,
+    ) -> None:
+        """Default constructor
+
+        Args:
+            regex_pattern (re.Pattern): Compiled pattern to look for
+            max_bytes (int): Max. number of body bytes to inspect (cap)
+            encoding (str, optional): Charset of the body. Defaults to "utf-8".
+            overlap_chars (int, optional): Characters kept from previous chunks, so that
+            matches up to this length are found even when they span two chunks. Defaults to 4096.
+
+        Properties:
+            bytes_read (int): Number of body bytes inspected so far
+            matched (bool): True once the pattern has been found
+            truncated (bool): True if the cap was reached before finding the pattern
+            tail (str): Last `overlap_chars` characters already inspected
+        """
+        self.regex_pattern = regex_pattern
+        self.max_bytes = max_bytes
+        self.overlap_chars = overlap_chars
+        try:
+            decoder_class = codecs.getincrementaldecoder(encoding)
+        except LookupError:
+            decoder_class = codecs.getincrementaldecoder("utf-8")
+        self.decoder = decoder_class(errors="replace")
+        self.bytes_read = 0
+        self.matched = False
+        self.truncated = False
+        self.tail = ""
+
+    @property
+    def done(self) -> bool:
+        """True when no more bytes are needed: pattern found or cap reached"""
+        return self.matched or self.truncated
+
+    def _search(self, text: str) -> None:
+        window = self.tail + text
+        if self.regex_pattern.search(window):
+            self.matched = True
+        else:
+            self.tail = window[-self.overlap_chars :]
+
+    def feed(self, chunk: bytes) -> bool:
+        """Inspect next chunk of the body, ignoring the bytes beyond the cap
+
+        Args:
+            chunk (bytes): Next piece of the body
+
+        Returns:
+            bool: True when no more bytes are needed (see `done`)
+        """
+        if self.done:
+            return True
+        remaining = self.max_bytes - self.bytes_read
+        if len(chunk) > remaining:
+            chunk = chunk[:remaining]
+            self.bytes_read += len(chunk)
+            self._search(self.decoder.decode(chunk, final=True))
+            if not self.matched:
+                self.truncated = True
+        else:
+            self.bytes_read += len(chunk)
+            self._search(self.decoder.decode(chunk))
+        return self.done
+
+    def close(self) -> bool:
+        """Flush any pending bytes of the decoder, at the end of the body
+
+        Returns:
+            bool: True if the pattern was found
+        """
+        if not self.done:
+            self._search(self.decoder.decode(b"", final=True))
+        return self.matched
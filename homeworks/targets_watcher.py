@@ -0,0 +1,52 @@
+"""Detect changes in the targets file (MONITORING_TARGETS_PATH) by cheap stat polling,
+so that the agent can reload its monitoring targets without restarting
+"""
+
+import os
+from . import logging_console
+
+log = logging_console.getLogger("homeworks")
+
+
+class Targets_watcher:
+    """Compare the stat signature of a file between two polls"""
+
+    def __init__(self, file_path: str) -> None:
+        """Default constructor
+
+        Args:
+            file_path (str): Full path to the watched file
+
+        Properties:
+            signature (tuple): Inode, size and modification time (ns) of the file at the
+            last poll, None if it could not be read
+        """
+        self.file_path = file_path
+        self.signature = self.get_signature()
+
+    def get_signature(self) -> tuple:
+        """Returns:
+        tuple: Current (inode, size, mtime_ns) of the file, None if it doesn't exist.
+        Inode is included because editors often save by replacing the file
+        """
+        try:
+            stat = os.stat(self.file_path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def has_changed(self) -> bool:
+        """Poll the file
+
+        Returns:
+            bool: True if the file changed since previous poll (a missing file is not
+            reported as a change, so that targets are kept while the file is replaced)
+        """
+        signature = self.get_signature()
+        if signature is None:
+            log.warning(f"Targets file '{self.file_path}' cannot be accessed")
+            return False
+        if signature == self.signature:
+            return False
+        self.signature = signature
+        return True
@@ -0,0 +1,250 @@
+"""Encoding of the metric messages exchanged through Kafka.
+Two formats are supported, and consumers detect the format of every message by its
+first byte, so that agents can switch format while sinks keep running:
+* "json": One JSON object per message, with an ISO 8601 time string (legacy format)
+* "binary": Version byte and number of records, followed by struct-packed records
+with epoch-nanosecond times. Several records can be framed in the same message
+
+Binary record (version 1), big-endian:
+    time_ns (int64), http_status (int16), skipped_probes (uint32), resp_time,
+    sched_delay, dns_time, connect_time, ttfb_time, transfer_time (float64, NaN if
+    unset), body_cap (int64, -1 if unset), breaker_state (uint8, index in
+    BREAKER_STATES), regex_match, status_match, body_truncated, timeout_shortened
+    (int8, -1 if unset), length of web_url (uint16) and web_url (utf-8)
+"""
+
+import datetime
+import json
+import math
+import struct
+from . import logging_console
+from .circuit_breaker import Circuit_breaker
+
+# See: How to create tzinfo when I have UTC offset? https://stackoverflow.com/a/28270767
+from dateutil import tz
+from kafka.partitioner import murmur2
+
+log = logging_console.getLogger("homeworks")
+
+JSON_FORMAT = "json"
+BINARY_FORMAT = "binary"
+BINARY_VERSION = 1
+
+BREAKER_STATES = (
+    None,
+    Circuit_breaker.CLOSED,
+    Circuit_breaker.OPEN,
+    Circuit_breaker.HALF_OPEN,
+)
+_BREAKER_STATE_CODES = {state: code for code, state in enumerate(BREAKER_STATES)}
+_FLOAT_FIELDS = (
+    "sched_delay",
+    "dns_time",
+    "connect_time",
+    "ttfb_time",
+    "transfer_time",
+)
+_BOOL_FIELDS = ("regex_match", "status_match", "body_truncated", "timeout_shortened")
+# Decoded values of the nullable booleans, indexed by their encoded value
+_BOOLS = {-1: None, 0: False, 1: True}
+_HEADER = struct.Struct(">BH")
+_RECORD = struct.Struct(">qhId5dqB4bH")
+_UTC = datetime.timezone.utc
+_LOCAL_TZ = tz.tzlocal()
+
+
+def format_time_ns(time_ns: int) -> str:
+    """Format an epoch time as in the JSON format
+
+    Args:
+        time_ns (int): Nanoseconds since epoch (see `time.time_ns()`)
+
+    Returns:
+        str: Date time in ISO 8601 without 'T' and with TimeZone offset
+    """
+    now = datetime.datetime.fromtimestamp(time_ns // 1000 / 1e6, tz=_LOCAL_TZ)
+    return now.strftime("%Y-%m-%d %H:%M:%S.%f%z")
+
+
+def time_ns_to_datetime(time_ns: int) -> datetime.datetime:
+    """Returns:
+    datetime.datetime: Epoch time `time_ns` in UTC, with microsecond precision
+    """
+    return datetime.datetime.fromtimestamp(time_ns // 1000 / 1e6, tz=_UTC)
+
+
+def encode_json(sample: dict) -> bytes:
+    """Encode one sample as a JSON object (legacy format)"""
+    message = dict(sample)
+    if isinstance(message["time"], int):
+        message["time"] = format_time_ns(message["time"])
+    return json.dumps(message).encode("utf-8", errors="strict")
+
+
+def encode_binary(samples: list[dict]) -> bytes:
+    """Encode samples as one binary message (see module description)"""
+    parts = [_HEADER.pack(BINARY_VERSION, len(samples))]
+    for sample in samples:
+        url = sample["web_url"].encode("utf-8")
+        body_cap = sample.get("body_cap")
+        parts.append(
+            _RECORD.pack(
+                sample["time"],
+                sample["http_status"],
+                sample.get("skipped_probes") or 0,
+                sample["resp_time"],
+                *(
+                    math.nan if sample.get(field) is None else sample[field]
+                    for field in _FLOAT_FIELDS
+                ),
+                -1 if body_cap is None else body_cap,
+                _BREAKER_STATE_CODES[sample.get("breaker_state")],
+                *(
+                    -1 if sample.get(field) is None else int(sample[field])
+                    for field in _BOOL_FIELDS
+                ),
+                len(url),
+            )
+        )
+        parts.append(url)
+    return b"".join(parts)
+
+
+def encode_samples(samples: list[dict], wire_format: str) -> bytes:
+    """Encode samples as one message
+
+    Args:
+        samples (list[dict]): Samples, whose "time" is in nanoseconds since epoch.
+        JSON format takes exactly one sample
+        wire_format (str): JSON_FORMAT or BINARY_FORMAT
+
+    Returns:
+        bytes: Encoded message
+    """
+    if wire_format == BINARY_FORMAT:
+        return encode_binary(samples)
+    if wire_format == JSON_FORMAT:
+        if len(samples) != 1:
+            raise ValueError(
+                f"JSON format takes one sample per message, got {len(samples)}"
+            )
+        return encode_json(samples[0])
+    raise ValueError(f"Unknown wire format '{wire_format}'")
+
+
+def decode_binary(raw_message: bytes) -> list[dict]:
+    """Decode a binary message (see module description)"""
+    version, count = _HEADER.unpack_from(raw_message)
+    if version != BINARY_VERSION:
+        raise ValueError(f"Unsupported binary format version {version}")
+    samples = []
+    offset = _HEADER.size
+    unpack_from = _RECORD.unpack_from
+    for _ in range(count):
+        (
+            time_ns,
+            http_status,
+            skipped_probes,
+            resp_time,
+            sched_delay,
+            dns_time,
+            connect_time,
+            ttfb_time,
+            transfer_time,
+            body_cap,
+            breaker_state,
+            regex_match,
+            status_match,
+            body_truncated,
+            timeout_shortened,
+            url_length,
+        ) = unpack_from(raw_message, offset)
+        offset += _RECORD.size
+        url_end = offset + url_length
+        # NaN is the only value different from itself
+        samples.append(
+            {
+                "time": time_ns_to_datetime(time_ns),
+                "web_url": raw_message[offset:url_end].decode("utf-8"),
+                "http_status": http_status,
+                "resp_time": resp_time,
+                "regex_match": _BOOLS[regex_match],
+                "status_match": _BOOLS[status_match],
+                "sched_delay": sched_delay if sched_delay == sched_delay else None,
+                "body_cap": None if body_cap < 0 else body_cap,
+                "body_truncated": _BOOLS[body_truncated],
+                "dns_time": dns_time if dns_time == dns_time else None,
+                "connect_time": connect_time if connect_time == connect_time else None,
+                "ttfb_time": ttfb_time if ttfb_time == ttfb_time else None,
+                "transfer_time": (
+                    transfer_time if transfer_time == transfer_time else None
+                ),
+                "breaker_state": BREAKER_STATES[breaker_state],
+                "timeout_shortened": _BOOLS[timeout_shortened],
+                "skipped_probes": skipped_probes,
+            }
+        )
+        offset = url_end
+    return samples
+
+
+def decode_samples(raw_message: bytes) -> list[dict]:
+    """Decode a message, detecting its format by its first byte
+
+    Args:
+        raw_message (bytes): Message consumed from Kafka
+
+    Returns:
+        list[dict]: Samples of the message. Their "time" is a string (JSON format)
+        or a datetime.datetime (binary format)
+    """
+    if raw_message[:1] in (b"{", b" "):
+        # Not necessary to decode, json.loads() accepts input encoding utf-8 since v3.6
+        return [json.loads(raw_message)]
+    return decode_binary(raw_message)
+
+
+def count_samples(raw_message: bytes) -> int:
+    """Number of samples of a message, read from its header without decoding it
+
+    Args:
+        raw_message (bytes): Encoded message
+
+    Returns:
+        int: Samples of the message (always 1 in JSON format)
+    """
+    if raw_message[:1] in (b"{", b" "):
+        return 1
+    return _HEADER.unpack_from(raw_message)[1]
+
+
+def message_key(raw_message: bytes) -> bytes:
+    """Kafka key of a message: the URL of its first sample, so that all samples of a URL
+    go to the same partition, keeping their order (messages of several samples
+    are expected to group URLs of the same partition)
+
+    Args:
+        raw_message (bytes): Encoded message
+
+    Returns:
+        bytes: URL of the first sample, encoded to utf-8
+    """
+    if raw_message[:1] in (b"{", b" "):
+        return json.loads(raw_message)["web_url"].encode("utf-8")
+    offset = _HEADER.size + _RECORD.size
+    url_length = _RECORD.unpack_from(raw_message, _HEADER.size)[-1]
+    return raw_message[offset : offset + url_length]
+
+
+def get_partition(key: bytes, partitions: list[int]) -> int:
+    """Partition where the default partitioner of Kafka clients puts a key
+    (murmur2 hash, as in the Java client)
+
+    Args:
+        key (bytes): Message key
+        partitions (list[int]): Sorted partitions of the topic
+
+    Returns:
+        int: Partition of `key`
+    """
+    return partitions[(murmur2(key) & 0x7FFFFFFF) % len(partitions)]
@@ -4,9 +4,16 @@
 2. It assumes that Kafka is up and running and we have administrative authorization
 3. It enables TimescaleDB extension in PostgresSQL
 4. It creates a table for storing web_health monitoring
-5. It turns previous table in a partitioned hypertable for storing monitoring metrics
+5. It turns previous table in a partitioned hypertable for storing monitoring metrics,
+with compression and retention policies (POSTGRES_COMPRESS_AFTER, POSTGRES_DROP_AFTER)
+6. It creates a table with the Kafka offsets of the stored metrics
+7. It creates a Kafka topic with KAFKA_TOPIC_PARTITIONS partitions or, if the topic
+already exists, it grows its partitions up to that number
+8. Optionally (--rollups), it creates 1-minute and 1-hour rollups per URL (TimescaleDB
+continuous aggregates) of the hypertable, with their refresh policies
 """
 
+import argparse
 import sys
 from homeworks import logging_console
 from homeworks.communication_manager import Communication_manager
@@ -15,18 +22,44 @@ from homeworks.store_manager import Store_manager
 log = logging_console.getLogger("homeworks")
 
 
-def main() -> int:
+def parse_arguments(argv: list[str]) -> argparse.Namespace:
+    """Parse command line arguments
+
+    Args:
+        argv (list[str]): Command line arguments, without the program name
+
+    Returns:
+        argparse.Namespace: Parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--rollups",
+        action="store_true",
+        help="Create also 1-minute and 1-hour rollups per URL (continuous aggregates) of the metrics, for long-range queries",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] = None) -> int:
     """Main program
 
+    Args:
+        argv (list[str], optional): Command line arguments. Defaults to sys.argv[1:].
+
     Returns:
         int: Return 0 if all setup ran without problems
     """
+    arguments = parse_arguments(sys.argv[1:] if argv is None else argv)
     result = 0
 
     # Initialize and validate DB
     store_manager = Store_manager()
     store_manager.initialize_metrics_store()
-    is_db_ok = store_manager.validate_metric_store()
+    if arguments.rollups:
+        store_manager.initialize_rollups()
+    is_db_ok = store_manager.validate_metric_store(check_rollups=arguments.rollups)
 
     if not is_db_ok:
         result += 1
@@ -36,7 +69,9 @@ def main() -> int:
     try:
         communication_manager = Communication_manager()
         is_bus_ok = communication_manager.validate_metrics_communication()
-        if not is_bus_ok:
+        if is_bus_ok:
+            communication_manager.grow_metrics_partitions()
+        else:
             communication_manager.initialize_metrics_communication()
     except Exception:
         result += 1
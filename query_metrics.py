@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+"""Queries the stored metrics and prints them as CSV:
+* stats: Uptime, regex failure rate and resp_time (min., avg., max., p50, p95 and p99)
+per URL and time bucket, read from the rollups when they exist
+* errors: Number of errors per URL and HTTP status
+* status: Most recent metric of every URL, whatever the time range
+"""
+
+import argparse
+import csv
+import datetime
+import sys
+from homeworks import logging_console
+from homeworks.store_manager import Store_manager
+
+log = logging_console.getLogger("homeworks")
+
+
+def parse_arguments(argv: list[str]) -> argparse.Namespace:
+    """Parse command line arguments
+
+    Args:
+        argv (list[str]): Command line arguments, without the program name
+
+    Returns:
+        argparse.Namespace: Parsed arguments
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "report", choices=("stats", "errors", "status"), help="Report to print"
+    )
+    parser.add_argument(
+        "--start",
+        default=(now - datetime.timedelta(days=1)).isoformat(),
+        help="Start of the time range, e.g. '2021-05-01 00:00:00+00' (default: 1 day ago)",
+    )
+    parser.add_argument(
+        "--end",
+        default=now.isoformat(),
+        help="End of the time range, excluded (default: now)",
+    )
+    parser.add_argument(
+        "--bucket",
+        default="1 hour",
+        help="Width of the time buckets of 'stats', as PostgreSQL interval (default: '1 hour')",
+    )
+    parser.add_argument("--url", default=None, help="Only this URL (default: all)")
+    parser.add_argument(
+        "--output",
+        default="-",
+        help="CSV file to write, '-' for stdout, where only warnings and errors are logged (default: '-')",
+    )
+    return parser.parse_args(argv)
+
+
+def write_csv(rows, output=sys.stdout) -> int:
+    """Write rows as CSV, with a header taken from the first row
+
+    Args:
+        rows (iterable[dict]): Rows to write, all with the same keys
+        output (file, optional): Where to write them. Defaults to sys.stdout.
+
+    Returns:
+        int: Number of written rows
+    """
+    writer = None
+    count = 0
+    for row in rows:
+        if writer is None:
+            writer = csv.DictWriter(output, fieldnames=list(row))
+            writer.writeheader()
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+def main(argv: list[str] = None) -> int:
+    """Main program
+
+    Args:
+        argv (list[str], optional): Command line arguments. Defaults to sys.argv[1:].
+
+    Returns:
+        int: Return 0 if the query ran without issues
+    """
+    arguments = parse_arguments(sys.argv[1:] if argv is None else argv)
+    if arguments.output == "-":
+        # INFO messages go to stdout too, see logging_console.init_logging()
+        log.setLevel("WARNING")
+    result = 0
+    store_manager = Store_manager()
+    output = None
+    try:
+        output = (
+            sys.stdout
+            if arguments.output == "-"
+            else open(arguments.output, "wt", newline="")
+        )
+        if arguments.report == "stats":
+            rows = store_manager.query_url_stats(
+                arguments.start, arguments.end, arguments.bucket, arguments.url
+            )
+        elif arguments.report == "status":
+            rows = store_manager.query_latest_status(arguments.url)
+        else:
+            rows = store_manager.query_error_breakdown(
+                arguments.start, arguments.end, arguments.url
+            )
+        count = write_csv(rows, output)
+        log.info(f"{count} rows returned")
+    except Exception:
+        result = 1
+        log.exception("Unexpected error")
+    finally:
+        store_manager.close()
+        if output and output is not sys.stdout:
+            output.close()
+        return result
+
+
+if __name__ == "__main__":
+    logging_console.init_logging()
+    result = 255
+    result = main()
+
+    sys.exit(result)
@@ -4,38 +4,50 @@
 """
 
 # import daemon
+import argparse
+import functools
 import sys
 from homeworks import logging_console
+from homeworks.agent_supervisor import Agent_supervisor
 from homeworks.communication_manager import Communication_manager
+from homeworks.sink_pipeline import Sink_pipeline
 from homeworks.store_manager import Store_manager
 
 log = logging_console.getLogger("homeworks")
 
 
-def sink_data(metrics_retriever: None, metrics_inserter: None):
+def sink_data(
+    metrics_retriever: None, metrics_inserter: None, insert_method: str = "copy"
+):
     """While connection to the communication bus is still established, batches of messages
-    are retrieved and stored in the DB
+    are retrieved and stored in the DB, overlapping both stages (see `Sink_pipeline`)
     Loop can be interrupted with a Ctr+Break
 
     Args:
         metrics_retriever (Communication_manager): Manages Kafka communication
 
         metrics_inserter (Store_manager): Manages PostgresSQL storage
+
+        insert_method (str, optional): "copy" (binary COPY) or "batch" (INSERT
+        statements), see `Sink_pipeline`. Defaults to "copy".
     """
-    while True:
-        try:
-            messages = metrics_retriever.consume_messages()
-            metrics_inserter.insert_metrics_batch(messages)
-        except KeyboardInterrupt:
-            log.info("Keyboard interruption received (Ctrl+break)")
-            break
-        except Exception:
-            log.exception("Unexpected error")
-            raise
-
-
-def main() -> int:
-    """Main program
+    try:
+        Sink_pipeline(
+            metrics_retriever, metrics_inserter, insert_method=insert_method
+        ).run()
+    except KeyboardInterrupt:
+        log.info("Keyboard interruption received (Ctrl+break)")
+    except Exception:
+        log.exception("Unexpected error")
+        raise
+
+
+def run_sink(insert_method: str = "copy") -> int:
+    """Consume and store metrics in this process
+
+    Args:
+        insert_method (str, optional): How metrics are stored, see `sink_data()`.
+        Defaults to "copy".
 
     Returns:
         int: Return 0 if all ran without issues (Note: Ctrl+break is considered a normal way to stop it and it should exit with 0)
@@ -44,10 +56,9 @@ def main() -> int:
     retriever = None
     inserter = None
     try:
-        # TODO: URGENT! Run next call under 'daemon.DaemonContext()' context, following specifications PEP 3143
         retriever = Communication_manager()
         inserter = Store_manager()
-        sink_data(retriever, inserter)
+        sink_data(retriever, inserter, insert_method)
     except Exception:
         result = 1
         log.exception("Unexpected error")
@@ -59,6 +70,82 @@ def main() -> int:
         return result
 
 
+def run_sink_worker(
+    worker_name: str, worker_names: list[str], insert_method: str = "copy"
+) -> None:
+    """Entry point of a sink process, see `Agent_supervisor`: Its share of the
+    partitions is assigned by the consumer group (KAFKA_CONSUMER_GROUP)
+
+    Args:
+        worker_name (str): Name of this process
+        worker_names (list[str]): Names of all sink processes
+        insert_method (str, optional): How metrics are stored, see `sink_data()`.
+        Defaults to "copy".
+    """
+    log.info(f"{worker_name}: Consuming as one of {len(worker_names)} sink processes")
+    sys.exit(run_sink(insert_method))
+
+
+def parse_arguments(argv: list[str]) -> argparse.Namespace:
+    """Parse command line arguments
+
+    Args:
+        argv (list[str]): Command line arguments, without the program name
+
+    Returns:
+        argparse.Namespace: Parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="Fork N consumer processes of the same consumer group, which share the partitions of the topic (more processes than partitions stay idle). By default, this process consumes alone",
+    )
+    parser.add_argument(
+        "--insert-method",
+        choices=sorted(Sink_pipeline.insert_methods),
+        default="copy",
+        help="How batches of metrics are stored: 'copy', streamed with a binary COPY (fastest), or 'batch', with INSERT statements (default: copy)",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] = None) -> int:
+    """Main program
+
+    Args:
+        argv (list[str], optional): Command line arguments. Defaults to sys.argv[1:].
+
+    Returns:
+        int: Return 0 if all ran without issues (Note: Ctrl+break is considered a normal way to stop it and it should exit with 0)
+    """
+    arguments = parse_arguments(sys.argv[1:] if argv is None else argv)
+    # TODO: URGENT! Run next call under 'daemon.DaemonContext()' context, following specifications PEP 3143
+    if not arguments.processes:
+        return run_sink(arguments.insert_method)
+
+    result = 1
+    try:
+        log.info(f"Starting {arguments.processes} sink processes")
+        Agent_supervisor(
+            arguments.processes,
+            target=functools.partial(
+                run_sink_worker, insert_method=arguments.insert_method
+            ),
+        ).run()
+        log.warning("Sink supervisor stopped by itself")
+    except KeyboardInterrupt:
+        result = 0
+        log.info("Keyboard interruption received (Ctrl+break)")
+    except Exception:
+        log.exception("Unexpected error")
+    finally:
+        return result
+
+
 if __name__ == "__main__":
     logging_console.init_logging()
     result = 255
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Compare the wire formats of the metric messages (see homeworks/wire_format.py):
+size of the messages, CPU time for encoding them (agent) and for decoding them (sink)
+Usage:
+    ./tests/benchmark_wire_format.py [<number of samples>]
+"""
+
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from homeworks import wire_format
+
+
+def make_samples(count: int) -> list[dict]:
+    """Returns:
+    list[dict]: Realistic samples, as produced by Probe_engine
+    """
+    now = time.time_ns()
+    return [
+        {
+            "time": now + i * 1000,
+            "web_url": f"https://www.example{i % 1000}.com/health/check",
+            "http_status": 200 if i % 10 else 503,
+            "resp_time": 0.123456 + i % 7,
+            "regex_match": bool(i % 3),
+            "status_match": None,
+            "sched_delay": 0.0012,
+            "body_cap": 1048576,
+            "body_truncated": False,
+            "dns_time": None if i % 2 else 0.004,
+            "connect_time": 0.02,
+            "ttfb_time": 0.1,
+            "transfer_time": 0.003,
+            "breaker_state": "closed",
+            "timeout_shortened": False,
+            "skipped_probes": 0,
+        }
+        for i in range(count)
+    ]
+
+
+def benchmark(name: str, encode, samples: list[dict], repeat: int = 5) -> None:
+    """Print bytes per sample and the best encoding and decoding times per sample"""
+    messages = encode(samples)
+    size = sum(len(message) for message in messages)
+    encode_secs = min(timeit.repeat(lambda: encode(samples), number=1, repeat=repeat))
+    decode_secs = min(
+        timeit.repeat(
+            lambda: [wire_format.decode_samples(message) for message in messages],
+            number=1,
+            repeat=repeat,
+        )
+    )
+    count = len(samples)
+    print(
+        f"{name:<18} {size / count:>12.1f} {encode_secs / count * 1e6:>12.2f} {decode_secs / count * 1e6:>12.2f}"
+    )
+
+
+def main() -> int:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    samples = make_samples(count)
+    print(f"{count} samples")
+    print(
+        f"{'format':<18} {'bytes/sample':>12} {'encode (us)':>12} {'decode (us)':>12}"
+    )
+    benchmark(
+        "json",
+        lambda samples: [wire_format.encode_json(sample) for sample in samples],
+        samples,
+    )
+    benchmark(
+        "binary",
+        lambda samples: [wire_format.encode_binary([sample]) for sample in samples],
+        samples,
+    )
+    benchmark(
+        "binary, batch 100",
+        lambda samples: [
+            wire_format.encode_binary(samples[i : i + 100])
+            for i in range(0, len(samples), 100)
+        ],
+        samples,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
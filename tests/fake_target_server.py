@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Concurrent HTTP server which plays the monitored targets of benchmarks, unlike
+http_server.py (one request at a time, random delays of up to 15 seconds).
+Every path is a target (e.g. /target/42), whose latency and HTTP status follow a
+profile (see PROFILES) and are drawn from a generator seeded by the path and the
+number of the request, so that runs with the same seed are reproducible
+Usage:
+    ./tests/fake_target_server.py [--port <port>] [--profile <profile>] [--seed <seed>]
+"""
+
+import argparse
+import asyncio
+import random
+import sys
+from aiohttp import web
+
+# Min. and max. latency (seconds) and weight of every HTTP status
+PROFILES = {
+    "fast": (0.001, 0.005, {200: 1}),
+    "mixed": (0.005, 0.2, {200: 90, 302: 4, 404: 3, 500: 3}),
+    "slow": (0.5, 3.0, {200: 95, 503: 5}),
+    "flaky": (0.05, 0.5, {200: 70, 500: 30}),
+}
+
+
+class Target_profile:
+    """Latency and HTTP status of the responses of every target"""
+
+    def __init__(self, profile: str = "mixed", seed: int = 0) -> None:
+        """Default constructor
+
+        Args:
+            profile (str, optional): Name of a profile of PROFILES. Defaults to "mixed".
+            seed (int, optional): Seed of the responses. Defaults to 0.
+
+        Properties:
+            requests (dict[str, int]): Number of requests of every path so far
+        """
+        self.min_latency, self.max_latency, weights = PROFILES[profile]
+        self.statuses = list(weights)
+        self.weights = list(weights.values())
+        self.seed = seed
+        self.requests = {}
+
+    def next_response(self, path: str) -> tuple[float, int]:
+        """Args:
+            path (str): Path of the request
+
+        Returns:
+            tuple[float, int]: Latency (seconds) and HTTP status of the next response
+            of `path`
+        """
+        count = self.requests.get(path, 0)
+        self.requests[path] = count + 1
+        generator = random.Random(f"{self.seed}:{path}:{count}")
+        latency = generator.uniform(self.min_latency, self.max_latency)
+        status = generator.choices(self.statuses, self.weights)[0]
+        return latency, status
+
+
+def create_app(profile: str = "mixed", seed: int = 0) -> web.Application:
+    """Returns:
+    web.Application: Application which answers every path as defined by `profile`
+    """
+    target_profile = Target_profile(profile, seed)
+
+    async def handle(request: web.Request) -> web.Response:
+        latency, status = target_profile.next_response(request.path)
+        await asyncio.sleep(latency)
+        return web.Response(
+            status=status,
+            text=f"<html><body>Target {request.path}: {status}</body></html>",
+            content_type="text/html",
+        )
+
+    app = web.Application()
+    app.router.add_route("*", "/{tail:.*}", handle)
+    return app
+
+
+def run_server(port: int = 8080, profile: str = "mixed", seed: int = 0) -> None:
+    """Serve until interrupted
+
+    Args:
+        port (int, optional): TCP port, on localhost. Defaults to 8080.
+        profile (str, optional): Name of a profile of PROFILES. Defaults to "mixed".
+        seed (int, optional): Seed of the responses. Defaults to 0.
+    """
+    # Big backlog, since agents open many connections at once
+    web.run_app(
+        create_app(profile, seed),
+        host="127.0.0.1",
+        port=port,
+        backlog=4096,
+        access_log=None,
+        print=None,
+    )
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--port", type=int, default=8080, help="(default: 8080)")
+    parser.add_argument(
+        "--profile", choices=sorted(PROFILES), default="mixed", help="(default: mixed)"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="(default: 0)")
+    arguments = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    run_server(arguments.port, arguments.profile, arguments.seed)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,379 @@
+"""Local stand-in of Kafka for benchmarks: a partitioned log served by a
+multiprocessing manager (see `start_bus()`), so that agents and sinks run in their own
+processes, and clients with the subset of the KafkaProducer and KafkaConsumer API used
+by Communication_manager (see `Local_bus_client`). Messages are keyed and partitioned
+like in Kafka, consumer groups keep committed offsets, and partitions are assigned
+statically to the members of a group
+"""
+
+import collections
+import kafka
+import multiprocessing
+import threading
+import time
+from multiprocessing import managers
+from homeworks import wire_format
+from homeworks.communication_manager import Communication_manager
+
+Record = collections.namedtuple("Record", ("offset", "value"))
+
+
+class Local_bus:
+    """Partitioned log of one topic, living in the manager process"""
+
+    def __init__(self, partitions: int) -> None:
+        """Default constructor
+
+        Args:
+            partitions (int): Number of partitions of the topic
+
+        Properties:
+            logs (list[list[bytes]]): Messages of every partition, their offset is their index
+            committed (dict[str, dict[int, int]]): Committed offsets of every group
+            stats (dict): Counters of produced messages and samples, and of stored rows
+            lag_counts (collections.Counter): Stored rows per end-to-end lag, in
+            hundredths of a second, see `record_stored()`
+        """
+        self.logs = [[] for _ in range(partitions)]
+        self.committed = {}
+        self.changed = threading.Condition()
+        self.stats = collections.Counter()
+        self.lag_counts = collections.Counter()
+
+    def get_partitions(self) -> int:
+        return len(self.logs)
+
+    def append(self, messages: list[tuple]) -> None:
+        """Args:
+        messages (list[tuple]): Partition, value and number of samples of every message
+        """
+        with self.changed:
+            for partition, value, samples in messages:
+                self.logs[partition].append(value)
+                self.stats["produced_messages"] += 1
+                self.stats["produced_samples"] += samples
+                self.stats["produced_bytes"] += len(value)
+            self.changed.notify_all()
+
+    def fetch(self, positions: dict, max_records: int, timeout_secs: float) -> tuple:
+        """Wait until some partition has messages after its position, or `timeout_secs`
+
+        Args:
+            positions (dict[int, int]): Next offset to fetch of every partition
+            max_records (int): Max. messages to return, from all partitions
+            timeout_secs (float): Max. time waiting for messages
+
+        Returns:
+            tuple[dict, dict]: Records (offset and value) and high watermark of every
+            partition of `positions`
+        """
+        deadline = time.monotonic() + timeout_secs
+        with self.changed:
+            while True:
+                records = {}
+                for partition, position in positions.items():
+                    values = self.logs[partition][position : position + max_records]
+                    if values:
+                        records[partition] = [
+                            (position + index, value)
+                            for index, value in enumerate(values)
+                        ]
+                        max_records -= len(values)
+                        if max_records <= 0:
+                            break
+                remaining = deadline - time.monotonic()
+                if records or remaining <= 0:
+                    return records, {
+                        partition: len(self.logs[partition]) for partition in positions
+                    }
+                self.changed.wait(remaining)
+
+    def commit(self, group: str, offsets: dict) -> None:
+        with self.changed:
+            self.committed.setdefault(group, {}).update(offsets)
+
+    def get_committed(self, group: str) -> dict:
+        with self.changed:
+            return dict(self.committed.get(group, {}))
+
+    def record_stored(self, rows: int, lag_counts: dict) -> None:
+        """Count rows stored by a sink
+
+        Args:
+            rows (int): Stored rows
+            lag_counts (dict[int, int]): Rows per end-to-end lag (from the time of the
+            sample until it was stored), in hundredths of a second
+        """
+        with self.changed:
+            self.stats["stored_rows"] += rows
+            self.stats["stored_batches"] += 1
+            self.lag_counts.update(lag_counts)
+
+    def get_stats(self) -> tuple[dict, dict]:
+        """Returns:
+        tuple[dict, dict]: Counters and lag counts (see `record_stored()`) so far
+        """
+        with self.changed:
+            return dict(self.stats), dict(self.lag_counts)
+
+
+class Local_bus_manager(managers.BaseManager):
+    """Serves one Local_bus to the processes of a benchmark"""
+
+
+def start_bus(partitions: int, authkey: bytes) -> Local_bus_manager:
+    """Start a manager process serving a new Local_bus
+
+    Args:
+        partitions (int): Number of partitions of the topic
+        authkey (bytes): Secret of the clients of the manager
+
+    Returns:
+        Local_bus_manager: Started manager, its `address` is needed by clients
+    """
+    bus = Local_bus(partitions)
+    Local_bus_manager.register("get_bus", callable=lambda: bus)
+    manager = Local_bus_manager(
+        address=("127.0.0.1", 0),
+        authkey=authkey,
+        ctx=multiprocessing.get_context("fork"),
+    )
+    manager.start()
+    return manager
+
+
+def connect_bus(address: tuple, authkey: bytes):
+    """Returns:
+    managers.BaseProxy: Proxy of the Local_bus served at `address`
+    """
+    Local_bus_manager.register("get_bus")
+    manager = Local_bus_manager(address=address, authkey=authkey)
+    manager.connect()
+    return manager.get_bus()
+
+
+class Local_future:
+    """Delivery of a message, like kafka.producer.future.FutureRecordMetadata"""
+
+    def __init__(self) -> None:
+        self.callbacks = []
+        self.errbacks = []
+        self.done = threading.Event()
+        self.exception = None
+
+    def add_callback(self, function, *args) -> None:
+        self.callbacks.append((function, args))
+
+    def add_errback(self, function, *args) -> None:
+        self.errbacks.append((function, args))
+
+    def resolve(self, exception: Exception = None) -> None:
+        self.exception = exception
+        self.done.set()
+        if exception is None:
+            for function, args in self.callbacks:
+                function(*args, None)
+        else:
+            for function, args in self.errbacks:
+                function(*args, exception)
+
+    def get(self, timeout: float = None):
+        if not self.done.wait(timeout):
+            raise kafka.errors.KafkaTimeoutError("Message not delivered yet")
+        if self.exception:
+            raise self.exception
+
+
+class Local_producer:
+    """Subset of kafka.KafkaProducer: messages are buffered and appended to the bus
+    every `linger_ms`, or when flushed
+    """
+
+    def __init__(self, bus, linger_ms: int) -> None:
+        self.bus = bus
+        self.partitions = list(range(bus.get_partitions()))
+        self.linger_secs = max(linger_ms, 5) / 1000
+        self.buffer = []
+        self.buffer_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.sender = threading.Thread(
+            target=self.run_sender, name="Local_producer", daemon=True
+        )
+        self.sender.start()
+
+    def partitions_for(self, topic: str) -> set[int]:
+        return set(self.partitions)
+
+    def send(self, topic: str, value: bytes, key: bytes = None) -> Local_future:
+        partition = wire_format.get_partition(key, self.partitions)
+        future = Local_future()
+        with self.buffer_lock:
+            self.buffer.append(
+                (partition, value, wire_format.count_samples(value), future)
+            )
+        return future
+
+    def flush(self, timeout: float = None) -> None:
+        with self.flush_lock:
+            with self.buffer_lock:
+                buffer, self.buffer = self.buffer, []
+            if not buffer:
+                return
+            try:
+                self.bus.append(
+                    [
+                        (partition, value, samples)
+                        for partition, value, samples, _ in buffer
+                    ]
+                )
+            except Exception as exception:
+                for message in buffer:
+                    message[3].resolve(exception)
+            else:
+                for message in buffer:
+                    message[3].resolve()
+
+    def run_sender(self) -> None:
+        while not self.closed.wait(self.linger_secs):
+            self.flush()
+
+    def close(self) -> None:
+        self.closed.set()
+        self.flush()
+
+
+class Local_consumer:
+    """Subset of kafka.KafkaConsumer, for one member of a consumer group whose members
+    own partitions statically (partition % members == member)
+    """
+
+    def __init__(self, bus, topic: str, group: str, member: int, members: int) -> None:
+        self.bus = bus
+        self.topic = topic
+        self.group = group
+        self.owned = [
+            kafka.TopicPartition(topic, partition)
+            for partition in range(bus.get_partitions())
+            if partition % members == member
+        ]
+        self.assigned = []
+        self.positions = {}
+        self.highwaters = {}
+        self.paused_partitions = set()
+        self.listener = None
+
+    def subscribe(self, topics: list[str], listener=None) -> None:
+        # Like in Kafka, partitions are assigned during the first poll
+        self.listener = listener
+
+    def assign_partitions(self) -> None:
+        committed = self.bus.get_committed(self.group)
+        self.assigned = list(self.owned)
+        self.positions = {
+            topic_partition: committed.get(topic_partition.partition, 0)
+            for topic_partition in self.assigned
+        }
+        if self.listener:
+            self.listener.on_partitions_assigned(set(self.assigned))
+
+    def poll(self, timeout_ms: int = 0, max_records: int = None) -> dict:
+        if not self.assigned:
+            self.assign_partitions()
+        positions = {
+            topic_partition.partition: position
+            for topic_partition, position in self.positions.items()
+            if topic_partition not in self.paused_partitions
+        }
+        if not positions:
+            time.sleep(timeout_ms / 1000)
+            return {}
+        records, highwaters = self.bus.fetch(
+            positions, max_records or 500, timeout_ms / 1000
+        )
+        result = {}
+        for partition, highwater in highwaters.items():
+            self.highwaters[kafka.TopicPartition(self.topic, partition)] = highwater
+        for partition, partition_records in records.items():
+            topic_partition = kafka.TopicPartition(self.topic, partition)
+            result[topic_partition] = [Record(*record) for record in partition_records]
+            self.positions[topic_partition] = partition_records[-1][0] + 1
+        return result
+
+    def assignment(self) -> set:
+        return set(self.assigned)
+
+    def highwater(self, topic_partition: kafka.TopicPartition) -> int:
+        return self.highwaters.get(topic_partition)
+
+    def position(self, topic_partition: kafka.TopicPartition) -> int:
+        return self.positions[topic_partition]
+
+    def seek(self, topic_partition: kafka.TopicPartition, offset: int) -> None:
+        self.positions[topic_partition] = offset
+
+    def pause(self, *topic_partitions) -> None:
+        self.paused_partitions.update(topic_partitions)
+
+    def resume(self, *topic_partitions) -> None:
+        self.paused_partitions.difference_update(topic_partitions)
+
+    def paused(self) -> set:
+        return set(self.paused_partitions)
+
+    def commit(self, offsets: dict = None) -> None:
+        if offsets is None:
+            committed = {
+                topic_partition.partition: position
+                for topic_partition, position in self.positions.items()
+            }
+        else:
+            committed = {
+                topic_partition.partition: offset_and_metadata.offset
+                for topic_partition, offset_and_metadata in offsets.items()
+            }
+        self.bus.commit(self.group, committed)
+
+    def close(self, autocommit: bool = True) -> None:
+        pass
+
+
+class Local_bus_client(Communication_manager):
+    """Communication_manager whose producer and consumer use a Local_bus instead of
+    Kafka, everything else (encoding, batching, offsets) is unchanged
+    """
+
+    def __init__(
+        self, address: tuple, authkey: bytes, member: int = 0, members: int = 1
+    ) -> None:
+        """Default constructor
+
+        Args:
+            address (tuple): Address of the Local_bus_manager, see `start_bus()`
+            authkey (bytes): Secret of the manager
+            member (int, optional): Index of this consumer in its group. Defaults to 0.
+            members (int, optional): Number of consumers of the group. Defaults to 1.
+        """
+        super().__init__()
+        self.bus = connect_bus(address, authkey)
+        self.member = member
+        self.members = members
+
+    def connect_producer(self) -> None:
+        if not self.kafka_producer:
+            self.kafka_producer = Local_producer(
+                self.bus, self.kafka_producer_settings["linger_ms"]
+            )
+
+    def connect_consumer(self, rebalance_listener=None) -> None:
+        if not self.kafka_consumer:
+            self.kafka_consumer = Local_consumer(
+                self.bus,
+                self.kafka_topic_name,
+                self.kafka_consumer_group,
+                self.member,
+                self.members,
+            )
+            self.kafka_consumer.subscribe(
+                [self.kafka_topic_name], listener=rebalance_listener
+            )
@@ -0,0 +1,1111 @@
+"""Validate the building blocks of our web-monitoring application which
+don't need any external service (neither Kafka nor Postgres)
+"""
+
+import asyncio
+import collections
+import datetime
+import kafka
+import pytest
+import queue
+import re
+import signal
+import struct
+import threading
+import time
+import types
+import unittest.mock
+from aiohttp import test_utils, web
+from homeworks.agent_supervisor import Agent_supervisor
+from homeworks.batch_window import Batch_window
+from homeworks.circuit_breaker import Circuit_breaker
+from homeworks.communication_manager import Communication_manager
+from homeworks.deadline_scheduler import Deadline_scheduler
+from homeworks.disk_spool import Disk_spool
+from homeworks.hash_ring import Hash_ring
+from homeworks.metrics_publisher import Metrics_publisher
+from homeworks.phase_timer import Phase_timer, create_trace_config
+from homeworks.probe_engine import Probe_engine
+from homeworks.probe_spec import Probe_spec, load_probe_specs
+from homeworks.sink_pipeline import Batch_flusher, Sink_pipeline
+from homeworks.store_manager import (
+    Store_manager,
+    estimate_percentile,
+    select_latest_metrics,
+)
+from homeworks.stream_matcher import Stream_matcher
+from homeworks import phase_timer
+from homeworks import wire_format
+
+
+def test_deadline_scheduler_does_not_drift():
+    """Validate that next deadlines are computed from previous deadlines, not from the time they were popped"""
+    scheduler = Deadline_scheduler(clock=lambda: 0.0)
+    scheduler.add("http://a", 10, first_deadline=5.0)
+    scheduler.add("http://b", 4, first_deadline=1.0)
+
+    assert scheduler.pop_due(now=3.0) == [("http://b", 1.0)]
+    # Popped late (by 2.5 seconds), but next deadline keeps the phase
+    assert scheduler.pop_due(now=7.5) == [("http://a", 5.0), ("http://b", 5.0)]
+    assert scheduler.next_deadline() == 9.0
+
+
+def test_deadline_scheduler_skips_missed_deadlines_and_removed_keys():
+    """Validate that a key late by several intervals fires once, and that removed keys never fire"""
+    scheduler = Deadline_scheduler(clock=lambda: 0.0)
+    scheduler.add("http://a", 10, first_deadline=0.0)
+    scheduler.add("http://b", 10, first_deadline=0.0)
+    scheduler.remove("http://b")
+
+    assert scheduler.pop_due(now=35.0) == [("http://a", 0.0)]
+    assert scheduler.next_deadline() == 40.0
+    assert "http://b" not in scheduler
+    assert len(scheduler) == 1
+
+
+def test_deadline_scheduler_spreads_first_deadlines():
+    """Validate that first deadlines are spread within one interval"""
+    scheduler = Deadline_scheduler(jitter_ratio=1.0, clock=lambda: 100.0)
+    for i in range(100):
+        scheduler.add(i, 60)
+    deadlines = [entry[1] for entry in scheduler.entries.values()]
+
+    assert all(100.0 <= deadline <= 160.0 for deadline in deadlines)
+    assert len(set(deadlines)) > 1
+
+
+def test_hash_ring_moves_few_keys_when_adding_a_node():
+    """Validate that adding a 5th node to the ring only moves about 1/5 of keys, all of them to the new node"""
+    keys = [f"http://example{i}.com" for i in range(2000)]
+    ring = Hash_ring([f"worker-{i}" for i in range(4)])
+    before = {key: ring.get_node(key) for key in keys}
+    ring.add_node("worker-4")
+    moved = [key for key in keys if ring.get_node(key) != before[key]]
+
+    assert all(ring.get_node(key) == "worker-4" for key in moved)
+    assert 0.1 < len(moved) / len(keys) < 0.3
+    assert sorted(
+        sum((ring.get_shard(f"worker-{i}", keys) for i in range(5)), [])
+    ) == sorted(keys)
+
+
+def test_stream_matcher_finds_matches_spanning_chunks():
+    """Validate that a match split across two chunks (and a split multi-byte character) is found"""
+    matcher = Stream_matcher(re.compile("héllo world"), max_bytes=1000)
+    body = "<html>héllo world</html>".encode("utf-8")
+
+    assert not matcher.feed(body[:8])
+    assert matcher.feed(body[8:])
+    assert matcher.close()
+    assert not matcher.truncated
+
+
+def test_stream_matcher_stops_at_byte_cap():
+    """Validate that bytes beyond the cap are never inspected"""
+    matcher = Stream_matcher(re.compile("needle"), max_bytes=10)
+
+    assert not matcher.feed(b"0123456789")
+    assert matcher.feed(b"needle")
+    assert not matcher.close()
+    assert matcher.truncated
+    assert matcher.bytes_read == 10
+
+
+async def run_trace_hooks(trace_config, timer: Phase_timer, hooks: list[str]) -> None:
+    """Fire the aiohttp tracing hooks of `trace_config` in the given order"""
+    context = types.SimpleNamespace(trace_request_ctx=timer)
+    for hook in hooks:
+        for callback in getattr(trace_config, hook):
+            await callback(None, context, None)
+
+
+def test_phase_timer_fills_phases_of_new_and_pooled_connections(monkeypatch):
+    """Validate that the tracing hooks time DNS, connect (without DNS), TTFB and transfer, and that a reused connection has no DNS nor connect times"""
+    times = [0.0, 0.002, 0.012, 0.052, 0.152]
+    monkeypatch.setattr(phase_timer, "_now", lambda: times.pop(0))
+    trace_config = create_trace_config()
+    timer = Phase_timer()
+    asyncio.run(
+        run_trace_hooks(
+            trace_config,
+            timer,
+            [
+                "on_connection_create_start",
+                "on_dns_resolvehost_start",
+                "on_dns_resolvehost_end",
+                "on_connection_create_end",
+                "on_request_end",
+            ],
+        )
+    )
+    timer.body_end = 0.202
+    sample = {}
+    timer.to_sample(sample)
+
+    assert sample == pytest.approx(
+        {
+            "dns_time": 0.01,
+            "connect_time": 0.042,
+            "ttfb_time": 0.1,
+            "transfer_time": 0.05,
+        }
+    )
+
+    # Next request of the same URL reuses the pooled connection
+    times.extend([1.0, 1.08])
+    timer = Phase_timer()
+    asyncio.run(
+        run_trace_hooks(
+            trace_config, timer, ["on_connection_reuseconn", "on_request_end"]
+        )
+    )
+    timer.body_end = 1.09
+    timer.to_sample(sample)
+
+    assert sample["dns_time"] is None and sample["connect_time"] is None
+    assert sample["ttfb_time"] == pytest.approx(0.08)
+    assert sample["transfer_time"] == pytest.approx(0.01)
+
+
+def test_probe_specs_are_loaded_from_bare_urls_and_json_lines(tmp_path):
+    """Validate that both formats of the targets file are accepted and identical regexes share their compiled pattern"""
+    targets_file = tmp_path / "targets.txt"
+    targets_file.write_text(
+        "# Comments and empty lines are ignored\n"
+        "\n"
+        "http://a.com\n"
+        '{"url": "http://b.com", "interval": 30, "method": "head", "expected_status": 200, "headers": {"Accept": "text/html"}}\n'
+        "http://a.com\n"
+    )
+    defaults = {"interval": 60, "timeout": 15, "regex": "Welcome"}
+    specs = load_probe_specs(str(targets_file), defaults)
+
+    assert [spec.url for spec in specs] == ["http://a.com", "http://b.com"]
+    assert specs[0] == Probe_spec("http://a.com", 60, 15, regex="Welcome")
+    assert specs[1].interval == 30.0
+    assert specs[1].method == "HEAD"
+    assert specs[1].expected_status == (200,)
+    assert specs[1].headers == (("Accept", "text/html"),)
+    assert specs[0].regex_pattern is specs[1].regex_pattern
+
+
+def test_probe_specs_reject_unknown_keys(tmp_path):
+    """Validate that a typo in the targets file is reported with its line number"""
+    targets_file = tmp_path / "targets.txt"
+    targets_file.write_text('{"url": "http://a.com", "intreval": 30}\n')
+
+    with pytest.raises(ValueError, match="line 1"):
+        load_probe_specs(str(targets_file), {"interval": 60, "timeout": 15})
+
+
+@pytest.mark.parametrize(
+    "target",
+    [
+        '{"url": "http://a.com", "interval": 0}',
+        '{"url": "http://a.com", "interval": -30}',
+        '{"url": "http://a.com", "timeout": 0}',
+        '{"url": "http://a.com", "expected_status": "200"}',
+        '{"url": "http://a.com", "expected_status": [200, "302"]}',
+        '{"url": "http://a.com", "expected_status": true}',
+    ],
+)
+def test_probe_specs_reject_invalid_values(tmp_path, target):
+    """Validate that a non-positive interval or timeout and a non-integer expected status are reported with their line number"""
+    targets_file = tmp_path / "targets.txt"
+    targets_file.write_text(f"http://b.com\n{target}\n")
+
+    with pytest.raises(ValueError, match="line 2"):
+        load_probe_specs(str(targets_file), {"interval": 60, "timeout": 15})
+
+
+def test_probe_engine_reload_only_touches_changed_targets():
+    """Validate that reloading targets keeps the deadlines of unchanged URLs"""
+    engine = Probe_engine(
+        [Probe_spec("http://a.com", 60, 15), Probe_spec("http://b.com", 60, 15)]
+    )
+    engine.scheduler.add("http://a.com", 60, first_deadline=10.0)
+    engine.scheduler.add("http://b.com", 60, first_deadline=20.0)
+    engine.update_specs(
+        [Probe_spec("http://a.com", 60, 15), Probe_spec("http://c.com", 30, 15)]
+    )
+
+    assert sorted(engine.specs) == ["http://a.com", "http://c.com"]
+    assert sorted(engine.samples) == ["http://a.com", "http://c.com"]
+    assert "http://b.com" not in engine.scheduler
+    assert engine.scheduler.entries["http://a.com"][1] == 10.0
+    assert engine.scheduler.entries["http://c.com"][0] == 30
+
+
+def test_probe_engine_reload_rejects_invalid_targets_as_a_whole():
+    """Validate that a new list of targets with an invalid interval is not applied at all, not even its valid specs"""
+    engine = Probe_engine([Probe_spec("http://a.com", 60, 15)])
+    engine.scheduler.add("http://a.com", 60, first_deadline=10.0)
+
+    with pytest.raises(ValueError, match="http://c.com"):
+        engine.update_specs(
+            [Probe_spec("http://b.com", 30, 15), Probe_spec("http://c.com", 0, 15)]
+        )
+
+    assert sorted(engine.specs) == ["http://a.com"]
+    assert sorted(engine.samples) == ["http://a.com"]
+    assert sorted(engine.scheduler.entries) == ["http://a.com"]
+
+
+def test_circuit_breaker_backs_off_until_host_recovers():
+    """Validate that the circuit opens after N failures, allows one trial probe per cool-down (doubling it) and closes on success"""
+    now = [0.0]
+    breaker = Circuit_breaker("a.com", 3, 10, 25, clock=lambda: now[0])
+    for _ in range(3):
+        assert breaker.allow_probe()
+        breaker.record_failure()
+    assert breaker.state == Circuit_breaker.OPEN
+    assert not breaker.allow_probe()
+
+    now[0] = 10.0
+    assert breaker.allow_probe()
+    assert breaker.state == Circuit_breaker.HALF_OPEN
+    assert not breaker.allow_probe()  # Only one trial probe
+    breaker.record_failure()
+    assert breaker.open_until == 30.0
+
+    now[0] = 30.0
+    assert breaker.allow_probe()
+    breaker.record_failure()
+    assert breaker.open_until == 55.0  # Cool-down is limited to 25 seconds
+
+    now[0] = 55.0
+    assert breaker.allow_probe()
+    breaker.record_success()
+    assert breaker.state == Circuit_breaker.CLOSED
+    assert breaker.consecutive_failures == 0
+
+
+class Fake_publisher:
+    """Metrics_publisher stand-in, which keeps the published samples"""
+
+    def __init__(self) -> None:
+        self.published = []
+
+    def publish(self, sample: dict) -> None:
+        self.published.append(dict(sample))
+
+
+def test_probe_engine_probes_a_local_server():
+    """Validate that the engine fires every URL of a local HTTP server repeatedly and publishes its status, regex match and phase times, over a pooled connection after the first probe"""
+
+    async def handle(request: web.Request) -> web.Response:
+        if request.path == "/missing":
+            raise web.HTTPNotFound()
+        return web.Response(text="<html>Welcome</html>", content_type="text/html")
+
+    async def run_engine() -> None:
+        app = web.Application()
+        app.router.add_get("/{tail:.*}", handle)
+        server = test_utils.TestServer(app)
+        await server.start_server()
+        engine.update_specs(
+            [
+                Probe_spec(str(server.make_url(path)), 0.1, 5, regex="Welcome")
+                for path in ("/ok", "/missing")
+            ]
+        )
+        engine_task = asyncio.create_task(engine.run_async())
+        try:
+            for _ in range(100):
+                await asyncio.sleep(0.05)
+                if len(engine.publisher.published) >= 6:
+                    break
+        finally:
+            engine_task.cancel()
+            await server.close()
+
+    engine = Probe_engine([])
+    engine.reload_secs = 0
+    engine.publisher = Fake_publisher()
+    asyncio.run(run_engine())
+
+    samples = {}
+    for sample in engine.publisher.published:
+        samples.setdefault(sample["web_url"].rsplit("/", 1)[1], []).append(sample)
+    assert len(samples["ok"]) >= 2 and len(samples["missing"]) >= 2
+    assert all(sample["http_status"] == 200 for sample in samples["ok"])
+    assert all(sample["regex_match"] for sample in samples["ok"])
+    assert all(sample["http_status"] == 404 for sample in samples["missing"])
+    assert all(sample["resp_time"] > 0 for sample in engine.publisher.published)
+    # Both URLs share the connections of their host
+    published = engine.publisher.published
+    assert published[0]["connect_time"] is not None
+    assert all(sample["connect_time"] is None for sample in published[-2:])
+    assert all(sample["ttfb_time"] > 0 for sample in published)
+
+
+def test_cold_targets_do_not_use_the_shared_connection_pool():
+    """Validate that every probe of a cold target opens its own connection, while the rest of targets reuse the pooled connection of their host"""
+    client_ports = collections.defaultdict(list)
+
+    async def handle(request: web.Request) -> web.Response:
+        client_ports[request.path].append(
+            request.transport.get_extra_info("peername")[1]
+        )
+        return web.Response(text="OK")
+
+    async def probe_three_times() -> None:
+        app = web.Application()
+        app.router.add_get("/{tail:.*}", handle)
+        server = test_utils.TestServer(app)
+        await server.start_server()
+        specs = [
+            Probe_spec(str(server.make_url("/warm")), 60, 5),
+            Probe_spec(str(server.make_url("/cold")), 60, 5, cold_connection=True),
+        ]
+        engine.update_specs(specs)
+        try:
+            async with engine.create_session() as session:
+                for _ in range(3):
+                    for spec in specs:
+                        await engine.probe(
+                            session,
+                            asyncio.Semaphore(1),
+                            spec,
+                            engine.samples[spec.url],
+                            0.0,
+                        )
+        finally:
+            await server.close()
+
+    engine = Probe_engine([])
+    engine.publisher = Fake_publisher()
+    asyncio.run(probe_three_times())
+
+    assert len(set(client_ports["/warm"])) == 1
+    assert len(set(client_ports["/cold"])) == 3
+    cold_samples = [
+        sample
+        for sample in engine.publisher.published
+        if sample["web_url"].endswith("/cold")
+    ]
+    assert len(cold_samples) == 3
+    assert all(sample["connect_time"] is not None for sample in cold_samples)
+
+
+def test_failed_probe_does_not_publish_results_of_the_previous_one():
+    """Validate that a probe which times out after a successful one publishes no status, regex or body results of the first probe, but its own response time"""
+    requests = []
+
+    async def handle(request: web.Request) -> web.Response:
+        requests.append(request.path)
+        if len(requests) > 1:
+            await asyncio.sleep(1)
+        return web.Response(text="<html>Welcome</html>", content_type="text/html")
+
+    async def probe_twice() -> None:
+        app = web.Application()
+        app.router.add_get("/{tail:.*}", handle)
+        server = test_utils.TestServer(app)
+        await server.start_server()
+        spec = Probe_spec(
+            str(server.make_url("/ok")),
+            60,
+            0.2,
+            expected_status=(200,),
+            regex="Welcome",
+        )
+        engine.update_specs([spec])
+        try:
+            async with engine.create_session() as session:
+                for _ in range(2):
+                    await engine.probe(
+                        session,
+                        asyncio.Semaphore(1),
+                        spec,
+                        engine.samples[spec.url],
+                        0.0,
+                    )
+        finally:
+            await server.close()
+
+    engine = Probe_engine([])
+    engine.publisher = Fake_publisher()
+    asyncio.run(probe_twice())
+
+    first, second = engine.publisher.published
+    assert (
+        first["http_status"] == 200 and first["status_match"] and first["regex_match"]
+    )
+    assert first["body_cap"] == engine.max_body_bytes
+    assert second["http_status"] == 504
+    assert second["status_match"] is False
+    assert second["regex_match"] is None
+    assert second["body_cap"] is None and second["body_truncated"] is None
+    assert 0.2 <= second["resp_time"] < 1
+    assert second["ttfb_time"] is None
+
+
+def test_failed_or_cancelled_trial_probe_does_not_leave_circuit_half_open():
+    """Validate that a trial probe which raises an unexpected error is published and opens the circuit again, and that a cancelled one lets the next deadline try again"""
+    now = [0.0]
+    engine = Probe_engine([Probe_spec("http://a.com", 60, 15)])
+    engine.scheduler.clock = lambda: now[0]
+    engine.publisher = Fake_publisher()
+    spec = engine.specs["http://a.com"]
+    breaker = engine.get_breaker(spec.host)
+    for _ in range(engine.breaker_failures):
+        breaker.record_failure()
+    now[0] = breaker.open_until
+    assert breaker.allow_probe()
+
+    async def fail_to_decode(session, spec, sample, timeout):
+        raise UnicodeDecodeError("utf-8", b"\xff", 0, 1, "invalid start byte")
+
+    engine.monitor_one_url = fail_to_decode
+    asyncio.run(
+        engine.probe(None, asyncio.Semaphore(1), spec, engine.samples[spec.url], 0.0)
+    )
+    assert breaker.state == Circuit_breaker.OPEN
+    assert engine.publisher.published[-1]["http_status"] == 500
+    assert engine.publisher.published[-1]["breaker_state"] == Circuit_breaker.HALF_OPEN
+
+    async def hang(session, spec, sample, timeout):
+        await asyncio.sleep(60)
+
+    async def cancel_trial_probe():
+        task = asyncio.create_task(
+            engine.probe(
+                None, asyncio.Semaphore(1), spec, engine.samples[spec.url], 0.0
+            )
+        )
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    engine.monitor_one_url = hang
+    now[0] = breaker.open_until
+    assert breaker.allow_probe()
+    asyncio.run(cancel_trial_probe())
+    assert breaker.state == Circuit_breaker.OPEN
+    assert len(engine.publisher.published) == 1
+    assert breaker.allow_probe()
+    assert breaker.state == Circuit_breaker.HALF_OPEN
+
+
+def test_disk_spool_replays_in_order_and_survives_restarts(tmp_path):
+    """Validate that spooled messages are read oldest first, only removed once committed, and recovered by a new instance"""
+    spool = Disk_spool(str(tmp_path), max_bytes=1024, segment_bytes=20)
+    for i in range(5):
+        spool.append(f"message-{i}".encode())
+    assert spool.depth == 5
+
+    assert spool.peek(2) == [b"message-0", b"message-1"]
+    spool.commit()
+    spool.close()
+
+    spool = Disk_spool(str(tmp_path), max_bytes=1024, segment_bytes=20)
+    assert spool.depth == 3
+    assert spool.peek(10) == [b"message-2", b"message-3", b"message-4"]
+    spool.commit()
+    assert spool.depth == 0
+    spool.append(b"message-5")
+    assert spool.peek(10) == [b"message-5"]
+
+
+def test_disk_spool_drops_oldest_segment_when_full(tmp_path):
+    """Validate that the spool size is bounded by dropping its oldest messages"""
+    spool = Disk_spool(str(tmp_path), max_bytes=40, segment_bytes=13)
+    for i in range(6):
+        spool.append(f"message-{i}".encode())  # 13 bytes per record
+
+    assert spool.size_bytes <= 40
+    assert spool.peek(10) == [b"message-3", b"message-4", b"message-5"]
+
+
+def test_disk_spool_smaller_than_a_segment_stays_bounded(tmp_path):
+    """Validate that a spool whose max. size is smaller than its segments never grows over it, since the active segment is rotated at the max. size"""
+    spool = Disk_spool(str(tmp_path), max_bytes=30)
+    for i in range(6):
+        spool.append(f"message-{i}".encode())  # 13 bytes per record
+        file_bytes = sum(path.stat().st_size for path in tmp_path.glob("*.spool"))
+        assert spool.size_bytes == file_bytes <= 30
+
+    assert spool.peek(10) == [b"message-4", b"message-5"]
+
+
+def test_disk_spool_size_counts_whole_segments_and_keeps_replay_in_flight(tmp_path):
+    """Validate that the spool size matches its segment files after a restart in the middle of a segment, and that dropping a segment while a replay is in flight doesn't replay its messages twice"""
+
+    def get_file_bytes(spool: Disk_spool) -> int:
+        return sum(path.stat().st_size for path in tmp_path.glob("*.spool"))
+
+    spool = Disk_spool(str(tmp_path), max_bytes=1024, segment_bytes=26)
+    for i in range(6):
+        spool.append(f"message-{i}".encode())  # 2 records of 13 bytes per segment
+    spool.peek(1)
+    spool.commit()
+    spool.close()
+
+    spool = Disk_spool(str(tmp_path), max_bytes=65, segment_bytes=26)
+    assert spool.size_bytes == get_file_bytes(spool) == 78
+    assert spool.peek(2) == [b"message-1", b"message-2"]
+    spool.commit()
+    assert spool.size_bytes == get_file_bytes(spool) == 52
+
+    # Replay of message-3 and message-4 in flight, while the oldest segment is dropped
+    assert spool.peek(2) == [b"message-3", b"message-4"]
+    for i in range(6, 8):
+        spool.append(f"message-{i}".encode())
+    assert spool.size_bytes == get_file_bytes(spool) == 52
+    spool.commit()
+    assert spool.peek(10) == [b"message-5", b"message-6", b"message-7"]
+    assert spool.depth == 3
+
+
+def test_publisher_never_writes_to_disk_from_probes(tmp_path):
+    """Validate that samples published while the queue is full are spooled by the publisher thread, not by the caller"""
+    publisher = Metrics_publisher(str(tmp_path))
+    publisher.pending = queue.Queue(1)
+    samples = Probe_engine.initialize_sampling_data(["http://a.com", "http://b.com"])
+    for sample in samples:
+        sample.update(time=1621170000000000000, http_status=200, resp_time=0.1)
+        publisher.publish(sample)
+
+    assert publisher.pending.qsize() == 1
+    assert publisher.spool.depth == 0
+    publisher.spool_overflow()
+    assert publisher.spool.depth == 1
+    assert wire_format.decode_samples(publisher.spool.peek(1)[0])[0]["web_url"] == (
+        "http://b.com"
+    )
+
+
+def test_wire_format_round_trip_and_detection():
+    """Validate that a binary batch decodes to the same samples, and that JSON messages are still accepted"""
+    sample = Probe_engine.initialize_sampling_data(["https://example.com/ü"])[0]
+    sample.update(time=1621170000123456789, http_status=200, resp_time=0.25)
+    sample.update(regex_match=False, breaker_state="half_open", dns_time=0.004)
+    other_sample = dict(sample, web_url="http://b", body_truncated=True, body_cap=10)
+
+    message = wire_format.encode_samples([sample, other_sample], "binary")
+    decoded = wire_format.decode_samples(message)
+
+    assert [decoded_sample["web_url"] for decoded_sample in decoded] == [
+        "https://example.com/ü",
+        "http://b",
+    ]
+    assert decoded[0]["time"].isoformat() == "2021-05-16T13:00:00.123456+00:00"
+    assert {**decoded[0], "time": sample["time"]} == sample
+    assert decoded[1]["body_truncated"] is True and decoded[1]["body_cap"] == 10
+
+    assert wire_format.message_key(message) == "https://example.com/ü".encode()
+    json_message = wire_format.encode_samples([sample], "json")
+    assert wire_format.decode_samples(json_message)[0]["web_url"] == sample["web_url"]
+    assert wire_format.message_key(json_message) == wire_format.message_key(message)
+    with pytest.raises(ValueError):
+        wire_format.decode_samples(b"\x09\x00\x01")
+
+
+class Fake_producer:
+    """kafka.KafkaProducer stand-in, which keeps the keys of the sent messages"""
+
+    def __init__(self) -> None:
+        self.keys = []
+
+    def send(self, topic: str, value: bytes, key: bytes = None):
+        self.keys.append(key)
+        return unittest.mock.Mock()
+
+    def flush(self, timeout: float = None) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+def test_messages_of_the_same_url_go_to_the_same_partition():
+    """Validate that messages are keyed by web_url, whatever their format and time, so that Kafka puts all samples of a URL in the same partition"""
+    sender = Communication_manager()
+    sender.kafka_producer = Fake_producer()
+    partitions = list(range(6))
+    urls = [f"https://www.example{i}.com/health" for i in range(50)]
+    samples = Probe_engine.initialize_sampling_data(urls)
+    # Keys are taken from the samples, messages are not parsed again
+    with unittest.mock.patch.object(
+        wire_format, "message_key", side_effect=AssertionError
+    ):
+        for message_format in ("json", "binary"):
+            sender.kafka_wire_format = message_format
+            for time_ns in (1621170000000000000, 1621170060000000000):
+                for sample in samples:
+                    sender.produce_message(dict(sample, time=time_ns, http_status=200))
+
+    assert sender.kafka_producer.keys[: len(urls)] == [url.encode() for url in urls]
+    url_partitions = {}
+    for url, key in zip(urls * 4, sender.kafka_producer.keys):
+        url_partitions.setdefault(url, set()).add(
+            wire_format.get_partition(key, partitions)
+        )
+    assert all(len(used) == 1 for used in url_partitions.values())
+    # URLs are spread over all partitions
+    assert set.union(*url_partitions.values()) == set(partitions)
+
+
+def test_consumer_without_group_takes_all_partitions_from_their_stored_offsets():
+    """Validate that, without consumer group, the consumer is assigned all partitions of the topic and the rebalance listener is notified of them, so that it seeks to their stored offsets"""
+    retriever = Communication_manager()
+    retriever.kafka_consumer_group = None
+    listener = unittest.mock.Mock()
+    with unittest.mock.patch("kafka.KafkaConsumer") as consumer_class:
+        consumer_class.return_value.partitions_for_topic.return_value = {2, 0, 1}
+        retriever.connect_consumer(rebalance_listener=listener)
+
+    consumer = consumer_class.return_value
+    assert consumer_class.call_args.kwargs["group_id"] is None
+    assigned = [
+        kafka.TopicPartition(retriever.kafka_topic_name, partition)
+        for partition in range(3)
+    ]
+    consumer.subscribe.assert_not_called()
+    consumer.assign.assert_called_once_with(assigned)
+    listener.on_partitions_assigned.assert_called_once_with(assigned)
+
+
+def test_publisher_keys_every_message_by_its_first_sample(tmp_path):
+    """Validate that the publisher keys every encoded message by the URL of its first sample, the same key that is read back from spooled messages"""
+    sender = types.SimpleNamespace(kafka_wire_format="binary", kafka_topic_partitions=3)
+    publisher = Metrics_publisher(str(tmp_path), metrics_sender=sender)
+    publisher.batch_samples = 4
+    urls = [f"https://www.example{i % 10}.com/health" for i in range(30)]
+    samples = [
+        dict(sample, time=1621170000000000000, http_status=200)
+        for sample in Probe_engine.initialize_sampling_data(urls)
+    ]
+
+    for message_format in ("json", "binary"):
+        publisher.metrics_sender.kafka_wire_format = message_format
+        keyed_messages = publisher.encode_messages(samples)
+        assert all(
+            key == wire_format.message_key(message) for key, message in keyed_messages
+        )
+    publisher.spool.close()
+
+
+class Fake_retriever:
+    """Communication_manager stand-in, which returns predefined batches"""
+
+    kafka_topic_name = "metrics"
+
+    def __init__(self, batches: list[tuple]) -> None:
+        self.batches = list(batches)
+        self.seeked = {}
+        self.last_batch_offsets = {}
+        self.committed = {}
+        self.paused = 0
+
+    def connect_consumer(self, rebalance_listener=None) -> None:
+        self.rebalance_listener = rebalance_listener
+
+    def consume_messages(self) -> list[dict]:
+        if not self.batches:
+            raise EOFError("No more batches")
+        messages, self.last_batch_offsets = self.batches.pop(0)
+        self.last_batch_report = {"rows": len(messages), "reason": "rows"}
+        return messages
+
+    def poll_messages(self, timeout_ms: int, max_rows: int = None) -> int:
+        return 0
+
+    def take_consumed_messages(self) -> list[dict]:
+        return []
+
+    def seek_consumer(self, offsets: dict) -> None:
+        self.seeked.update(offsets)
+
+    def pause_consumer(self) -> None:
+        self.paused += 1
+
+    def resume_consumer(self) -> None:
+        pass
+
+    def commit_consumed_messages(self, offsets: dict = None) -> None:
+        self.committed.update(offsets)
+
+
+class Slow_inserter:
+    """Store_manager stand-in, slower than the consumer"""
+
+    def __init__(self) -> None:
+        self.stored = []
+        self.stored_offsets = {}
+
+    def insert_metrics_batch(self, metrics: list[dict], offsets: dict = None) -> None:
+        time.sleep(0.05)
+        self.stored.extend(metrics)
+        self.stored_offsets.update(
+            {partition: offset for (topic, partition), offset in offsets.items()}
+        )
+
+    def get_stored_offsets(self, topic: str) -> dict[int, int]:
+        return dict(self.stored_offsets)
+
+
+def test_sink_pipeline_stores_in_order_and_commits_stored_offsets():
+    """Validate that batches are stored in order, that the consumer is paused while the writer falls behind, and that offsets of all stored batches are committed"""
+    retriever = Fake_retriever(
+        [([{"n": n}], {("metrics", n % 2): n + 1}) for n in range(6)]
+    )
+    inserter = Slow_inserter()
+    pipeline = Sink_pipeline(retriever, inserter, queue_batches=1)
+
+    with pytest.raises(RuntimeError):
+        pipeline.run()
+
+    assert [message["n"] for message in inserter.stored] == list(range(6))
+    assert retriever.committed == {("metrics", 0): 5, ("metrics", 1): 6}
+    assert inserter.stored_offsets == {0: 5, 1: 6}
+    assert retriever.paused > 0
+    stats = pipeline.get_stats()
+    assert stats["batches"] == 6 and stats["messages"] == 6
+    assert stats["flush_reasons"] == {"rows": 6}
+    assert isinstance(pipeline.consumer_error, EOFError)
+
+
+def test_store_manager_encodes_binary_copy_rows():
+    """Validate the PostgreSQL binary COPY data of metrics decoded from both wire formats"""
+    metrics = [
+        {
+            "time": datetime.datetime(
+                2000, 1, 1, 0, 0, 1, tzinfo=datetime.timezone.utc
+            ),
+            "web_url": "http://a",
+            "http_status": 200,
+            "resp_time": 0.5,
+            "regex_match": True,
+            "dns_time": 0.25,
+            "connect_time": None,
+            "ttfb_time": None,
+            "transfer_time": None,
+        },
+        # Message of an older agent, in JSON format and without phase timings
+        {
+            "time": "2000-01-01 02:00:00.000002+0200",
+            "web_url": "http://b",
+            "http_status": 503,
+            "resp_time": 1.0,
+            "regex_match": None,
+        },
+    ]
+    data = Store_manager.encode_copy_binary(
+        metrics, {"http://a": 1, "http://b": 70000}
+    ).read()
+
+    assert data.startswith(b"PGCOPY\n\377\r\n\0")
+    assert data.endswith(struct.pack(">h", -1))
+    offset = 19
+    rows = []
+    for _ in metrics:
+        (field_count,) = struct.unpack_from(">h", data, offset)
+        offset += 2
+        fields = []
+        for _ in range(field_count):
+            (length,) = struct.unpack_from(">i", data, offset)
+            offset += 4
+            fields.append(None if length < 0 else data[offset : offset + length])
+            offset += max(length, 0)
+        rows.append(fields)
+    assert offset == len(data) - 2
+
+    assert [struct.unpack(">q", row[0])[0] for row in rows] == [1000000, 2]
+    assert [struct.unpack(">i", row[1])[0] for row in rows] == [1, 70000]
+    assert [struct.unpack(">h", row[2])[0] for row in rows] == [200, 503]
+    assert [struct.unpack(">d", row[3])[0] for row in rows] == [0.5, 1.0]
+    assert [row[4] for row in rows] == [b"\x01", None]
+    assert struct.unpack(">d", rows[0][5])[0] == 0.25
+    assert rows[0][6:] == [None] * 3 and rows[1][5:] == [None] * 4
+
+
+def test_latest_metric_of_every_url_is_selected():
+    """Most recent metric per URL, whatever their order and time format"""
+    metrics = [
+        {
+            "time": "2000-01-01T00:00:02+00:00",
+            "web_url": "http://a",
+            "http_status": 200,
+        },
+        {
+            "time": "2000-01-01T00:00:01+00:00",
+            "web_url": "http://a",
+            "http_status": 503,
+        },
+        {
+            "time": datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc),
+            "web_url": "http://b",
+            "http_status": 404,
+        },
+        {
+            "time": "2000-01-01T01:00:00+01:00",
+            "web_url": "http://b",
+            "http_status": 200,
+        },
+    ]
+
+    latest = select_latest_metrics(metrics)
+
+    assert {url: metric["http_status"] for url, metric in latest.items()} == {
+        "http://a": 200,
+        "http://b": 200,
+    }
+
+
+def test_store_manager_caches_url_ids_in_lru_order():
+    """URLs missing in the cache are got or created in bulk, and the least recently
+    used ones are evicted"""
+    created = []
+
+    def create_url_ids(urls):
+        created.append(urls)
+        return {url: ord(url[-1]) for url in urls}
+
+    store_manager = Store_manager()
+    store_manager.url_cache_size = 3
+    store_manager.create_url_ids = create_url_ids
+
+    assert store_manager.get_url_ids(["http://a", "http://b", "http://a"]) == {
+        "http://a": 97,
+        "http://b": 98,
+    }
+    assert store_manager.get_url_ids(["http://c", "http://a"]) == {
+        "http://c": 99,
+        "http://a": 97,
+    }
+    # "http://b" is the least recently used URL
+    store_manager.get_url_ids(["http://d"])
+    store_manager.get_url_ids(["http://a", "http://b"])
+
+    assert created == [
+        ["http://a", "http://b"],
+        ["http://c"],
+        ["http://d"],
+        ["http://b"],
+    ]
+    assert list(store_manager.url_ids) == ["http://d", "http://a", "http://b"]
+
+
+def test_storage_policies_are_compared_as_intervals():
+    """Validate that the age thresholds of the storage policies are compared with their settings by Postgres, as intervals, and that a missing policy only matches an empty setting"""
+    db_cursor = unittest.mock.Mock()
+    db_cursor.fetchone.return_value = {"same_interval": False}
+
+    assert Store_manager.intervals_match(db_cursor, None, "")
+    assert not Store_manager.intervals_match(db_cursor, None, "7 days")
+    assert not Store_manager.intervals_match(db_cursor, "7 days", "")
+    db_cursor.execute.assert_not_called()
+    assert not Store_manager.intervals_match(db_cursor, "30 days", "7 days")
+    db_cursor.execute.assert_called_once_with(
+        "SELECT %s::interval = %s::interval AS same_interval", ("30 days", "7 days")
+    )
+
+
+def test_metrics_store_of_an_older_version_is_not_initialized():
+    """Validate that initializing a DB whose table stores web_url instead of url_id fails before creating anything, asking for its migration"""
+    db_connect = unittest.mock.MagicMock()
+    db_cursor = db_connect.cursor.return_value.__enter__.return_value
+    db_cursor.fetchall.return_value = [("time",), ("web_url",), ("http_status",)]
+    store_manager = Store_manager()
+    store_manager.db_connect = db_connect
+
+    with pytest.raises(RuntimeError, match="must be migrated"):
+        store_manager.initialize_metrics_store()
+
+    assert db_cursor.execute.call_count == 1
+    assert "information_schema.columns" in db_cursor.execute.call_args.args[0]
+    db_connect.close.assert_called_once()
+
+
+def test_sink_pipeline_seeks_to_offsets_stored_with_messages():
+    """Validate that assigned partitions are consumed from the offsets stored in DB, when there are any"""
+    retriever = Fake_retriever([])
+    inserter = Slow_inserter()
+    inserter.stored_offsets = {0: 42, 3: 7}
+    pipeline = Sink_pipeline(retriever, inserter)
+
+    Batch_flusher(pipeline).on_partitions_assigned(
+        {kafka.TopicPartition("metrics", 0), kafka.TopicPartition("metrics", 1)}
+    )
+
+    assert retriever.seeked == {kafka.TopicPartition("metrics", 0): 42}
+
+
+def test_partitions_moved_between_sink_processes_continue_from_stored_offsets():
+    """Validate the handover of partitions between two sink processes of the consumer group: the one losing them stores and commits its in-flight messages, and the one getting them consumes from the offsets stored with those messages"""
+    topic_partitions = [kafka.TopicPartition("metrics", n) for n in range(4)]
+    store = Slow_inserter()
+    old_owner = Fake_retriever([])
+    old_owner.take_consumed_messages = lambda: [{"n": 1}, {"n": 2}]
+    old_owner.last_batch_offsets = {topic_partitions[2]: 10, topic_partitions[3]: 20}
+    old_pipeline = Sink_pipeline(old_owner, store)
+    writer = threading.Thread(
+        target=lambda: old_pipeline.write_batch(*old_pipeline.batches.get())
+    )
+    writer.start()
+
+    Batch_flusher(old_pipeline).on_partitions_revoked(set(topic_partitions[2:]))
+    writer.join()
+    assert [message["n"] for message in store.stored] == [1, 2]
+    assert old_owner.committed == {topic_partitions[2]: 10, topic_partitions[3]: 20}
+
+    new_owner = Fake_retriever([])
+    Batch_flusher(Sink_pipeline(new_owner, store)).on_partitions_assigned(
+        set(topic_partitions[2:])
+    )
+    assert new_owner.seeked == {topic_partitions[2]: 10, topic_partitions[3]: 20}
+
+
+def test_batch_window_flushes_by_limits_and_follows_lag():
+    """Validate the flush reasons of a batch, and that target rows grow with the lag and shrink back when batches wait for the latency limit"""
+    window = Batch_window(max_rows=1000, max_bytes=4096, max_latency_secs=2.0)
+    assert window.target_rows == 100
+    assert window.flush_reason(99, 100, 1.0) is None
+    assert window.flush_reason(100, 100, 1.0) == Batch_window.ROWS
+    assert window.flush_reason(10, 4096, 1.0) == Batch_window.BYTES
+    assert window.flush_reason(0, 0, 2.0) == Batch_window.LATENCY
+
+    # Lag larger than a batch: batches grow up to max_rows
+    assert [window.adapt(5000, Batch_window.ROWS) for _ in range(5)] == [
+        200,
+        400,
+        800,
+        1000,
+        1000,
+    ]
+    # Unknown lag or lag which is not small enough keeps the target
+    assert window.adapt(None, Batch_window.LATENCY) == 1000
+    assert window.adapt(600, Batch_window.LATENCY) == 1000
+    # Little lag and batches waiting for the latency limit: batches shrink
+    assert window.adapt(0, Batch_window.LATENCY) == 500
+    assert window.adapt(0, Batch_window.ROWS) == 500
+    assert [window.adapt(0, Batch_window.LATENCY) for _ in range(4)] == [
+        250,
+        125,
+        100,
+        100,
+    ]
+
+    fixed_window = Batch_window(1000, 4096, 2.0, adaptive=False)
+    assert fixed_window.target_rows == 1000
+    assert fixed_window.adapt(5000, Batch_window.ROWS) == 1000
+
+
+Record = collections.namedtuple("Record", ("offset", "value"))
+
+
+class Fake_consumer:
+    """kafka.KafkaConsumer stand-in, which serves the messages of some partitions"""
+
+    def __init__(self, logs: dict) -> None:
+        self.logs = logs
+        self.positions = {topic_partition: 0 for topic_partition in logs}
+
+    def poll(self, timeout_ms: int = 0, max_records: int = None) -> dict:
+        responses = {}
+        for topic_partition, values in self.logs.items():
+            position = self.positions[topic_partition]
+            records = [
+                Record(offset, values[offset])
+                for offset in range(position, len(values))
+            ][: max_records - sum(map(len, responses.values()))]
+            if records:
+                responses[topic_partition] = records
+                self.positions[topic_partition] = records[-1].offset + 1
+        return responses
+
+    def assignment(self) -> set:
+        return set(self.logs)
+
+    def highwater(self, topic_partition: kafka.TopicPartition) -> int:
+        return len(self.logs[topic_partition])
+
+    def position(self, topic_partition: kafka.TopicPartition) -> int:
+        return self.positions[topic_partition]
+
+    def seek(self, topic_partition: kafka.TopicPartition, offset: int) -> None:
+        self.positions[topic_partition] = offset
+
+    def close(self, autocommit: bool = True) -> None:
+        pass
+
+
+def test_consumed_batches_are_bounded_by_rows_of_multi_sample_messages():
+    """Validate that batches of binary messages (30 samples each) never exceed their target rows, that messages left out are consumed by the next batch, and that the lag is reported in rows"""
+    sample = Probe_engine.initialize_sampling_data(["http://a"])[0]
+    sample.update(time=1621170000000000000, http_status=200, resp_time=0.25)
+    logs = {
+        kafka.TopicPartition("metrics", partition): [
+            wire_format.encode_samples(
+                [dict(sample, skipped_probes=partition * 100 + n)] * 30, "binary"
+            )
+            for n in range(20)
+        ]
+        for partition in range(2)
+    }
+    retriever = Communication_manager()
+    retriever.kafka_consumer = Fake_consumer(logs)
+    retriever.batch_window = Batch_window(
+        max_rows=250, max_bytes=10**9, max_latency_secs=0.05, min_rows=100
+    )
+
+    # Only whole messages: 3 messages (90 rows) fit in the first batch of 100 rows
+    batches = [retriever.consume_messages()]
+    assert len(batches[0]) == 90
+    assert retriever.last_batch_report["lag"] == 37 * 30
+    target_rows = []
+    while sum(map(len, batches)) < 1200:
+        target_rows.append(retriever.batch_window.target_rows)
+        batches.append(retriever.consume_messages())
+        assert 0 < len(batches[-1]) <= target_rows[-1] <= 250
+    # The lag in rows grows the batches up to max_rows
+    assert target_rows[:3] == [200, 250, 250]
+
+    # Every message is consumed once, in order within its partition
+    consumed = [metric["skipped_probes"] for batch in batches for metric in batch]
+    assert len(consumed) == 1200
+    for partition in range(2):
+        assert [n for n in consumed[::30] if n // 100 == partition] == [
+            partition * 100 + n for n in range(20)
+        ]
+
+
+def test_percentiles_are_estimated_from_rollup_histograms():
+    """Validate the percentiles estimated from the histograms of resp_time (4 buckets of 0.5 seconds, plus values below and above its bounds)"""
+    histogram = [0, 50, 30, 15, 5, 0]
+    assert estimate_percentile(histogram, 0.5, 0.0, 2.0) == pytest.approx(0.5)
+    assert estimate_percentile(histogram, 0.65, 0.0, 2.0) == pytest.approx(0.75)
+    assert estimate_percentile(histogram, 0.99, 0.0, 2.0) == pytest.approx(1.9)
+    # Out of bounds, percentiles are clamped to them
+    assert estimate_percentile([10, 0, 0, 0, 0, 0], 0.5, 0.0, 2.0) == 0.0
+    assert estimate_percentile([0, 1, 0, 0, 0, 9], 0.95, 0.0, 2.0) == 2.0
+    assert estimate_percentile([0] * 6, 0.5, 0.0, 2.0) is None
+
+
+def test_supervisor_lets_workers_stop_cleanly_before_terminating_them(tmp_path):
+    """Validate that stopping the supervisor interrupts every worker as Ctrl+C does, and only terminates the ones which ignore it"""
+
+    def stop_on_interrupt(worker_name: str, worker_names: list[str]) -> None:
+        try:
+            time.sleep(60)
+        except KeyboardInterrupt:
+            (tmp_path / worker_name).write_text("flushed")
+
+    def ignore_interrupt(worker_name: str, worker_names: list[str]) -> None:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        time.sleep(60)
+
+    supervisor = Agent_supervisor(2, stop_timeout_secs=0.5)
+    supervisor.target = stop_on_interrupt
+    supervisor.start_worker("worker-0")
+    supervisor.target = ignore_interrupt
+    supervisor.start_worker("worker-1")
+    time.sleep(0.2)  # Let workers install their handlers
+    supervisor.stop_workers()
+
+    assert (tmp_path / "worker-0").read_text() == "flushed"
+    assert supervisor.processes["worker-0"].exitcode == 0
+    assert supervisor.processes["worker-1"].exitcode == -signal.SIGTERM
@@ -8,52 +8,60 @@ and publishes (Producer) it to a Kafka topic:
 """
 
 # import daemon
+import argparse
 import sys
 from homeworks import config
 from homeworks import logging_console
-from homeworks.get_request_thread import Get_request_thread
+from homeworks.agent_supervisor import Agent_supervisor
+from homeworks.probe_engine import Probe_engine
 
 log = logging_console.getLogger("homeworks")
 
 
-def waitting_threads_ending_loop(threads: list[Get_request_thread]):
-    """Wait for threads to end, however these threads stop only
-    when they're killed; therefore process becomes a daemon and
-    it runs for always
+def parse_arguments(argv: list[str]) -> argparse.Namespace:
+    """Parse command line arguments
 
     Args:
-        urls (list[Get_request_thread]): List of threads waiting to end
-    """
-    for thread in threads:
-        thread.join()
+        argv (list[str]): Command line arguments, without the program name
 
-    log.warning("All threads stopped by themselves")
+    Returns:
+        argparse.Namespace: Parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Fork N worker processes, each one monitoring a shard of the URLs (split by consistent hashing). By default, all URLs are monitored by this process",
+    )
+    return parser.parse_args(argv)
 
 
-def main() -> int:
+def main(argv: list[str] = None) -> int:
     """Main program
 
+    Args:
+        argv (list[str], optional): Command line arguments. Defaults to sys.argv[1:].
+
     Returns:
         int: Return 0 if all ran without issues (Note: Ctrl+break is considered a normal way to stop it and it should exit with 0)
     """
     result = 1
-    threads = []
-    slice = 5  # Max. number of URLs managed by a thread
+    arguments = parse_arguments(sys.argv[1:] if argv is None else argv)
     try:
-        for i in range(0, len(config.monitored_url_targets), slice):
-            """From total list of URLs, it is splitted in slices
-            of 5 URLs (max.). One individual thread is created for
-            monitoring every slice
-            """
-            urls = config.monitored_url_targets[i : i + slice]
-            log.debug(f"Creating Thread for URLs: {urls}")
-            thread = Get_request_thread(urls)
-            thread.daemon = True  # Daemons are killed when the main program exits
-            thread.start()
-            threads.append(thread)
-
-        # TODO: URGENT! Run next call under 'daemon.DaemonContext()' context, following specifications PEP 3143
-        waitting_threads_ending_loop(threads)
+        # TODO: URGENT! Run next calls under 'daemon.DaemonContext()' context, following specifications PEP 3143
+        if arguments.workers:
+            log.info(f"Starting {arguments.workers} worker processes")
+            Agent_supervisor(arguments.workers).run()
+            log.warning("Agent supervisor stopped by itself")
+        else:
+            # One event loop monitors all URLs, see Probe_engine
+            log.debug(f"Creating engine for URLs: {config.monitored_url_targets}")
+            engine = Probe_engine(config.monitored_probe_specs)
+            engine.run()
+            log.warning("Probe engine stopped by itself")
     except KeyboardInterrupt:
         result = 0
         log.info("Keyboard interruption received (Ctrl+break)")